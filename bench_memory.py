@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# bench_memory
+'''
+:author:  madkote
+:contact: madkote(at)bluewin.ch
+
+Memory benchmark
+----------------
+The module measures the memory held by the stored items: items as plain
+dictionaries (as stored before ´mmshop.Item´), as item records and as
+the whole ´mmshop.ItemStore´ (records, indexes and columns).
+Usage: python bench_memory.py [count]
+'''
+
+import gc
+import logging
+import sys
+import tracemalloc
+
+import mmshop
+
+VERSION = (0, 2, 0)
+
+__all__ = []
+__author__ = 'madkote <madkote(at)bluewin.ch>'
+__version__ = '.'.join(str(x) for x in VERSION)
+
+COUNT = 1000000
+
+
+# =============================================================================
+# BENCHMARK
+# =============================================================================
+def make_items(count):
+    '''
+    Generate the items as they are decoded from JSON: every item has own
+    name and expiry strings.
+    :param count: The count of items
+    :return: list of item dictionaries
+    '''
+    return [{'id': i,
+             'name': 'item_%s' % i,
+             'price': 1.0 + (i % 1000) / 100.0,
+             'expire': '2030%02d%02d%02d%02d' % (1 + i % 12, 1 + i % 28,
+                                               i % 24, i % 60)}
+            for i in range(count)]
+
+
+def measure(build, count):
+    '''
+    Measure the memory held by the result of the build, the temporary
+    allocations of the build are not counted
+    :param build: The function building the items
+    :param count: The count of items
+    :return: The bytes per item
+    '''
+    gc.collect()
+    tracemalloc.start()
+    items = build(count)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del items
+    return size / count
+
+
+def bench(count):
+    '''
+    Run the benchmark
+    :param count: The count of items
+    '''
+    logging.info('items: %s' % count)
+    per_dict = measure(make_items, count)
+    logging.info('  dict:   %8.1f bytes/item' % per_dict)
+    per_item = measure(lambda n: [mmshop.Item.from_dict(i)
+                                  for i in make_items(n)], count)
+    logging.info('  Item:   %8.1f bytes/item' % per_item)
+    logging.info('  saving: %8.1f %%' % (100.0 * (1 - per_item / per_dict)))
+    # > the store built from the decoded items, as by the API
+    per_store = measure(lambda n: mmshop.ItemStore(make_items(n)), count)
+    logging.info('  store:  %8.1f bytes/item' % per_store)
+    logging.info('  index:  %8.1f bytes/item' % (per_store - per_item))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+    try:
+        bench(int(sys.argv[1]) if len(sys.argv) > 1 else COUNT)
+    finally:
+        logging.shutdown()
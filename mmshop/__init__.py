@@ -12,6 +12,16 @@ The package provides web API for a simple shop application
 
 from mmshop.settings import *
 
+from mmshop.store import *
+from mmshop.models import *
+from mmshop.changes import *
+from mmshop.storage import *
+from mmshop.shared import *
+from mmshop.cache import *
+from mmshop.serializer import *
+from mmshop.compression import *
+from mmshop.tuning import *
+
 from mmshop.api import *
 from mmshop.cli import *
 
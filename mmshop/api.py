@@ -11,15 +11,22 @@ The API implementation
 '''
 
 import cherrypy
+import cherrypy.lib.static
 import datetime
+import hashlib
 import jinja2
 import json
 import logging
+import math
 import os
+import re
+import threading
+import time
+import types
 
 import mmshop
 
-VERSION = (0, 4, 0)
+VERSION = (0, 7, 0)
 
 __all__ = ['MickeyMouseShop']
 __author__ = 'madkote <madkote(at)bluewin.ch>'
@@ -30,8 +37,69 @@ __version__ = '.'.join(str(x) for x in VERSION)
 # =============================================================================
 _DEBUG = mmshop.API_FLAG_DEBUG
 _PATH_WWW = mmshop.API_PATH_WWW
+_IMAGE_SERVE_MODE = mmshop.API_IMAGE_SERVE_MODE
 
-EXPIRE_FORMAT = '%Y%m%d%H%M'
+EXPIRE_FORMAT = mmshop.EXPIRE_FORMAT
+STREAM_FORMATS = ('json', 'ndjson')
+STREAM_CHUNK_SIZE = 100
+BULK_ID = '_bulk'
+# > key of the cached list of all items, see ´RenderCache´
+ITEMS_PAGE = 'items'
+# > routes of ´/item´ by method and path: ´item´ (´/item´ and ´/item/<id>´),
+#   ´bulk´ (´/item/_bulk´) and ´field´ (´/item/<id>/<field>´)
+ITEM_ROUTES = {('GET', 'item'): '_GET_item',
+               ('POST', 'item'): '_POST_item',
+               ('PUT', 'item'): '_PUT_item',
+               ('PATCH', 'item'): '_PATCH_item',
+               ('POST', 'bulk'): '_POST_bulk',
+               ('GET', 'field'): '_GET_field',
+               ('PUT', 'field'): '_PUT_field'}
+_ITEM_PATHS = {BULK_ID: 'bulk'}
+QUERY_PARAMS = ('name', 'name_prefix', 'price_min', 'price_max', 'expire_min',
+                'expire_max', 'sort', 'order')
+# > change feed: heartbeat (seconds) keeps idle connections open and
+#   checks the expiry, streams end after the maximal time (seconds) to
+#   release the server thread, the browser reconnects after the retry
+#   time (milliseconds)
+CHANGES_HEARTBEAT = 5
+CHANGES_STREAM_TIME = 300
+CHANGES_RETRY = 3000
+# > maximal wait (seconds) of ´GET /item?since=<seq>&wait=<s>´
+CHANGES_WAIT_MAX = 60
+# > every waiting request (change feed or long poll) holds a server thread,
+#   at most this share of ´server.thread_pool´ waits at once, so the other
+#   threads keep serving the API
+CHANGES_WAITING_SHARE = 0.5
+
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_MIME_TYPES = ('text/html', 'text/plain', 'text/css', 'text/csv',
+                       'application/json', 'application/javascript',
+                       'application/x-ndjson', 'image/svg+xml')
+# > ETags of compressed bodies: the ETag of the identity body with the
+#   encoding appended, e.g. ´"<md5>-gzip"´
+_RE_ETAG_ENCODING = re.compile(r'-(?:gzip|br)"')
+
+# > Cache-Control by kind of response:
+#   * view, read - can be stored, but must be validated with ETag
+#   * image      - fresh for a while, then validated with ETag/Last-Modified
+#   * stats      - can be stored, but must be fetched again
+#   * write      - responses of updates, never stored
+#   * changes    - change feed and deltas, never stored
+#   * error      - error responses, never stored
+#   static assets get ´API_STATIC_CACHE_CONTROL´ from ´API_CONFIG´, see
+#   ´cache_policy´
+CACHE_POLICY = {'view': 'no-cache',
+                'read': 'no-cache',
+                'image': mmshop.API_IMAGE_CACHE_CONTROL,
+                'stats': 'no-cache',
+                'write': 'no-store',
+                'changes': 'no-store',
+                'error': 'no-store'}
+_HEADERS_REVALIDATE = [('Cache-Control', CACHE_POLICY['view'])]
+_HEADERS_READ = [('Cache-Control', CACHE_POLICY['read'])]
+_HEADERS_IMAGE = [('Cache-Control', CACHE_POLICY['image'])]
+_HEADERS_STATS = [('Cache-Control', CACHE_POLICY['stats'])]
+_HEADERS_EVENTS = [('Cache-Control', CACHE_POLICY['changes'])]
 
 
 # =============================================================================
@@ -45,6 +113,222 @@ def with_static(m):
     return wrapper
 
 
+# =============================================================================
+# TOOLS
+# =============================================================================
+def compress_response(min_size=COMPRESS_MIN_SIZE, level=6, brotli_level=5,
+                      mime_types=COMPRESS_MIME_TYPES):
+    '''
+    Compress the response body with the encoding accepted by the client,
+    see ´mmshop.negotiate_encoding´. Only complete ´200´ responses of the
+    MIME types and at least ´min_size´ bytes are compressed, streamed
+    responses are sent as they are. Handlers of cached responses set
+    ´cherrypy.request.variants´ to the dictionary of compressed
+    variants kept with the cached body, the body is then compressed
+    only once. The ETag of a compressed body gets the encoding appended,
+    see ´encoding_etag´.
+    :param min_size: The minimal size (bytes) of compressed bodies
+    :param level: The gzip compression level
+    :param brotli_level: The brotli quality
+    :param mime_types: The compressed MIME types
+    '''
+    request = cherrypy.serving.request
+    response = cherrypy.serving.response
+    if response.stream or 'Content-Encoding' in response.headers:
+        return
+    status = cherrypy.lib.httputil.valid_status(response.status)[0]
+    encoding = mmshop.negotiate_encoding(request.headers.get('Accept-Encoding'))  # @IgnorePep8
+    etag = response.headers.get('ETag')
+    if status == 304:
+        # > the client has the compressed body, see ´validate_etags´
+        if etag and encoding and encoding_etag(etag, encoding) in getattr(request, 'etag_conditions', ''):  # @IgnorePep8
+            response.headers['ETag'] = encoding_etag(etag, encoding)
+        return
+    if status != 200:
+        return
+    content_type = response.headers.get('Content-Type', '').split(';')[0]
+    if content_type not in mime_types:
+        return
+    # > caches must keep the variants apart
+    vary = response.headers.get('Vary')
+    response.headers['Vary'] = vary + ', Accept-Encoding' if vary else 'Accept-Encoding'  # @IgnorePep8
+    if encoding is None:
+        return
+    variants = getattr(request, 'variants', None)
+    body = variants.get(encoding) if variants is not None else None
+    if body is None:
+        data = response.collapse_body()
+        if len(data) < min_size:
+            return
+        body = mmshop.compress(data, encoding, level, brotli_level)
+        if variants is not None:
+            variants[encoding] = body
+    response.body = body
+    response.headers['Content-Encoding'] = encoding
+    response.headers['Content-Length'] = str(len(body))
+    # > the compressed body is another representation with its own ETag
+    if etag:
+        response.headers['ETag'] = encoding_etag(etag, encoding)
+
+
+cherrypy.tools.compress = cherrypy.Tool('before_finalize', compress_response,
+                                        priority=80)
+
+
+def cache_policy(static=None):
+    '''
+    Finish the caching policy of the response. Error responses are never
+    stored. Static assets (responses with the policy ´static´) are shared
+    by the caches: only successful responses keep the policy, and they do
+    not set the session cookie.
+    :param static: The policy of static assets
+        (default: ´API_STATIC_CACHE_CONTROL´)
+    '''
+    request = cherrypy.serving.request
+    response = cherrypy.serving.response
+    status = cherrypy.lib.httputil.valid_status(response.status)[0]
+    policy = response.headers.get('Cache-Control')
+    if policy == (static or mmshop.API_STATIC_CACHE_CONTROL):
+        session_cookie = request.config.get('tools.sessions.name', 'session_id')  # @IgnorePep8
+        if session_cookie in response.cookie:
+            del response.cookie[session_cookie]
+        if not (200 <= status < 300 or status == 304):
+            response.headers['Cache-Control'] = CACHE_POLICY['error']
+    elif status >= 400:
+        response.headers['Cache-Control'] = CACHE_POLICY['error']
+
+
+class CachePolicyTool(cherrypy.Tool):
+    '''
+    Tool of ´cache_policy´: runs before the response is finalized and
+    after unexpected errors, which skip ´before_finalize´
+    '''
+    def __init__(self):
+        super(CachePolicyTool, self).__init__('before_finalize', cache_policy,
+                                              priority=90)
+
+    def _setup(self):
+        super(CachePolicyTool, self)._setup()
+        conf = self._merged_args()
+        conf.pop('priority', None)
+        cherrypy.serving.request.hooks.attach('after_error_response',
+                                              self.callable, **conf)
+
+
+cherrypy.tools.cache_policy = CachePolicyTool()
+
+
+def encoding_etag(etag, encoding):
+    '''
+    Get the ETag of the compressed body
+    :param etag: The ETag of the identity body
+    :param encoding: The content encoding
+    :return: The ETag
+    '''
+    return '%s-%s"' % (etag[:-1], encoding)
+
+
+def validate_etags():
+    '''
+    Validate the ETag of the response against ´If-Match´ and
+    ´If-None-Match´, see ´cherrypy.lib.cptools.validate_etags´. The
+    ETags of the compressed bodies (see ´encoding_etag´) match the ETag
+    of the identity body, a ´304´ response gets the ETag of the
+    representation the client has.
+    '''
+    request = cherrypy.serving.request
+    request.etag_conditions = request.headers.get('If-None-Match', '')
+    for name in ('If-Match', 'If-None-Match'):
+        value = request.headers.get(name)
+        if value:
+            request.headers[name] = _RE_ETAG_ENCODING.sub('"', value)
+    cherrypy.lib.cptools.validate_etags()
+
+
+# =============================================================================
+# HANDLERS
+# =============================================================================
+def json_handler(*args, **kwargs):
+    '''
+    JSON output handler for ´tools.json_out´ using the fastest installed
+    JSON encoder. Encoded (bytes) and streamed (generator) bodies are
+    passed through.
+    '''
+    value = cherrypy.serving.request._json_inner_handler(*args, **kwargs)
+    if isinstance(value, (bytes, types.GeneratorType)):
+        return value
+    return mmshop.encode_json(value)
+
+
+# =============================================================================
+# VALIDATION
+# =============================================================================
+_FIELD_NAMES = {'id': 'ID', 'name': 'Name', 'price': 'Price',
+                'expire': 'Expire'}
+
+
+def _check_id(value):
+    if isinstance(value, str):
+        try:
+            value = int(value)
+        except Exception as e:
+            raise ValueError('ID field in the entity must be integer: %s' % e)
+    elif not isinstance(value, int):
+        raise ValueError('ID field in the entity must be integer')
+    try:
+        return mmshop.check_item_id(value)
+    except ValueError as e:
+        raise ValueError('ID field in the entity must be 64-bit integer: %s' % e)  # @IgnorePep8
+
+
+def _check_name(value):
+    if not isinstance(value, str):
+        try:
+            return str(value)
+        except Exception as e:
+            raise ValueError('Name field in the entity must be string: %s' % e)
+    return value
+
+
+def _check_price(value):
+    if isinstance(value, str):
+        try:
+            value = float(value)
+        except Exception as e:
+            raise ValueError('Price field in the entity must be float: %s' % e)
+    elif not isinstance(value, float):
+        raise ValueError('Price field in the entity must be float')
+    # > NaN and infinity would break the ordering and the sums of prices
+    if not math.isfinite(value):
+        raise ValueError('Price field in the entity must be finite')
+    return value
+
+
+def _check_expire(value):
+    if not isinstance(value, str):
+        value = str(value)
+    try:
+        mmshop.parse_expire(value)
+    except ValueError as e:
+        raise ValueError('Expire field in the entity must be date/time: %s' % e)  # @IgnorePep8
+    return value
+
+
+# > validation of the known fields, other fields are stored as given, the
+#   checks raise ´ValueError´ with the message of the ´404´ response
+_FIELD_CHECKS = {'id': _check_id, 'name': _check_name, 'price': _check_price,
+                 'expire': _check_expire}
+
+
+def item_etag(item):
+    '''
+    Get the entity tag of the item version
+    :param item: The item
+    :return: The ETag
+    '''
+    return '"%s"' % item.version
+
+
 # =============================================================================
 # DUMMY
 # =============================================================================
@@ -77,47 +361,99 @@ class MickeyMouseShop(object):
     '''
     Simple web service API
     '''
-    def __init__(self, flag_static=False):
+    def __init__(self, flag_static=False, store=None):
+        '''
+        :param flag_static: Flag to serve the HTML views
+        :param store: The item store or the store specification, see
+            ´mmshop.open_store´ (default: in-memory store), new stores
+            are initialized with the dummy items
+        '''
         self.env = jinja2.Environment(loader=jinja2.FileSystemLoader(_PATH_WWW))  # @IgnorePep8
+        if store is None or isinstance(store, str):
+            store = mmshop.open_store(store, _ITEMS)
+        self.store = store
+        self.pages = mmshop.RenderCache()
+        self.images = mmshop.LRUCache(mmshop.API_IMAGE_CACHE_SIZE)
+        # > encoded items are cached for the in-memory stores only
+        self.serializer = mmshop.ItemSerializer(
+            cache_size=None if isinstance(store, mmshop.ItemStore) else 0)
+        self._routes = dict((k, getattr(self, v))
+                            for k, v in ITEM_ROUTES.items())
+        self._waiting = 0
+        self._waiting_lock = threading.Lock()
         self.__flag_static = flag_static
 
-    def _check_item(self, _item):
+    def _check_item(self, _item, _new=False):
         '''
         Check / validate item
         :param _item: Item to be validated
-        :return: the validated item
+        :param _new: Flag the ID may be missing, it is assigned by the store
+        :return: the validated item record
         :raise cherrypy.HTTPError: ´404´ if item is not valid
         '''
-        # ID
-        if 'id' not in _item:
-            raise cherrypy.HTTPError(404, 'ID field in the entity must be defined')  # @IgnorePep8
-        elif isinstance(_item['id'], str):
-            try:
-                _item['id'] = int(_item['id'])
-            except Exception as e:
-                raise cherrypy.HTTPError(404, 'ID field in the entity must be integer: %s' % e)  # @IgnorePep8
-        elif not isinstance(_item['id'], int):
-            raise cherrypy.HTTPError(404, 'ID field in the entity must be integer')  # @IgnorePep8
-        # name
-        if 'name' not in _item:
-            raise cherrypy.HTTPError(404, 'Name field in the entity must be defined')  # @IgnorePep8
-        elif not isinstance(_item['name'], str):
-            try:
-                _item['name'] = str(_item['name'])
-            except Exception as e:
-                raise cherrypy.HTTPError(404, 'Name field in the entity must be string: %s' % e)  # @IgnorePep8
-        # price
-        if 'price' not in _item:
-            raise cherrypy.HTTPError(404, 'Price field in the entity must be defined')  # @IgnorePep8
-        elif isinstance(_item['price'], str):
-            try:
-                _item['price'] = float(_item['price'])
-            except Exception as e:
-                raise cherrypy.HTTPError(404, 'ID field in the entity must be float: %s' % e)  # @IgnorePep8
-        elif not isinstance(_item['price'], float):
-            raise cherrypy.HTTPError(404, 'Price field in the entity must be float')  # @IgnorePep8
+        try:
+            return self._validate_item(_item, _new)
+        except ValueError as e:
+            raise cherrypy.HTTPError(404, str(e))
+
+    def _validate_item(self, _item, _new=False):
+        '''
+        Validate item, see ´_check_item´
+        :param _item: Item to be validated
+        :param _new: Flag the ID may be missing, it is assigned by the store
+        :return: the validated item record
+        :raise ValueError: if item is not valid
+        '''
+        for k in ('id', 'name', 'price'):
+            if k not in _item and not (_new and k == 'id'):
+                raise ValueError('%s field in the entity must be defined' % _FIELD_NAMES[k])  # @IgnorePep8
+        self._validate_fields(_item)
         # OK
-        return _item
+        return mmshop.Item.from_dict(_item)
+
+    def _check_fields(self, _data):
+        '''
+        Check / validate the given fields of an item, the values are
+        converted in place
+        :param _data: The fields to be validated
+        :return: the validated fields
+        :raise cherrypy.HTTPError: ´404´ if a field is not valid
+        '''
+        try:
+            return self._validate_fields(_data)
+        except ValueError as e:
+            raise cherrypy.HTTPError(404, str(e))
+
+    def _validate_fields(self, _data):
+        '''
+        Validate the given fields of an item, see ´_check_fields´
+        :param _data: The fields to be validated
+        :return: the validated fields
+        :raise ValueError: if a field is not valid
+        '''
+        for k, v in _data.items():
+            check = _FIELD_CHECKS.get(k)
+            if check is not None:
+                _data[k] = check(v)
+        return _data
+
+    def _if_match(self, _item, _request):
+        '''
+        Get the item version expected by the ´If-Match´ precondition
+        :param _item: The current item
+        :param _request: The request
+        :return: The expected version or ´None´ if any version matches
+        :raise cherrypy.HTTPError: ´412´ if the item version does not match
+        '''
+        value = _request.headers.get('If-Match')
+        if value is None:
+            return None
+        etags = [etag.strip() for etag in _RE_ETAG_ENCODING.sub('"', value).split(',')]  # @IgnorePep8
+        if '*' in etags:
+            return None
+        if item_etag(_item) in etags:
+            return _item.version
+        raise cherrypy.HTTPError(412, 'Item version does not match: %s' % value)  # @IgnorePep8
 
     def _GET_item(self, _id, _request):
         '''
@@ -130,19 +466,186 @@ class MickeyMouseShop(object):
         '''
         if _id is None:
             # all items
-            return _ITEMS[:]
+            if _request is None:
+                return self.store.items()
+            return self._GET_items(_request.params)
         else:
             # search for item with given ID
             try:
                 _id = int(_id)
             except ValueError as e:
                 raise cherrypy.HTTPError(404, 'Item ID not valid: %s' % e)
+            try:
+                return self.store.get(_id)
+            except mmshop.ItemNotFoundError:
+                raise cherrypy.HTTPError(404, 'Item could not be found.')
+
+    def _GET_items(self, _params):
+        '''
+        Get the items list, optionally paginated or streamed. Supported
+        parameters:
+        * limit  :: the maximal count of items
+        * after  :: the cursor - ID of the last item of the previous page
+        * stream :: stream the items as ´json´ array or ´ndjson´
+        * expired :: ´true´ or ´false´ - only expired or not expired items
+            ordered by expiry, can not be used with ´after´
+        * name, name_prefix :: only items with the name or the name prefix
+        * price_min, price_max :: only items in the price range (inclusive)
+        * expire_min, expire_max :: only items in the expiry range
+            (inclusive, ´EXPIRE_FORMAT´)
+        * sort :: sort key ´id´ (default), ´name´, ´price´ or ´expire´
+        * order :: sort order ´asc´ (default) or ´desc´
+        * since, wait :: only the changes after the sequence number,
+            see ´_GET_changes´ (other parameters are ignored)
+        The query parameters can be used with ´expired´ and ´after´.
+        The cursor for the next page is returned in ´X-Next-After´ header.
+        :param _params: The request parameters
+        :return: The items list or a generator for streamed items
+        :raise cherrypy.HTTPError: ´404´ if any parameter is invalid
+        '''
+        if 'since' in _params:
+            return self._GET_changes(_params)
+        # > the client can follow the changes made after the items are read
+        cherrypy.response.headers['X-Changes-Seq'] = str(self.store.changes.seq)  # @IgnorePep8
+        if not _params:
+            return self._GET_all()
+        try:
+            limit = _params.get('limit')
+            limit = int(limit) if limit is not None else None
+            after = _params.get('after')
+            after = int(after) if after is not None else None
+        except ValueError as e:
+            raise cherrypy.HTTPError(404, 'Pagination not valid: %s' % e)
+        query = dict((k, _params[k]) for k in QUERY_PARAMS if k in _params)
+        try:
+            for k in ('price_min', 'price_max'):
+                if k in query:
+                    query[k] = float(query[k])
+            for k in ('expire_min', 'expire_max'):
+                if k in query:
+                    query[k] = mmshop.parse_expire(query[k])
+        except ValueError as e:
+            raise cherrypy.HTTPError(404, 'Query not valid: %s' % e)
+        if query.get('sort', 'id') not in mmshop.QUERY_SORT_KEYS:
+            raise cherrypy.HTTPError(404, 'Sort key not valid: %s' % query['sort'])  # @IgnorePep8
+        if query.get('order', 'asc') not in ('asc', 'desc'):
+            raise cherrypy.HTTPError(404, 'Sort order not valid: %s' % query['order'])  # @IgnorePep8
+        if limit is not None and limit < 1:
+            raise cherrypy.HTTPError(404, 'Pagination limit must be positive')  # @IgnorePep8
+        stream = _params.get('stream')
+        if stream is not None and stream not in STREAM_FORMATS:
+            raise cherrypy.HTTPError(404, 'Stream format not valid: %s' % stream)  # @IgnorePep8
+        expired = _params.get('expired')
+        if expired is not None:
+            if expired not in ('true', 'false'):
+                raise cherrypy.HTTPError(404, 'Expired filter not valid: %s' % expired)  # @IgnorePep8
+            expired = expired == 'true'
+        if query:
+            try:
+                items, next_after = self.store.query(
+                    expired=expired, after=after, limit=limit, **query)
+            except mmshop.ItemNotFoundError:
+                raise cherrypy.HTTPError(404, 'Pagination cursor not found: %s' % after)  # @IgnorePep8
+        elif expired is not None:
+            if after is not None:
+                raise cherrypy.HTTPError(404, 'Expired filter can not be paginated with cursor')  # @IgnorePep8
+            items = self.store.expired(flag=expired)[:limit]
+            next_after = None
+        else:
+            items, next_after = self.store.page(after, limit)
+        if next_after is not None:
+            cherrypy.response.headers['X-Next-After'] = str(next_after)
+        if stream:
+            return self._stream_items(items, stream)
+        return items
+
+    def _GET_all(self):
+        '''
+        Get all items. The encoded list is cached until the items change,
+        together with its ETag and compressed variants.
+        :return: The items list (encoded)
+        '''
+        version = self.store.version
+        page = self.pages.get(ITEMS_PAGE, version, None)
+        if page is None:
+            body = self.serializer.encode_items(self.store.items())
+            # > a write in the meantime may be in the list already
+            if self.store.version != version:
+                return body
+            page = self.pages.put(ITEMS_PAGE, version, None, body)
+        cherrypy.response.headers['ETag'] = page.etag
+        validate_etags()
+        cherrypy.request.variants = page.variants
+        return page.body
+
+    def _GET_changes(self, _params):
+        '''
+        Get the item changes after the sequence number (long polling).
+        If there are no changes yet, the request waits for them up to
+        ´wait´ seconds (default: no wait, at most ´CHANGES_WAIT_MAX´).
+        If too many requests wait already (´CHANGES_WAITING_SHARE´), it
+        answers at once with ´Retry-After´.
+        The response is ´{"seq": <seq>, "changes": [...]}´ with the changes
+        as ´{"seq": <seq>, "op": "create|update", "item": {...}}´, the
+        client passes ´seq´ as ´since´ of the next request. Start with
+        ´since=0´ or read all items and start with their sequence number
+        from the ´X-Changes-Seq´ header of ´GET /item´.
+        :param _params: The request parameters
+        :return: The changes (encoded)
+        :raise cherrypy.HTTPError: ´404´ if any parameter is invalid,
+            ´410´ if the changes are not kept anymore - the client has
+            to read all items again
+        '''
+        try:
+            since = int(_params['since'])
+            wait = float(_params.get('wait', 0))
+        except ValueError as e:
+            raise cherrypy.HTTPError(404, 'Changes cursor not valid: %s' % e)  # @IgnorePep8
+        wait = min(max(wait, 0), CHANGES_WAIT_MAX)
+        if wait and not self._start_waiting():
+            # > all waiting threads are taken, answer at once
+            wait = 0
+            cherrypy.response.headers['Retry-After'] = str(CHANGES_RETRY // 1000)  # @IgnorePep8
+        try:
+            if wait:
+                changes = self.store.changes.wait(since, wait)
             else:
-                for i in _ITEMS:
-                    if i['id'] == _id:
-                        return i
-                else:
-                    raise cherrypy.HTTPError(404, 'Item could not be found.')
+                changes = self.store.changes.since(since)
+        except mmshop.ChangesExpiredError:
+            raise cherrypy.HTTPError(410, 'Changes are not available anymore: %s' % since)  # @IgnorePep8
+        seq = changes[-1].seq if changes else since
+        cherrypy.response.headers['X-Changes-Seq'] = str(seq)
+        cherrypy.response.headers['Cache-Control'] = CACHE_POLICY['changes']
+        return self.serializer.encode_changes(changes, seq)
+
+    def _stream_items(self, _items, _format):
+        '''
+        Stream the items, the response is sent in chunks while encoding
+        :param _items: The items
+        :param _format: The stream format ´json´ or ´ndjson´
+        :return: generator of encoded chunks
+        '''
+        cherrypy.response.stream = True
+        if _format == 'ndjson':
+            cherrypy.response.headers['Content-Type'] = 'application/x-ndjson'  # @IgnorePep8
+            head, sep, tail = b'', b'\n', b'\n'
+        else:
+            head, sep, tail = b'[', b', ', b']'
+        encode_item = self.serializer.encode_item
+
+        def body():
+            chunk = [head]
+            for n, item in enumerate(_items):
+                if n:
+                    chunk.append(sep)
+                chunk.append(encode_item(item))
+                if len(chunk) >= STREAM_CHUNK_SIZE:
+                    yield b''.join(chunk)
+                    chunk = []
+            if _items or _format == 'json':
+                chunk.append(tail)
+            yield b''.join(chunk)
+        return body()
 
     def _POST_item(self, _id, _request):
         '''
@@ -159,24 +662,15 @@ class MickeyMouseShop(object):
         except Exception as e:
             raise cherrypy.HTTPError(404, 'Can not process data: %s' % e)
         # determine ID
-        if 'id' in data:
-            # existing item
-            try:
-                i = self._GET_item(data['id'], _request)
-            except Exception as e:
-                pass
-            else:
-                raise cherrypy.HTTPError(409, 'Item with id "%s" exists already' % data['id'])  # @IgnorePep8
-        else:
+        if 'id' not in data:
             # next ID for item
-            try:
-                data['id'] = max([i['id'] for i in _ITEMS]) + 1
-            except Exception as e:
-                raise cherrypy.HTTPError(404, 'Can not find next ID: %s' % e)
+            data['id'] = self.store.next_id()
         # check and add data
         try:
             data = self._check_item(data)
-            _ITEMS.append(data)
+            data = self.store.add(data)
+        except mmshop.ItemExistsError:
+            raise cherrypy.HTTPError(409, 'Item with id "%s" exists already' % data['id'])  # @IgnorePep8
         except cherrypy.HTTPError as e:
             raise e
         except Exception as e:
@@ -186,6 +680,58 @@ class MickeyMouseShop(object):
         # result
         return data
 
+    def _POST_bulk(self, _request):
+        '''
+        Add new items at once. The body is a JSON array of items or
+        an NDJSON stream (Content-Type ´application/x-ndjson´). Items are
+        validated in one pass, missing IDs are allocated in a block and
+        the valid items are added with a single store write.
+        :param _request: The request
+        :return: The count of created and failed items and the result
+            (´id´, ´status´ and ´error´) for every item in the given order
+        :raise cherrypy.HTTPError: ´404´ if any problems processing data
+        '''
+        # data
+        content_type = str(_request.headers.get('Content-Type', ''))
+        try:
+            if content_type.startswith('application/x-ndjson'):
+                data = [json.loads(line.decode('utf-8'))
+                        for line in _request.body if line.strip()]
+            else:
+                data = json.loads(_request.body.read().decode('utf-8'))
+                if not isinstance(data, list):
+                    raise ValueError('JSON array of items expected')
+            data = [dict(i) for i in data]
+        except Exception as e:
+            raise cherrypy.HTTPError(404, 'Can not process data: %s' % e)
+        # check, the store assigns the missing IDs after the given ones
+        results = [None] * len(data)
+        positions = []
+        items = []
+        for n, i in enumerate(data):
+            try:
+                items.append(self._validate_item(i, _new=True))
+            except ValueError as e:
+                results[n] = {'id': i.get('id'), 'status': 404,
+                              'error': str(e)}
+            else:
+                positions.append(n)
+        # add data
+        errors = self.store.add_many(items)
+        for n, i, e in zip(positions, items, errors):
+            if e is None:
+                results[n] = {'id': i.id, 'status': 201}
+            elif isinstance(e, mmshop.ItemExistsError):
+                results[n] = {'id': i.id, 'status': 409,
+                              'error': 'Item with id "%s" exists already' % i.id}  # @IgnorePep8
+            else:
+                results[n] = {'id': i.id, 'status': 404,
+                              'error': 'Can not add data: %s' % e}
+        created = errors.count(None)
+        return {'created': created,
+                'failed': len(results) - created,
+                'results': results}
+
     def _PUT_item(self, _id, _request):
         '''
         Update the item by ID
@@ -203,63 +749,239 @@ class MickeyMouseShop(object):
         else:
             if not data:
                 raise cherrypy.HTTPError(204, 'No data: %s' % e)
+        return self._update_item(_id, data, _request)
+
+    def _PATCH_item(self, _id, _request):
+        '''
+        Update fields of the item. Only the given fields are validated and
+        replaced, the item is not copied and revalidated as a whole. The
+        update is applied atomically by the store, with ´If-Match´ it is
+        applied only if the item version matches.
+        :param _id: The item ID
+        :param _request: The request
+        :return: Updated item
+        :raise cherrypy.HTTPError: ´400´ if cannot process data,
+            ´404´ if cannot update or
+            ´412´ if the item version does not match.
+        '''
+        if _id is None:
+            raise cherrypy.HTTPError(404, 'Item ID is expected')
+        try:
+            data = dict(json.loads(_request.body.read().decode("utf-8")))
+        except Exception as e:
+            raise cherrypy.HTTPError(400, 'Can not process data: %s' % e)
+        else:
+            if not data:
+                raise cherrypy.HTTPError(400, 'No data')
+        c = self._GET_item(_id, _request)
+        self._check_fields(data)
+        if data.get('id', c.id) != c.id:
+            raise cherrypy.HTTPError(404, 'ID field in the entity can not be changed')  # @IgnorePep8
+        version = self._if_match(c, _request)
+        try:
+            c = self.store.update(c.id, data, version)
+        except mmshop.ItemVersionError:
+            raise cherrypy.HTTPError(412, 'Item was updated in the meantime')  # @IgnorePep8
+        except Exception as e:
+            raise cherrypy.HTTPError(404, 'Cannot update data: %s' % e)
+        return c
+
+    def _GET_field(self, _id, _field, _request):
+        '''
+        Get a field of the item
+        :param _id: The item ID
+        :param _field: The field name
+        :param _request: The request
+        :return: The field value
+        :raise cherrypy.HTTPError: ´404´ if there is no item with the given
+            ID or the item has not the field
+        '''
+        c = self._GET_item(_id, _request)
+        try:
+            return c[_field]
+        except KeyError:
+            raise cherrypy.HTTPError(404, 'Item has no field "%s"' % _field)
+
+    def _PUT_field(self, _id, _field, _request):
+        '''
+        Update a field of the item, the body is the JSON value
+        :param _id: The item ID
+        :param _field: The field name
+        :param _request: The request
+        :return: Updated field value
+        :raise cherrypy.HTTPError: ´400´ if cannot process data or
+            ´404´ if cannot update.
+        '''
+        try:
+            value = json.loads(_request.body.read().decode("utf-8"))
+        except Exception as e:
+            raise cherrypy.HTTPError(400, 'Can not process data: %s' % e)
+        return self._update_item(_id, {_field: value}, _request)[_field]
+
+    def _update_item(self, _id, data, _request):
+        '''
+        Validate and update the item. With ´If-Match´ the update is applied
+        only if the item version matches.
+        :param _id: The item ID
+        :param data: The fields to be updated
+        :param _request: The request
+        :return: Updated item
+        :raise cherrypy.HTTPError: ´404´ if cannot update or
+            ´412´ if the item version does not match.
+        '''
         try:
             # get item
             c = self._GET_item(_id, _request)
             # check if update will not break anything
-            d = dict(c)
+            d = c.to_dict()
             d.update(data)
             self._check_item(d)
+            if d['id'] != c.id:
+                raise cherrypy.HTTPError(404, 'ID field in the entity can not be changed')  # @IgnorePep8
             # update
-            c.update(data)
+            c = self.store.update(c.id, d, self._if_match(c, _request))
         except cherrypy.HTTPError as e:
             raise e
+        except mmshop.ItemVersionError:
+            raise cherrypy.HTTPError(412, 'Item was updated in the meantime')  # @IgnorePep8
         except Exception as e:
             raise cherrypy.HTTPError(404, 'Cannot update data: %s' % e)
         return c
 
     def _view_monitor(self, **kwargs):
         '''
+        Render the monitor view. The rendered page is cached until
+        the items change or the next item expires and it is validated
+        with ETag.
         supported by template:
         * fontsize
         '''
+        key = tuple(sorted(kwargs.items()))
+        now = datetime.datetime.now()
+        version = self.store.version
+        page = self.pages.get(key, version, mmshop.expire_key(now))
+        if page is None:
+            body = self._render_monitor(now, **kwargs).encode('utf-8')
+            page = self.pages.put(key, version,
+                                  self.store.next_expire(now), body)
+        cherrypy.response.headers['ETag'] = page.etag
+        validate_etags()
+        cherrypy.request.variants = page.variants
+        return page.body
+
+    def _render_monitor(self, now, **kwargs):
+        '''
+        Render the monitor template
+        :param now: The time to check the items expiry
+        :return: The rendered page
+        '''
         tmpl = self.env.get_template('mmshop.html')
+        # > the page follows the changes made after it was rendered
+        seq = self.store.changes.seq
+        expired = self.store.expired(now)
         data = {'title': 'Welcome to Mickey Mouse shop',
-                'items': self._GET_item(None, cherrypy.request),
-                'expire': {},
+                'items': self.store.items(),
+                'expire': dict((i.id, True) for i in expired),
+                'changes_url': '%s/changes?since=%s' % (cherrypy.request.script_name, seq),  # @IgnorePep8
                 'rest_api_version': mmshop.__version__}
-        now = datetime.datetime.now()
-        for item in data['items']:
-            if 'expire' in item:
-                item_now = datetime.datetime.strptime(item['expire'],
-                                                      EXPIRE_FORMAT)
-                data['expire'][item['id']] = now >= item_now
-            else:
-                data['expire'][item['id']] = True
         for k, v in kwargs.items():
             data[k] = v
         return tmpl.render(**data)
 
+    def _start_waiting(self):
+        '''
+        Take a server thread for a request waiting for changes, the thread
+        is given back when the request ends
+        :return: ´False´ if the share of waiting threads is taken already,
+            see ´CHANGES_WAITING_SHARE´
+        '''
+        limit = int(cherrypy.server.thread_pool * CHANGES_WAITING_SHARE)
+        with self._waiting_lock:
+            if self._waiting >= limit:
+                return False
+            self._waiting += 1
+        # > for streams the request ends after the last chunk is sent
+        cherrypy.request.hooks.attach('on_end_request', self._stop_waiting)
+        return True
+
+    def _stop_waiting(self):
+        with self._waiting_lock:
+            self._waiting -= 1
+
+    def _stream_changes(self, _seq):
+        '''
+        Stream the changes after the sequence number as server-sent events
+        :param _seq: The sequence number seen by the client
+        :return: generator of encoded events
+        '''
+        cherrypy.response.stream = True
+        cherrypy.response.headers['Content-Type'] = 'text/event-stream'
+        changes = self.store.changes
+        encode_item = self.serializer.encode_item
+        engine = cherrypy.engine
+        heartbeat = CHANGES_HEARTBEAT
+
+        def event(seq, op, item, now):
+            # > expiry events are not in the change log and have no ID
+            head = b'event: %s\n' % op.encode()
+            if seq is not None:
+                head = b'id: %d\n' % seq + head
+            expired = b'true' if item.expire_key <= now else b'false'
+            return b''.join((head, b'data: {"item": ', encode_item(item),
+                             b', "expired": ', expired, b'}\n\n'))
+
+        def body():
+            seq = _seq
+            now = mmshop.expire_key()
+            deadline = time.time() + CHANGES_STREAM_TIME
+            yield b'retry: %d\n\n' % CHANGES_RETRY
+            while engine.state == engine.states.STARTED and time.time() < deadline:  # @IgnorePep8
+                try:
+                    res = changes.wait(seq, heartbeat)
+                except mmshop.ChangesExpiredError:
+                    yield b'event: reset\ndata: {}\n\n'
+                    return
+                last, now = now, mmshop.expire_key()
+                chunk = [event(c.seq, c.op, c.item, now) for c in res]
+                if res:
+                    seq = res[-1].seq
+                if now > last:
+                    items, _ = self.store.query(expire_min=last + 1,
+                                                expire_max=now)
+                    chunk.extend(event(None, 'expire', item, now)
+                                 for item in items)
+                yield b''.join(chunk) or b': heartbeat\n\n'
+        return body()
+
     def has_static(self):
         return self.__flag_static
 
     @cherrypy.expose
     @cherrypy.tools.allow(methods=['get'])
+    @cherrypy.config(**{'tools.response_headers.headers': _HEADERS_REVALIDATE,  # @IgnorePep8
+                        'tools.sessions.on': False})
     @with_static
     def index(self):
         return self._view_monitor()
 
     @cherrypy.expose
     @cherrypy.tools.allow(methods=['get'])
+    @cherrypy.config(**{'tools.response_headers.headers': _HEADERS_REVALIDATE,  # @IgnorePep8
+                        'tools.sessions.on': False})
     @with_static
     def monitor(self):
         return self._view_monitor(fontsize='2em')
 
     @cherrypy.expose
     @cherrypy.tools.allow(methods=['get'])
+    @cherrypy.config(**{'tools.response_headers.headers': _HEADERS_IMAGE,
+                        'tools.sessions.on': False})
     def image(self, item_id):
         '''
-        Get image for a given item by ID
+        Get image for a given item by ID. Images are validated with ETag
+        and Last-Modified. Depending on ´API_IMAGE_SERVE_MODE´ images are
+        cached in memory or streamed from the disk, range requests are
+        always streamed.
         :param item_id: The item's ID
         :return: the image data
         '''
@@ -278,26 +1000,57 @@ class MickeyMouseShop(object):
         filename = os.path.join(_PATH_WWW, 'img', '%s.png' % c['name'])
         if _DEBUG:
             logging.debug('filename: %s' % filename)
-        if not os.path.exists(filename):
+        try:
+            st = os.stat(filename)
+        except OSError:
             raise cherrypy.HTTPError(404,
                                      "can not find item's image "
                                      "%s : %s" %
                                      (item_id, filename))
-        with open(filename, 'rb') as f:
-            contents = f.read()
+        # validate
+        cherrypy.response.headers['ETag'] = '"%x-%x"' % (st.st_mtime_ns,
+                                                         st.st_size)
+        cherrypy.response.headers['Last-Modified'] = cherrypy.lib.httputil.HTTPDate(st.st_mtime)  # @IgnorePep8
+        validate_etags()
+        cherrypy.lib.cptools.validate_since()
+        # streamed data
+        if _IMAGE_SERVE_MODE == 'file' or 'Range' in cherrypy.request.headers:  # @IgnorePep8
+            return cherrypy.lib.static.serve_file(filename, 'image/png')
+        # cached data
+        key = (filename, st.st_mtime_ns, st.st_size)
+        contents = self.images.get(key)
+        if contents is None:
+            with open(filename, 'rb') as f:
+                contents = f.read()
+            self.images.put(key, contents)
         return contents
 
     @cherrypy.expose
-    @cherrypy.tools.allow(methods=['get', 'post', 'put'])
-    @cherrypy.config(**{'tools.json_out.on': True})
-    def item(self, item_id=None):
+    @cherrypy.tools.allow(methods=['get', 'post', 'put', 'patch'])
+    @cherrypy.config(**{'tools.json_out.on': True,
+                        'tools.json_out.handler': json_handler,
+                        'tools.response_headers.headers': _HEADERS_READ,
+                        'tools.sessions.on': False})
+    def item(self, item_id=None, field=None, **kwargs):
         '''
         Item operations:
-        - GET  :: an item by ID or all items if no ID specified
-        - POST :: add new item
+        - GET  :: an item by ID or all items if no ID specified,
+                  the items list can be paginated with ´limit´ and ´after´
+                  and streamed with ´stream=json|ndjson´
+        - POST :: add new item or new items at once with ´_bulk´ as ID
         - PUT  :: update an item
+        - PATCH :: update fields of an item
+        - GET, PUT /item/<id>/<field> :: get or update a field of an item
+        Items are returned with the item version as ´ETag´, item lists
+        with the hash of the list. Updates with ´If-Match´ are applied
+        only if the item version matches (´412´ otherwise), a ´GET´ with
+        ´If-None-Match´ gets ´304´ if the item or list did not change.
+        Reads can be stored by caches but must be validated, responses
+        of updates are never stored, see ´CACHE_POLICY´.
+        The request is routed with the route table ´ITEM_ROUTES´.
         :param item_id: The item ID (optionally)
-        :return: Item or item list
+        :param field: The field name (optionally)
+        :return: Item, item list or field value
         '''
         # info
         if _DEBUG:
@@ -306,27 +1059,103 @@ class MickeyMouseShop(object):
             logging.debug('* %s' % cherrypy.request.method)
             logging.debug('* %s <%s>' % (item_id, type(item_id)))
         # process request
-        if cherrypy.request.method == 'GET':
-            res = self._GET_item(item_id, cherrypy.request)
-        elif cherrypy.request.method == 'POST':
-            res = self._POST_item(item_id, cherrypy.request)
-        elif cherrypy.request.method == 'PUT':
-            res = self._PUT_item(item_id, cherrypy.request)
+        if field is not None:
+            path, args = 'field', (item_id, field)
         else:
-            raise cherrypy.HTTPError(405, 'Method %s is not allowed' % cherrypy.request.method)  # @IgnorePep8
+            path = _ITEM_PATHS.get(item_id, 'item')
+            args = () if path == 'bulk' else (item_id,)
+        # > ´HEAD´ is routed like ´GET´, the server drops the body
+        method = cherrypy.request.method
+        try:
+            handler = self._routes['GET' if method == 'HEAD' else method, path]  # @IgnorePep8
+        except KeyError:
+            # > ´Allow´ lists the methods of the path, not of all routes
+            methods = [m for m, p in ITEM_ROUTES if p == path]
+            if 'GET' in methods:
+                methods.append('HEAD')
+            cherrypy.response.headers['Allow'] = ', '.join(methods)
+            raise cherrypy.HTTPError(405, 'Method %s is not allowed' % method)  # @IgnorePep8
+        res = handler(*args, cherrypy.request)
         if _DEBUG:
-            logging.debug('* %s' % res)
+            logging.debug('* %s' % (res,))
             logging.debug('*' * 50)
             logging.debug('')
+        # items are encoded with cache, reads are validated with ETag
+        read = method in ('GET', 'HEAD')
+        if not read:
+            cherrypy.response.headers['Cache-Control'] = CACHE_POLICY['write']  # @IgnorePep8
+        if isinstance(res, mmshop.Item):
+            cherrypy.response.headers['ETag'] = item_etag(res)
+            if read:
+                validate_etags()
+            res = self.serializer.encode_item(res)
+        elif isinstance(res, (list, tuple)):
+            res = self.serializer.encode_items(res)
+            if read:
+                cherrypy.response.headers['ETag'] = '"%s"' % hashlib.md5(res).hexdigest()  # @IgnorePep8
+                validate_etags()
         return res
 
     @cherrypy.expose
     @cherrypy.tools.allow(methods=['get'])
-    @cherrypy.config(**{'tools.json_out.on': True})
+    @cherrypy.config(**{'tools.response_headers.headers': _HEADERS_EVENTS,
+                        'tools.sessions.on': False})
+    def changes(self, since=None):
+        '''
+        Follow the item changes as server-sent events:
+        - create, update :: the new item, the event ID is the sequence
+                            number of the change
+        - expire         :: the item which has just expired
+        - reset          :: the changes are not kept anymore, the client
+                            has to read all items again
+        Events carry the item and its expiry state as
+        ´{"item": {...}, "expired": false}´. The stream resumes after
+        ´Last-Event-ID´ (sent by the browser on reconnect) or ´since´,
+        otherwise it starts with the next change. The stream ends after
+        ´CHANGES_STREAM_TIME´ to release the server thread. If too many
+        streams are open (´CHANGES_WAITING_SHARE´), the response is ´503´
+        and the client retries after ´Retry-After´ seconds.
+        :param since: The sequence number seen by the client (optionally)
+        :return: stream of events
+        :raise cherrypy.HTTPError: ´400´ if the sequence number is invalid,
+        '''
+        since = cherrypy.request.headers.get('Last-Event-ID', since)
+        try:
+            seq = self.store.changes.seq if since is None else int(since)
+        except ValueError:
+            raise cherrypy.HTTPError(400, 'Sequence number must be integer')
+        if not self._start_waiting():
+            # > error responses drop ´Retry-After´, set it after the error
+            cherrypy.HTTPError(503, 'Too many change feeds, retry later').set_response()  # @IgnorePep8
+            cherrypy.response.headers['Retry-After'] = str(CHANGES_RETRY // 1000)  # @IgnorePep8
+            return cherrypy.response.body
+        return self._stream_changes(seq)
+
+    @cherrypy.expose
+    @cherrypy.tools.allow(methods=['get'])
+    @cherrypy.config(**{'tools.json_out.on': True,
+                        'tools.json_out.handler': json_handler,
+                        'tools.response_headers.headers': _HEADERS_STATS,
+                        'tools.sessions.on': False})
     def stats(self):
         '''
-        Get basic statistics like count of items and their value
+        Get basic statistics like count of items and their value,
+        minimum, maximum and mean price and count of expired items
+        :return: The statistics
+        '''
+        return self.store.stats()
+
+    @cherrypy.expose
+    @cherrypy.tools.allow(methods=['get'])
+    @cherrypy.config(**{'tools.json_out.on': True,
+                        'tools.json_out.handler': json_handler,
+                        'tools.response_headers.headers': _HEADERS_STATS,
+                        'tools.sessions.on': False})
+    def server(self):
+        '''
+        Get the statistics of the server thread pool: count of threads,
+        of idle threads, the bounds of the pool and the count of queued
+        connections, see ´mmshop.pool_stats´
         :return: The statistics
         '''
-        return {'items_count': len(_ITEMS),
-                'items_value': sum([i['price'] for i in _ITEMS])}
+        return mmshop.pool_stats()
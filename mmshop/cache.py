@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# mmshop.cache
+'''
+:author:  madkote
+:contact: madkote(at)bluewin.ch
+
+Caches
+------
+The module provides caches for the API responses
+'''
+
+import collections
+import hashlib
+import threading
+
+VERSION = (0, 3, 0)
+
+__all__ = ['LRUCache', 'RenderCache']
+__author__ = 'madkote <madkote(at)bluewin.ch>'
+__version__ = '.'.join(str(x) for x in VERSION)
+
+
+# > ´variants´ - the compressed bodies by content encoding, filled on demand
+RenderEntry = collections.namedtuple('RenderEntry',
+                                     ['version', 'expires', 'body', 'etag',
+                                      'variants'])
+
+
+# =============================================================================
+# RENDERED PAGES
+# =============================================================================
+class RenderCache(object):
+    '''
+    Cache of rendered pages.
+
+    A page is cached per key (view parameters) together with the store
+    version it was rendered from and the expiry key of the item to expire
+    next. The page is stale as soon as the store changes or that item
+    expires. The compressed variants of the page live and die with the
+    entry, so a page is compressed once per change.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def get(self, key, version, now):
+        '''
+        Get the cached page
+        :param key: The page key
+        :param version: The current store version
+        :param now: The current expiry key
+        :return: The page entry or ´None´ if not cached or stale
+        '''
+        entry = self._entries.get(key)
+        if entry is None or entry.version != version:
+            return None
+        if entry.expires is not None and now >= entry.expires:
+            return None
+        return entry
+
+    def put(self, key, version, expires, body):
+        '''
+        Cache the page
+        :param key: The page key
+        :param version: The store version the page was rendered from
+        :param expires: The expiry key the page becomes stale at or ´None´
+        :param body: The page (bytes)
+        :return: The page entry
+        '''
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        entry = RenderEntry(version, expires, body, etag, {})
+        with self._lock:
+            self._entries[key] = entry
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# =============================================================================
+# LRU
+# =============================================================================
+class LRUCache(object):
+    '''
+    Least recently used cache of byte strings bounded by total size
+    '''
+    def __init__(self, max_size):
+        '''
+        :param max_size: The maximal total size (bytes) of cached values
+        '''
+        self.max_size = max_size
+        self.size = 0
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        '''
+        Get the cached value
+        :param key: The key
+        :return: The value or ´None´ if not cached
+        '''
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        '''
+        Cache the value, values larger than the cache are not cached.
+        :param key: The key
+        :param value: The value (bytes)
+        '''
+        if len(value) > self.max_size:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._entries[key] = value
+            self.size += len(value)
+            while self.size > self.max_size:
+                _, old = self._entries.popitem(last=False)
+                self.size -= len(old)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
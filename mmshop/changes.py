@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# mmshop.changes
+'''
+:author:  madkote
+:contact: madkote(at)bluewin.ch
+
+Changes
+-------
+The module provides the change log of the item stores
+'''
+
+import collections
+import itertools
+import threading
+import time
+
+import mmshop
+
+VERSION = (0, 2, 0)
+
+__all__ = ['CHANGES_POLL', 'Change', 'ChangeLog', 'ChangesExpiredError',
+           'SharedChangeLog']
+__author__ = 'madkote <madkote(at)bluewin.ch>'
+__version__ = '.'.join(str(x) for x in VERSION)
+
+
+# > period (seconds) of the waiting readers of a shared change log checking
+#   for the changes of other processes
+CHANGES_POLL = 0.5
+
+Change = collections.namedtuple('Change', ['seq', 'op', 'item'])
+
+
+class ChangesExpiredError(LookupError):
+    '''
+    The changes after the sequence number are not kept anymore
+    '''
+
+
+# =============================================================================
+# CHANGE LOG
+# =============================================================================
+class ChangeLog(object):
+    '''
+    Sequence-numbered log of the recent item changes.
+
+    Every write of a store appends a change with the next sequence number
+    (starting with ´1´). Only the last ´size´ changes are kept, so a
+    reader which has seen the sequence number gets the changes made since
+    then - or ´ChangesExpiredError´ if some of them are gone and the
+    reader has to read all items again. Readers can wait for new changes
+    instead of polling.
+    '''
+    def __init__(self, size=None):
+        '''
+        :param size: The count of kept changes (default: ´API_CHANGES_SIZE´)
+        '''
+        self.size = size or mmshop.API_CHANGES_SIZE
+        self._cond = threading.Condition(threading.Lock())
+        self._changes = collections.deque(maxlen=self.size)
+        self._seq = 0
+
+    @property
+    def seq(self):
+        '''
+        The sequence number of the last change, ´0´ if there is none
+        '''
+        return self._seq
+
+    def append(self, op, item):
+        '''
+        Append the change
+        :param op: The operation ´create´ or ´update´
+        :param item: The new item
+        :return: The sequence number of the change
+        '''
+        return self.extend(op, (item,))
+
+    def extend(self, op, items):
+        '''
+        Append the changes of the same operation at once
+        :param op: The operation ´create´ or ´update´
+        :param items: The new items
+        :return: The sequence number of the last change
+        '''
+        with self._cond:
+            for item in items:
+                self._seq += 1
+                self._changes.append(Change(self._seq, op, item))
+            self._cond.notify_all()
+            return self._seq
+
+    def since(self, seq):
+        '''
+        Get the changes after the sequence number
+        :param seq: The sequence number seen by the reader
+        :return: list of the changes ordered by sequence number
+        :raise ChangesExpiredError: if the changes are not kept anymore
+            or the sequence number is unknown (ahead of the log)
+        '''
+        with self._cond:
+            return self._since(seq)
+
+    def wait(self, seq, timeout=None):
+        '''
+        Get the changes after the sequence number, wait for them if
+        there are none yet
+        :param seq: The sequence number seen by the reader
+        :param timeout: The maximal wait (seconds, default: no limit)
+        :return: list of the changes, empty if the wait timed out
+        :raise ChangesExpiredError: see ´since´
+        '''
+        with self._cond:
+            if seq == self._seq:
+                self._cond.wait(timeout)
+            return self._since(seq)
+
+    def wakeup(self):
+        '''
+        Wake up all waiting readers, e.g. when the server stops
+        '''
+        with self._cond:
+            self._cond.notify_all()
+
+    def _since(self, seq):
+        # > the kept changes have contiguous sequence numbers
+        first = self._seq - len(self._changes)
+        if seq < first or seq > self._seq:
+            raise ChangesExpiredError(seq)
+        return list(itertools.islice(self._changes, seq - first, None))
+
+
+class SharedChangeLog(object):
+    '''
+    Change log kept by a store shared by processes, with the interface of
+    ´ChangeLog´.
+
+    The store records the changes with its writes (e.g. in the same
+    transaction), so the sequence numbers are the same for all processes
+    and readers see the writes of every process. Waiting readers are woken
+    by the writes of this process and check for the writes of the other
+    processes every ´poll´ seconds.
+    '''
+    def __init__(self, read, size=None, poll=CHANGES_POLL):
+        '''
+        :param read: The function of the store reading the log: for a
+            sequence number it returns the first and the last kept
+            sequence number and the changes after the sequence number
+            (none if the sequence number is ´None´). If there are no
+            changes, the first sequence number is the last plus ´1´.
+        :param size: The count of kept changes (default: ´API_CHANGES_SIZE´)
+        :param poll: The period (seconds) of the waiting readers
+        '''
+        self.size = size or mmshop.API_CHANGES_SIZE
+        self.poll = poll
+        self._read = read
+        self._cond = threading.Condition(threading.Lock())
+        self._notified = 0
+        self._woken = 0
+
+    @property
+    def seq(self):
+        '''
+        The sequence number of the last change, ´0´ if there is none
+        '''
+        return self._read(None)[1]
+
+    def notify(self):
+        '''
+        Wake up the waiting readers of this process after a write
+        '''
+        with self._cond:
+            self._notified += 1
+            self._cond.notify_all()
+
+    def since(self, seq):
+        '''
+        Get the changes after the sequence number, see ´ChangeLog.since´
+        :param seq: The sequence number seen by the reader
+        :return: list of the changes ordered by sequence number
+        :raise ChangesExpiredError: if the changes are not kept anymore
+            or the sequence number is unknown (ahead of the log)
+        '''
+        first, last, changes = self._read(seq)
+        if seq < first - 1 or seq > last:
+            raise ChangesExpiredError(seq)
+        return changes
+
+    def wait(self, seq, timeout=None):
+        '''
+        Get the changes after the sequence number, wait for them if
+        there are none yet, see ´ChangeLog.wait´
+        :param seq: The sequence number seen by the reader
+        :param timeout: The maximal wait (seconds, default: no limit)
+        :return: list of the changes, empty if the wait timed out
+        :raise ChangesExpiredError: see ´since´
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            woken = self._woken
+        while True:
+            with self._cond:
+                notified = self._notified
+            res = self.since(seq)
+            delay = self.poll
+            if deadline is not None:
+                delay = min(delay, deadline - time.time())
+            if res or delay <= 0:
+                return res
+            with self._cond:
+                if self._woken != woken:
+                    return res
+                # > a write since the read is not waited for
+                if self._notified == notified:
+                    self._cond.wait(delay)
+
+    def wakeup(self):
+        '''
+        Wake up all waiting readers, e.g. when the server stops
+        '''
+        with self._cond:
+            self._woken += 1
+            self._cond.notify_all()
@@ -14,13 +14,16 @@ import argparse
 import cherrypy
 import logging
 import os
+import signal
+import socket
 import sys
+import time
 
 import mmshop
 
-VERSION = (0, 2, 0)
+VERSION = (0, 4, 0)
 
-__all__ = ['main', 'quick_start']
+__all__ = ['main', 'quick_start', 'serve_workers']
 __author__ = 'madkote <madkote(at)bluewin.ch>'
 __version__ = '.'.join(str(x) for x in VERSION)
 
@@ -30,16 +33,29 @@ PROFILE = 0
 
 DESCRIPTION = 'Mickey Mouse shop web API'
 
+# > workers which exit sooner after the start are restarted with a delay
+#   (seconds), so a failing worker does not restart in a busy loop
+WORKER_MIN_LIFETIME = 5
+WORKER_RESTART_DELAY = 1
+
 
 # =============================================================================
 # API SEVICE STARTER
 # =============================================================================
-def quick_start(flag_auth=None, host=None, port=None, level=None):
+def quick_start(flag_auth=None, host=None, port=None, level=None,
+                store=None, workers=None, config_file=None, profile=None):
     '''
     Start server
     :param host: host name
     :param port: port to be exposed
     :param level: logging level
+    :param store: item store specification, see ´mmshop.open_store´
+    :param workers: count of worker processes, see ´serve_workers´
+        (default: serve in this process)
+    :param config_file: configuration file merged into ´API_CONFIG´,
+        see ´mmshop.load_config´
+    :param profile: performance settings (configuration entries), they
+        override the configuration file, see ´mmshop.PERFORMANCE_OPTIONS´
     '''
     #
     # logging
@@ -48,15 +64,16 @@ def quick_start(flag_auth=None, host=None, port=None, level=None):
     logging.basicConfig(level=level, stream=sys.stdout)
     #
     # settings
-    app = mmshop.MickeyMouseShop
-    script_name = mmshop.API_URL
     config = dict(mmshop.API_CONFIG)
+    if config_file:
+        config.update(mmshop.load_config(config_file))
     flag_static = True
-    reload = mmshop.API_FLAG_DEBUG
     if host:
         config['server.socket_host'] = str(host)
     if port:
         config['server.socket_port'] = int(port)
+    if store:
+        config['mmshop.store'] = str(store)
     if flag_auth is None:
         flag_auth = True
     elif not flag_auth:
@@ -64,6 +81,25 @@ def quick_start(flag_auth=None, host=None, port=None, level=None):
         config.pop('tools.auth_basic.on', None)
         config.pop('tools.auth_basic.realm', None)
         config.pop('tools.auth_basic.checkpassword', None)
+    if profile:
+        config.update(profile)
+    #
+    # run service
+    if workers and workers > 1:
+        serve_workers(workers, config, flag_static)
+    else:
+        _serve(config, flag_static, reload=mmshop.API_FLAG_DEBUG)
+
+
+def _serve(config, flag_static, reload=False):
+    '''
+    Run the service in this process until the engine exits
+    :param config: The configuration
+    :param flag_static: Flag to serve the HTML views
+    :param reload: Flag to restart on code changes
+    '''
+    app = mmshop.MickeyMouseShop
+    script_name = mmshop.API_URL
     #
     # apply configurations
     cherrypy.log.access_log.level = logging.ERROR
@@ -71,13 +107,107 @@ def quick_start(flag_auth=None, host=None, port=None, level=None):
         cherrypy.config.update(config)
     if not reload:
         cherrypy.engine.autoreload.unsubscribe()
+    mmshop.tune_server(config)
     #
     # run service
-    cherrypy.quickstart(root=app(flag_static=flag_static),
+    root = app(flag_static=flag_static, store=config.get('mmshop.store'))
+    # > waiting change feeds end when the server stops
+    cherrypy.engine.subscribe('stop', root.store.changes.wakeup)
+    cherrypy.engine.subscribe('stop', root.store.close)
+    cherrypy.quickstart(root=root,
                         script_name=script_name,
                         config=None)
 
 
+# =============================================================================
+# WORKER PROCESSES
+# =============================================================================
+def serve_workers(count, config, flag_static=True):
+    '''
+    Run the service in worker processes sharing the listening socket.
+
+    The socket is bound by this (supervisor) process and passed to the
+    forked workers as with systemd socket activation (descriptor ´3´ and
+    ´LISTEN_PID´), the kernel spreads the connections over the workers.
+    The supervisor restarts workers which exit. On ´SIGTERM´ or ´SIGINT´
+    it stops the workers, every worker stops gracefully: it finishes
+    the running requests (´server.shutdown_timeout´) and exits.
+    ´SIGHUP´ restarts the workers the same way.
+
+    The items are not copied between the workers, so the store has to be
+    shared by processes, see ´mmshop.SHARED_STORES´. The shared stores
+    keep the change log too, so the change feed of every worker follows
+    the changes of all workers (´mmshop.SharedChangeLog´).
+    :param count: The count of worker processes
+    :param config: The configuration
+    :param flag_static: Flag to serve the HTML views
+    :raise ValueError: if the store can not be shared or the host is
+        not an IPv4 address
+    '''
+    spec = config.get('mmshop.store') or 'memory'
+    if spec.partition(':')[0] not in mmshop.SHARED_STORES:
+        raise ValueError('Item store %s can not be shared by workers, use: %s' %  # @IgnorePep8
+                         (spec, ', '.join(mmshop.SHARED_STORES)))
+    host = config.get('server.socket_host', '127.0.0.1')
+    port = config.get('server.socket_port', 8080)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(config.get('server.socket_queue_size', 5))
+    # > the store is initialized once, not by every worker
+    mmshop.MickeyMouseShop(store=spec).store.close()
+    workers = {}
+    state = {'stop': False}
+
+    def start():
+        pid = os.fork()
+        if pid:
+            workers[pid] = time.time()
+            return
+        code = 0
+        try:
+            os.dup2(sock.fileno(), 3)
+            os.environ['LISTEN_PID'] = str(os.getpid())
+            # > the supervisor stops the workers on ´SIGINT´ (´Ctrl-C´)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGHUP, signal.SIG_DFL)
+            # > the supervisor restarts the worker, do not re-exec it
+            cherrypy.engine.signal_handler.handlers['SIGHUP'] = cherrypy.engine.exit  # @IgnorePep8
+            _serve(config, flag_static)
+        except BaseException:
+            logging.exception('worker %s failed' % os.getpid())
+            code = 1
+        finally:
+            logging.shutdown()
+            os._exit(code)
+
+    def signal_workers(sig, stop):
+        state['stop'] = state['stop'] or stop
+        for pid in list(workers):
+            try:
+                os.kill(pid, signal.SIGTERM if stop else signal.SIGHUP)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGTERM, lambda sig, frame: signal_workers(sig, True))  # @IgnorePep8
+    signal.signal(signal.SIGINT, lambda sig, frame: signal_workers(sig, True))  # @IgnorePep8
+    signal.signal(signal.SIGHUP, lambda sig, frame: signal_workers(sig, False))  # @IgnorePep8
+    logging.info('serving on %s:%s with %s workers' % (host, port, count))
+    for _ in range(count):
+        start()
+    while workers:
+        pid, status = os.wait()
+        started = workers.pop(pid, None)
+        if started is None or state['stop']:
+            continue
+        logging.warning('worker %s exited (%s), restarting' % (pid, status))
+        if time.time() - started < WORKER_MIN_LIFETIME:
+            time.sleep(WORKER_RESTART_DELAY)
+        start()
+    sock.close()
+
+
 # =============================================================================
 # COMMAND LINE INTERFACE
 # =============================================================================
@@ -115,11 +245,48 @@ def main(argv=None):
                             action='store',
                             default=None,
                             help='Port')
+        parser.add_argument('--store',
+                            dest='store',
+                            action='store',
+                            default=None,
+                            help='Item store: memory, wal:<directory>, '
+                                 'sqlite:<file> or shm:<file>')
+        parser.add_argument('--workers',
+                            dest='workers',
+                            action='store',
+                            type=int,
+                            default=None,
+                            help='Count of worker processes, the store has '
+                                 'to be shared (sqlite:<file> or shm:<file>)')
         parser.add_argument('--no-auth',
                             dest='flag_auth',
                             action='store_false',
                             default=True,
                             help='Flag to disable authentication')
+        parser.add_argument('--config',
+                            dest='config_file',
+                            action='store',
+                            default=None,
+                            help='Configuration file, see mmshop.load_config')
+        # > performance profile, the options override the configuration
+        profile_keys = {}
+        for option, key, kind, text in mmshop.PERFORMANCE_OPTIONS:
+            dest = option.lstrip('-').replace('-', '_')
+            profile_keys[dest] = key
+            if isinstance(kind, bool):
+                parser.add_argument(option,
+                                    dest=dest,
+                                    action='store_const',
+                                    const=kind,
+                                    default=None,
+                                    help=text)
+            else:
+                parser.add_argument(option,
+                                    dest=dest,
+                                    action='store',
+                                    type=kind,
+                                    default=None,
+                                    help=text)
         #
         # Process arguments
         args = parser.parse_args()
@@ -127,6 +294,12 @@ def main(argv=None):
         host = args.host
         port = args.port
         flag_auth = args.flag_auth
+        store = args.store
+        workers = args.workers
+        config_file = args.config_file
+        profile = {key: getattr(args, dest)
+                   for dest, key in profile_keys.items()
+                   if getattr(args, dest) is not None}
         #
         # settings
         if verbose == 0:
@@ -137,7 +310,8 @@ def main(argv=None):
             level = logging.DEBUG
         #
         # run API service
-        quick_start(flag_auth, host, port, level)
+        quick_start(flag_auth, host, port, level, store, workers,
+                    config_file, profile)
     except KeyboardInterrupt:
         res = 1
         print(program_name + ': ')
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# mmshop.compression
+'''
+:author:  madkote
+:contact: madkote(at)bluewin.ch
+
+Compression
+-----------
+The module provides the content encodings of the API responses: ´gzip´
+and ´br´ (brotli) if ´brotli´ is installed.
+'''
+
+import gzip
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+VERSION = (0, 1, 0)
+
+__all__ = ['COMPRESSION_ENCODINGS', 'compress', 'negotiate_encoding']
+__author__ = 'madkote <madkote(at)bluewin.ch>'
+__version__ = '.'.join(str(x) for x in VERSION)
+
+
+# > supported encodings in order of preference
+if brotli is not None:
+    COMPRESSION_ENCODINGS = ('br', 'gzip')
+else:
+    COMPRESSION_ENCODINGS = ('gzip',)
+
+
+# =============================================================================
+# ENCODINGS
+# =============================================================================
+def negotiate_encoding(header, encodings=None):
+    '''
+    Choose the encoding accepted by the client. The encoding with the
+    highest quality wins, equal qualities are resolved by the order of
+    the supported encodings.
+    :param header: The ´Accept-Encoding´ header (or ´None´)
+    :param encodings: The supported encodings in order of preference
+        (default: ´COMPRESSION_ENCODINGS´)
+    :return: The encoding or ´None´ for the identity
+    '''
+    if not header:
+        return None
+    accepted = {}
+    for part in header.split(','):
+        name, _, params = part.partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+    res, best = None, 0.0
+    for encoding in (encodings or COMPRESSION_ENCODINGS):
+        quality = accepted.get(encoding, accepted.get('*', 0.0))
+        if quality > best:
+            res, best = encoding, quality
+    return res
+
+
+def compress(data, encoding, level=6, brotli_level=5):
+    '''
+    Compress the data
+    :param data: The data (bytes)
+    :param encoding: The encoding ´gzip´ or ´br´
+    :param level: The gzip compression level (1-9)
+    :param brotli_level: The brotli quality (0-11)
+    :return: The compressed data
+    :raise ValueError: if the encoding is not supported
+    '''
+    if encoding == 'gzip':
+        # > fixed mtime, so the same data is compressed to the same bytes
+        return gzip.compress(data, compresslevel=level, mtime=0)
+    if encoding == 'br' and brotli is not None:
+        return brotli.compress(data, quality=brotli_level)
+    raise ValueError('Encoding not supported: %s' % encoding)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# mmshop.models
+'''
+:author:  madkote
+:contact: madkote(at)bluewin.ch
+
+Models
+------
+The module provides the item record held by the item stores
+'''
+
+import mmshop
+
+VERSION = (0, 1, 0)
+
+__all__ = ['Item']
+__author__ = 'madkote <madkote(at)bluewin.ch>'
+__version__ = '.'.join(str(x) for x in VERSION)
+
+
+# =============================================================================
+# ITEM
+# =============================================================================
+class Item(object):
+    '''
+    Compact item record.
+
+    The record has fixed slots instead of a per-item dictionary, the parsed
+    expiry key is kept next to the expiry. Fields which are not part of the
+    record are kept in ´extra´ (usually ´None´). The record supports the
+    read-only mapping access of the JSON item (´item['name']´) and is
+    converted to a dictionary only for the JSON output.
+
+    Stores never modify a stored record, see ´replace´. The version is
+    assigned by the store (´0´ until stored) and incremented on every
+    update, it is not part of the JSON item.
+    '''
+    __slots__ = ('id', 'name', 'price', 'expire', 'expire_key', 'extra',
+                 'version')
+
+    FIELDS = ('id', 'name', 'price', 'expire')
+
+    def __init__(self, id=None, name=None, price=None, expire=None,
+                 extra=None, version=0):
+        '''
+        :param id: The item ID, ´None´ if not assigned yet
+        :param name: The name
+        :param price: The price
+        :param expire: The expiry in ´mmshop.EXPIRE_FORMAT´ or ´None´
+        :param extra: The other fields or ´None´
+        :param version: The item version
+        :raise ValueError: if the expiry is not valid
+        '''
+        self.id = id
+        self.name = name
+        self.price = price
+        self.expire = expire
+        self.expire_key = mmshop.parse_expire(expire) if expire else 0
+        self.extra = extra or None
+        self.version = version
+
+    @classmethod
+    def coerce(cls, value):
+        '''
+        :param value: The item as record or dictionary
+        :return: The item record
+        :raise ValueError: if the expiry is not valid
+        '''
+        if isinstance(value, cls):
+            return value
+        return cls.from_dict(value)
+
+    @classmethod
+    def from_dict(cls, data, version=0):
+        '''
+        :param data: The item as dictionary
+        :param version: The item version
+        :return: The item
+        :raise ValueError: if the expiry is not valid
+        '''
+        extra = dict((k, v) for k, v in data.items() if k not in cls.FIELDS)
+        return cls(data.get('id'), data.get('name'), data.get('price'),
+                   data.get('expire'), extra, version)
+
+    def to_dict(self):
+        '''
+        :return: The item as dictionary
+        '''
+        res = {'id': self.id, 'name': self.name, 'price': self.price}
+        if self.expire is not None:
+            res['expire'] = self.expire
+        if self.extra:
+            res.update(self.extra)
+        return res
+
+    def replace(self, **fields):
+        '''
+        Get the next version of the item with the fields replaced
+        :param fields: The fields
+        :return: The new item
+        :raise ValueError: if the expiry is not valid
+        '''
+        res = Item.__new__(Item)
+        res.version = self.version + 1
+        res.id = fields.pop('id', self.id)
+        res.name = fields.pop('name', self.name)
+        res.price = fields.pop('price', self.price)
+        if 'expire' in fields:
+            res.expire = fields.pop('expire')
+            res.expire_key = mmshop.parse_expire(res.expire) if res.expire else 0  # @IgnorePep8
+        else:
+            res.expire = self.expire
+            res.expire_key = self.expire_key
+        if fields:
+            res.extra = dict(self.extra or {})
+            res.extra.update(fields)
+        else:
+            res.extra = self.extra
+        return res
+
+    def keys(self):
+        return [k for k in self.FIELDS if getattr(self, k) is not None] + \
+            list(self.extra or ())
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __getitem__(self, key):
+        if key in self.FIELDS:
+            value = getattr(self, key)
+            if value is not None:
+                return value
+        elif self.extra and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __eq__(self, other):
+        if not isinstance(other, Item):
+            return NotImplemented
+        return (self.id == other.id and self.name == other.name and
+                self.price == other.price and self.expire == other.expire and
+                self.extra == other.extra)
+
+    def __ne__(self, other):
+        res = self.__eq__(other)
+        return res if res is NotImplemented else not res
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'Item(%r)' % self.to_dict()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# mmshop.serializer
+'''
+:author:  madkote
+:contact: madkote(at)bluewin.ch
+
+Serializer
+----------
+The module provides JSON serialization of the API responses. The fastest
+installed encoder is used: ´orjson´, ´ujson´ or the standard ´json´.
+'''
+
+import json
+
+import mmshop
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+VERSION = (0, 4, 0)
+
+__all__ = ['JSON_ENCODER', 'ItemSerializer', 'encode_json']
+__author__ = 'madkote <madkote(at)bluewin.ch>'
+__version__ = '.'.join(str(x) for x in VERSION)
+
+
+# =============================================================================
+# ENCODER
+# =============================================================================
+if orjson is not None:
+    JSON_ENCODER = 'orjson'
+
+    def encode_json(value):
+        '''
+        Encode the value to JSON
+        :param value: The value
+        :return: The JSON (bytes)
+        '''
+        return orjson.dumps(value)
+elif ujson is not None:
+    JSON_ENCODER = 'ujson'
+
+    def encode_json(value):
+        '''
+        Encode the value to JSON
+        :param value: The value
+        :return: The JSON (bytes)
+        '''
+        return ujson.dumps(value).encode('utf-8')
+else:
+    JSON_ENCODER = 'json'
+    _encode = json.JSONEncoder().encode
+
+    def encode_json(value):
+        '''
+        Encode the value to JSON
+        :param value: The value
+        :return: The JSON (bytes)
+        '''
+        return _encode(value).encode('utf-8')
+
+
+# =============================================================================
+# ITEMS
+# =============================================================================
+class ItemSerializer(object):
+    '''
+    JSON serializer of items with a cache of encoded items.
+
+    An item is encoded once and the encoded bytes are reused as long as
+    the item does not change. The encoded items are kept in a LRU cache
+    bounded by size and keyed by the item ID and version, so an updated
+    item is encoded again and the stale entries are dropped with time.
+    Only stored items (with a version) are cached. A list of items is a
+    join of the cached fragments.
+    '''
+    def __init__(self, encoder=None, cache_size=None):
+        '''
+        :param encoder: The JSON encoder (default: ´encode_json´)
+        :param cache_size: The maximal size (bytes) of the cached items,
+            ´0´ disables the cache (default: ´API_ITEM_CACHE_SIZE´)
+        '''
+        self.encode = encoder or encode_json
+        if cache_size is None:
+            cache_size = mmshop.API_ITEM_CACHE_SIZE
+        self._cache = mmshop.LRUCache(cache_size) if cache_size else None
+
+    def __len__(self):
+        return len(self._cache) if self._cache is not None else 0
+
+    def encode_item(self, item):
+        '''
+        Encode the item
+        :param item: The item (record or dictionary)
+        :return: The JSON (bytes)
+        '''
+        key = None
+        if self._cache is not None and getattr(item, 'version', 0):
+            key = (item.id, item.version)
+            data = self._cache.get(key)
+            if data is not None:
+                return data
+        to_dict = getattr(item, 'to_dict', None)
+        data = self.encode(to_dict() if to_dict else item)
+        if key is not None:
+            self._cache.put(key, data)
+        return data
+
+    def encode_items(self, items):
+        '''
+        Encode the list of items
+        :param items: The items
+        :return: The JSON array (bytes)
+        '''
+        return b'[' + b', '.join([self.encode_item(i) for i in items]) + b']'  # @IgnorePep8
+
+    def encode_changes(self, changes, seq):
+        '''
+        Encode the item changes
+        :param changes: The changes, see ´mmshop.Change´
+        :param seq: The sequence number of the last change
+        :return: The JSON object ´{"seq": ..., "changes": [...]}´ (bytes)
+        '''
+        res = [b'{"seq": %d, "changes": [' % seq]
+        for n, change in enumerate(changes):
+            if n:
+                res.append(b', ')
+            res.append(b'{"seq": %d, "op": "%s", "item": %s}' % (
+                change.seq, change.op.encode(), self.encode_item(change.item)))  # @IgnorePep8
+        res.append(b']}')
+        return b''.join(res)
+
+    def clear(self):
+        if self._cache is not None:
+            self._cache.clear()
@@ -13,10 +13,13 @@ The module provides basic settings for API
 import os
 import uuid
 
-VERSION = (0, 2, 0)
+VERSION = (0, 5, 0)
 
 __all__ = ['API_CONFIG', 'API_NAME', 'API_VERSION', 'API_URL',
-           'API_FLAG_DEBUG', 'API_PATH_WWW']
+           'API_FLAG_DEBUG', 'API_PATH_WWW', 'API_IMAGE_CACHE_SIZE',
+           'API_IMAGE_CACHE_CONTROL', 'API_IMAGE_SERVE_MODE',
+           'API_STATIC_CACHE_CONTROL', 'API_CHANGES_SIZE',
+           'API_ITEM_CACHE_SIZE']
 __author__ = 'madkote <madkote(at)bluewin.ch>'
 __version__ = '.'.join(str(x) for x in VERSION)
 
@@ -27,10 +30,33 @@ API_VERSION = '1.0'
 API_URL = '/api/v%s/%s' % (API_VERSION, API_NAME)
 API_FLAG_DEBUG = True
 API_PATH_WWW = os.path.join(os.path.join(os.path.dirname(__file__), '..'), 'www_static')  # @IgnorePep8
+# > Maximal size (bytes) of item images kept in memory
+API_IMAGE_CACHE_SIZE = 16 * 1024 * 1024
+# > Maximal size (bytes) of encoded items kept in memory, used for the
+#   in-memory stores only (the other stores would be copied into memory)
+API_ITEM_CACHE_SIZE = 8 * 1024 * 1024
+# > Serving mode of item images:
+#   * ´cache´ - images are kept in memory (range requests are streamed)
+#   * ´file´  - images are streamed from the disk in chunks, use for large
+#               images to avoid reading the whole file into memory
+API_IMAGE_SERVE_MODE = 'cache'
+# > Cache-Control of item images, images are validated by ETag and
+#   Last-Modified after expiration
+API_IMAGE_CACHE_CONTROL = 'public, max-age=3600'
+# > Cache-Control of static assets (´API_PATH_WWW´), assets are validated
+#   by Last-Modified after expiration
+API_STATIC_CACHE_CONTROL = 'public, max-age=86400'
+# > Count of the recent item changes kept for the change feed, clients
+#   which are further behind have to read all items again
+API_CHANGES_SIZE = 10000
 API_CONFIG = {
     'server.socket_host': '127.0.0.1',
     'server.socket_port': 5000,
     'request.show_tracebacks': False,
+    # > The item store, see ´mmshop.open_store´:
+    #   * ´memory´            - items are lost on restart
+    #   * ´wal:<directory>´   - items are persisted with write-ahead log
+    'mmshop.store': 'memory',
     # > Set this to True to have both errors and
     #   access messages printed to stdout
     'log.screen': False,
@@ -40,15 +66,40 @@ API_CONFIG = {
     # > Set this to an absolute filename where you want messages written.
     # 'log.error_file': os.path.join('<some path>', "web.error.log"),
     #
-    # NO CACHE START
+    # CACHING
+    # > Default caching policy of static assets, the API routes set their
+    #   own policy (see ´mmshop.api.CACHE_POLICY´)
     'tools.response_headers.on': True,
     'tools.response_headers.headers': [
-        ('Expires', 'Sun, 19 Nov 1985 05:00:00 GMT'),
-        ('Cache-Control', 'no-store, no-cache, must-revalidate, post-check=0, pre-check=0'),  # @IgnorePep8
-        ('Pragma', 'no-cache'),
+        ('Cache-Control', API_STATIC_CACHE_CONTROL),
         # ('Access-Control-Allow-Origin', '*'),
     ],
-    # NO CACHE END
+    # > Error responses are not stored, static assets do not set the
+    #   session cookie (see ´mmshop.api.cache_policy´)
+    'tools.cache_policy.on': True,
+    #
+    # COMPRESSION
+    # > Responses of at least ´min_size´ bytes are compressed with gzip
+    #   (´level´ 1-9) or brotli (´brotli_level´ 0-11) if installed
+    'tools.compress.on': True,
+    'tools.compress.min_size': 1024,
+    'tools.compress.level': 6,
+    'tools.compress.brotli_level': 5,
+    #
+    # PERFORMANCE
+    # > HTTP server profile, see ´mmshop.PERFORMANCE_OPTIONS´ for the
+    #   command line options and ´mmshop.load_config´ for the config file
+    'server.thread_pool': 10,
+    'server.thread_pool_max': -1,
+    'server.socket_queue_size': 5,
+    'server.socket_timeout': 10,
+    'server.max_request_body_size': 100 * 1024 * 1024,
+    'server.nodelay': True,
+    # > Maximal count of idle keep-alive connections, 0 disables keep-alive
+    'mmshop.keep_alive': 10,
+    # > Grow and shrink the thread pool between ´server.thread_pool´ and
+    #   ´server.thread_pool_max´ with the queued connections
+    'mmshop.adaptive_threads': False,
     #
     "tools.staticdir.on": True,
     "tools.staticdir.dir": API_PATH_WWW,
@@ -0,0 +1,910 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# mmshop.shared
+'''
+:author:  madkote
+:contact: madkote(at)bluewin.ch
+
+Shared memory store
+-------------------
+The module provides the item store shared by processes in memory mapped
+files (POSIX only)
+'''
+
+import contextlib
+import json
+import math
+import mmap
+import os
+import struct
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import mmshop
+
+VERSION = (0, 3, 0)
+
+__all__ = ['SHM_CAPACITY', 'SHM_HEAP_COMPACT_MIN', 'SharedItemStore']
+__author__ = 'madkote <madkote(at)bluewin.ch>'
+__version__ = '.'.join(str(x) for x in VERSION)
+
+# > initial count of records, the files grow when they are full
+SHM_CAPACITY = 65536
+# > initial heap size (bytes) per record
+SHM_HEAP_PER_ITEM = 128
+# > reads retried while writes are in progress before taking the lock
+SHM_READ_RETRIES = 100
+# > the heap is checked for compaction when it grew by its size at the
+#   last check, but at least by this size (bytes)
+SHM_HEAP_COMPACT_MIN = 1024 * 1024
+# > the indexes are rebuilt instead of extended entry by entry when the
+#   added records are more than this fraction of all records
+SHM_INDEX_REBUILD_RATIO = 1 / 64
+
+_MAGIC = b'MMSHOP01'
+# > header: magic, sequence number (seqlock), count of records, next ID,
+#   store version, used heap size, sequence number of the last change and
+#   used heap size at the last compaction check
+_HEADER = struct.Struct('<8sQQqQQQQ')
+_HEADER_SIZE = 64
+_SEQ, _COUNT, _NEXT_ID, _VERSION, _HEAP_USED, _CHANGES, _HEAP_CHECKED = 8, 16, 24, 32, 40, 48, 56  # @IgnorePep8
+_U64 = struct.Struct('<Q')
+_I64 = struct.Struct('<q')
+# > record: ID, price, expiry key, version, name offset and length,
+#   JSON item offset and length in the heap
+_RECORD = struct.Struct('<qdqIQIQI')
+# > change: sequence number, operation, item version, JSON item offset and
+#   length in the heap
+_CHANGE = struct.Struct('<QBIQI')
+_CHANGE_OPS = ('create', 'update')
+# > indexes: header (capacity, count of indexed records, total price and
+#   its compensation), then an array of ´capacity´ record positions per
+#   index ordered by ID, price, expiry key and name (ties by ID)
+_INDEX_HEADER_SIZE = 32
+_CAPACITY, _INDEXED, _TOTAL, _COMPENSATION = 0, 8, 16, 24
+_F64 = struct.Struct('<d')
+_POSITION = struct.Struct('<I')
+_BY_ID, _BY_PRICE, _BY_EXPIRE, _BY_NAME = range(4)
+_BY_SORT = {'id': _BY_ID, 'price': _BY_PRICE, 'expire': _BY_EXPIRE,
+            'name': _BY_NAME}
+# > count of index entries read at once by the queries
+_READ_CHUNK = 256
+_INF = float('inf')
+
+
+# =============================================================================
+# SHARED MEMORY STORE
+# =============================================================================
+class SharedItemStore(object):
+    '''
+    Item store in memory mapped files shared by processes, with the
+    interface of ´mmshop.ItemStore´.
+
+    Items are fixed-width records (ID, price, expiry key, version and the
+    offsets of the name and of the JSON item) in the record file, names
+    and JSON items are appended to the heap file (´<path>.heap´). Every
+    process maps the files, so the catalog is held once for all worker
+    processes and reads need no round-trip to another process. Use a
+    path on ´/dev/shm´ to keep the files in memory only.
+
+    Writers are serialized by a lock of the record file (and a thread
+    lock within the process) and publish with a seqlock: the sequence
+    number in the header is odd while a write is in progress, readers
+    copy what they need and retry if the sequence number changed in the
+    meantime. Records are never removed, an update rewrites the record
+    in place and appends the new JSON item (and the name if changed).
+    When more than half of the heap is left by the old versions, the
+    update rewrites the heap with the live names and JSON items only.
+
+    The index file (´<path>.index´) holds the record positions sorted
+    by ID, price, expiry key and name, and the total price. Writers keep
+    the indexes with the records (a batch of more than
+    ´SHM_INDEX_REBUILD_RATIO´ of the records rebuilds them), so lookups,
+    pages, queries and aggregates are binary searches and ordered reads
+    shared by all processes instead of scans of the records.
+
+    Writers publish the changes to a ring of fixed-width entries in the
+    change file (´<path>.changes´) with the records, so the change log
+    ´changes´ (´mmshop.SharedChangeLog´) follows the writes of all
+    processes. The size of the ring is set when the store is created.
+    '''
+    def __init__(self, path, items=None, capacity=SHM_CAPACITY,
+                 changes_size=None):
+        '''
+        :param path: The record file, the heap file is ´<path>.heap´,
+            the index file ´<path>.index´
+        :param items: initial items, used only if the store is empty
+        :param capacity: The initial count of records of a new store
+        :param changes_size: The count of kept changes of a new store
+            (default: ´API_CHANGES_SIZE´)
+        :raise ValueError: if the file is not a store
+        :raise RuntimeError: if the platform does not support file locks
+        '''
+        if fcntl is None:
+            raise RuntimeError('Shared memory store needs POSIX file locks')
+        self.path = path
+        self.changes = mmshop.SharedChangeLog(self._read_changes, changes_size)  # @IgnorePep8
+        self._lock = threading.Lock()
+        self._map_lock = threading.RLock()
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self._heap_fd = os.open(path + '.heap', os.O_RDWR | os.O_CREAT, 0o644)  # @IgnorePep8
+        self._ring_fd = os.open(path + '.changes', os.O_RDWR | os.O_CREAT, 0o644)  # @IgnorePep8
+        self._index_fd = os.open(path + '.index', os.O_RDWR | os.O_CREAT, 0o644)  # @IgnorePep8
+        self._map = self._heap = self._ring = self._index = None
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(self._fd).st_size == 0:
+                    os.ftruncate(self._fd, _HEADER_SIZE + capacity * _RECORD.size)  # @IgnorePep8
+                    os.ftruncate(self._heap_fd, capacity * SHM_HEAP_PER_ITEM)
+                    os.pwrite(self._fd, _HEADER.pack(_MAGIC, 0, 0, 0, 0, 0, 0, 0), 0)  # @IgnorePep8
+                elif os.pread(self._fd, len(_MAGIC), 0) != _MAGIC:
+                    raise ValueError('Not an item store: %s' % path)
+                if os.fstat(self._ring_fd).st_size == 0:
+                    os.ftruncate(self._ring_fd, self.changes.size * _CHANGE.size)  # @IgnorePep8
+                if os.fstat(self._index_fd).st_size == 0:
+                    os.ftruncate(self._index_fd, _INDEX_HEADER_SIZE)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+        self._map = mmap.mmap(self._fd, 0)
+        self._heap = mmap.mmap(self._heap_fd, 0)
+        self._ring = mmap.mmap(self._ring_fd, 0)
+        self._index = mmap.mmap(self._index_fd, 0)
+        self._ring_size = len(self._ring) // _CHANGE.size
+        with self._writing():
+            if self._get_index(_INDEXED) != self._get(_COUNT):
+                # > the store was written without the indexes
+                with self._publishing():
+                    self._build_index()
+            if items and not self._get(_COUNT):
+                self._add_many(items)
+
+    def __len__(self):
+        return self._get(_COUNT)
+
+    def __contains__(self, item_id):
+        return self._read(lambda: self._position(item_id)) is not None
+
+    def close(self):
+        '''
+        Unmap and close the files
+        '''
+        for m in (self._map, self._heap, self._ring, self._index):
+            if m is not None:
+                m.close()
+        self._map = self._heap = self._ring = self._index = None
+        for fd in (self._fd, self._heap_fd, self._ring_fd, self._index_fd):
+            os.close(fd)
+
+    @property
+    def version(self):
+        '''
+        The store version, incremented on every write
+        '''
+        return self._get(_VERSION)
+
+    def next_id(self):
+        '''
+        Allocate the next free item ID
+        :return: the item ID
+        '''
+        return self.next_ids(1)
+
+    def next_ids(self, count):
+        '''
+        Allocate a block of free item IDs
+        :param count: The count of IDs
+        :return: the first item ID of the block
+        '''
+        with self._writing():
+            item_id = self._get(_NEXT_ID, _I64)
+            self._put(_NEXT_ID, item_id + count, _I64)
+        return item_id
+
+    def get(self, item_id):
+        '''
+        Get item by ID
+        :param item_id: The item ID
+        :return: The item
+        :raise ItemNotFoundError: if there is no item with the given ID
+        '''
+        def read():
+            position = self._position(item_id)
+            if position is None:
+                return None
+            return self._item(self._record(position))
+        item = self._read(read)
+        if item is None:
+            raise mmshop.ItemNotFoundError(item_id)
+        return item
+
+    def items(self):
+        '''
+        Get all items
+        :return: tuple of items ordered by ID
+        '''
+        return self.page()[0]
+
+    def page(self, after=None, limit=None):
+        '''
+        Get a page of items ordered by ID
+        :param after: The cursor - only items with greater ID are returned
+        :param limit: The maximal count of items (default: all)
+        :return: tuple of the items and the cursor for the next page,
+            the cursor is ´None´ if there are no more items
+        '''
+        return self.query(after=after, limit=limit)
+
+    def add(self, item):
+        '''
+        Add new item. If the item has no ID, the next free ID is assigned.
+        :param item: The item (record or dictionary)
+        :return: The stored item
+        :raise ItemExistsError: if an item with same ID exists already
+        :raise ValueError: if the item expiry or ID is not valid
+        '''
+        item = mmshop.Item.coerce(item)
+        with self._writing():
+            if item.id is None:
+                item.id = self._get(_NEXT_ID, _I64)
+            mmshop.check_item_id(item.id)
+            if self._position(item.id) is not None:
+                raise mmshop.ItemExistsError(item.id)
+            self._insert([item])
+        self.changes.notify()
+        return item
+
+    def add_many(self, items):
+        '''
+        Add new items at once with a single write, see
+        ´mmshop.ItemStore.add_many´
+        :param items: The items (records or dictionaries)
+        :return: list of errors for the items
+        '''
+        with self._writing():
+            errors = self._add_many(items)
+        self.changes.notify()
+        return errors
+
+    def update(self, item_id, data, version=None):
+        '''
+        Update the item by ID, see ´mmshop.ItemStore.update´
+        :param item_id: The item ID
+        :param data: The fields to be updated
+        :param version: The expected item version (default: any)
+        :return: The updated item
+        :raise ItemNotFoundError: if there is no item with the given ID
+        :raise ItemVersionError: if the item version is not the expected one
+        :raise ValueError: if the item expiry is not valid
+        '''
+        with self._writing():
+            position = self._position(item_id)
+            if position is None:
+                raise mmshop.ItemNotFoundError(item_id)
+            current = self._record(position)
+            old = self._item(current)
+            if version is not None and old.version != version:
+                raise mmshop.ItemVersionError(item_id, old.version)
+            item = old.replace(**data)
+            name = current[4:6] if item.name == old.name else None
+            record = self._append_heap([item], name)[0]
+            new = _RECORD.unpack(record)
+            # > the moved index entries, name keys are ´item.name or ''´
+            indexes = [k for k in (_BY_PRICE, _BY_EXPIRE)
+                       if new[k] != current[k]]
+            if self._name(current) != (item.name or ''):
+                indexes.append(_BY_NAME)
+            with self._publishing():
+                count = self._get(_COUNT)
+                for k in indexes:
+                    self._remove_index(k, position, count)
+                self._map[self._offset(position):self._offset(position + 1)] = record  # @IgnorePep8
+                for k in indexes:
+                    self._insert_index(k, position, count - 1)
+                self._add_total(-current[1])
+                self._add_total(new[1])
+                self._log('update', [record])
+                self._compact()
+        self.changes.notify()
+        return item
+
+    def stats(self, now=None):
+        '''
+        Get the aggregates of the items from the ends and the percentile
+        ranks of the price index, the total price and the position of the
+        expiry key in the expiry index
+        :param now: The time to count the expired items (default: now)
+        :return: The aggregates, see ´mmshop.ItemStore.stats´
+        '''
+        key = mmshop.expire_key(now)
+
+        def read():
+            count = self._get_index(_INDEXED)
+            value = self._get_index(_TOTAL, _F64) + self._get_index(_COMPENSATION, _F64)  # @IgnorePep8
+            res = {'items_count': count,
+                   'items_value': value if count else 0.0,
+                   'items_price_min': None,
+                   'items_price_max': None,
+                   'items_price_mean': value / count if count else None,
+                   'items_expired': self._bisect(_BY_EXPIRE, (key, _INF))}
+            if count:
+                res['items_price_min'] = self._price_at(0)
+                res['items_price_max'] = self._price_at(count - 1)
+            for q in mmshop.PRICE_PERCENTILES:
+                res['items_price_p%s' % q] = None
+                if count:
+                    index, fraction = mmshop.percentile_rank(count, q)
+                    price = self._price_at(index)
+                    if fraction:
+                        price += (self._price_at(index + 1) - price) * fraction  # @IgnorePep8
+                    res['items_price_p%s' % q] = price
+            return res
+        return self._read(read)
+
+    def expired(self, now=None, flag=True):
+        '''
+        Get expired items
+        :param now: The time (default: now)
+        :param flag: Get the expired (default) or not expired items
+        :return: list of items ordered by expiry
+        '''
+        key = mmshop.expire_key(now)
+
+        def read():
+            split = self._bisect(_BY_EXPIRE, (key, _INF))
+            if flag:
+                positions = self._entries(_BY_EXPIRE, 0, split)
+            else:
+                positions = self._entries(_BY_EXPIRE, split,
+                                          self._get_index(_INDEXED))
+            return [self._item(self._record(p)) for p in positions]
+        return self._read(read)
+
+    def select(self, price_min=None, price_max=None, expired=None,
+               after=None, limit=None, now=None):
+        '''
+        Get a page of the items in the price range ordered by ID, see
+        ´mmshop.ItemStore.select´
+        :return: tuple of the items and the cursor for the next page
+        '''
+        return self.query(price_min=price_min, price_max=price_max,
+                          expired=expired, after=after, limit=limit, now=now)
+
+    def query(self, name=None, name_prefix=None, price_min=None,
+              price_max=None, expire_min=None, expire_max=None, expired=None,
+              sort='id', order='asc', after=None, limit=None, now=None):
+        '''
+        Query the items through the indexes, see ´mmshop.ItemStore.query´.
+        The conditions are bisected in their indexes, the records of the
+        smallest range are filtered and sorted. If that range is the sort
+        index, or it holds more than ´1 / QUERY_SCAN_RATIO´ of the records
+        while the result is limited, the sort index is read in order from
+        the cursor up to the limit instead. The JSON items are read for the
+        result only.
+        :return: tuple of the items and the cursor for the next page
+        :raise ValueError: if the sort key or order is not valid
+        :raise ItemNotFoundError: if there is no item with the cursor ID
+        '''
+        if sort not in mmshop.QUERY_SORT_KEYS:
+            raise ValueError('sort key %r not in %r' %
+                             (sort, mmshop.QUERY_SORT_KEYS))
+        if order not in ('asc', 'desc'):
+            raise ValueError('sort order %r not in asc, desc' % order)
+        if expired is not None:
+            key = mmshop.expire_key(now)
+            if expired:
+                expire_max = key if expire_max is None else min(expire_max, key)  # @IgnorePep8
+            else:
+                expire_min = key + 1 if expire_min is None else max(expire_min, key + 1)  # @IgnorePep8
+        if name is not None:
+            name_low = name_high = name
+        elif name_prefix is not None:
+            name_low, name_high = name_prefix, name_prefix + mmshop.NAME_PREFIX_END  # @IgnorePep8
+        else:
+            name_low = name_high = None
+        bounds = {}
+        if name_low is not None:
+            bounds[_BY_NAME] = (name_low, name_high)
+        if price_min is not None or price_max is not None:
+            bounds[_BY_PRICE] = (price_min, price_max)
+        if expire_min is not None or expire_max is not None:
+            bounds[_BY_EXPIRE] = (expire_min, expire_max)
+        desc = order == 'desc'
+        size = None if limit is None else limit + 1
+        index = _BY_SORT[sort]
+
+        def match(r):
+            for k, (low, high) in bounds.items():
+                value = self._name(r) if k == _BY_NAME else r[k]
+                if (low is not None and value < low or
+                        high is not None and value > high):
+                    return False
+            return True
+
+        def read():
+            count = self._get_index(_INDEXED)
+            ranges = dict((k, self._range(k, low, high))
+                          for k, (low, high) in bounds.items())
+            cursor = None
+            if after is not None:
+                if sort == 'id':
+                    cursor = (after, after)
+                else:
+                    position = self._position(after)
+                    if position is None:
+                        return None
+                    cursor = self._key(index, self._record(position))
+            start, stop = ranges.get(index, (0, count))
+            if cursor is not None:
+                if desc:
+                    stop = min(stop, self._bisect(index, cursor))
+                else:
+                    start = max(start, self._bisect(index, cursor, True))
+            k, (low, high) = min(ranges.items(), default=(index, (0, 0)),
+                                 key=lambda r: r[1][1] - r[1][0])
+            if (k == index or size is not None and
+                    (high - low) * mmshop.QUERY_SCAN_RATIO > count):
+                records = []
+                while start < stop and (size is None or len(records) < size):  # @IgnorePep8
+                    if desc:
+                        low = max(start, stop - _READ_CHUNK)
+                        positions = reversed(self._entries(index, low, stop))
+                        stop = low
+                    else:
+                        high = min(stop, start + _READ_CHUNK)
+                        positions = self._entries(index, start, high)
+                        start = high
+                    for p in positions:
+                        r = self._record(p)
+                        if match(r):
+                            records.append(r)
+                            if size is not None and len(records) == size:
+                                break
+            else:
+                records = [r for r in map(self._record,
+                                          self._entries(k, low, high))
+                           if match(r)]
+
+                def key(r):
+                    return self._key(index, r)
+                records.sort(key=key, reverse=desc)
+                if cursor is not None:
+                    records = [r for r in records
+                               if (key(r) < cursor if desc else key(r) > cursor)]  # @IgnorePep8
+            return tuple(self._item(r) for r in records[:size])
+        res = self._read(read)
+        if res is None:
+            raise mmshop.ItemNotFoundError(after)
+        next_after = None
+        if limit is not None and len(res) > limit:
+            res = res[:limit]
+            next_after = res[-1].id
+        return res, next_after
+
+    def next_expire(self, now=None):
+        '''
+        Get the expiry key of the item to expire next
+        :param now: The time (default: now)
+        :return: The expiry key or ´None´ if no item is going to expire
+        '''
+        key = mmshop.expire_key(now)
+
+        def read():
+            split = self._bisect(_BY_EXPIRE, (key, _INF))
+            if split < self._get_index(_INDEXED):
+                return self._record(self._entry(_BY_EXPIRE, split))[2]
+            return None
+        return self._read(read)
+
+    # -------------------------------------------------------------------------
+    # records
+    # -------------------------------------------------------------------------
+    def _get(self, offset, field=_U64):
+        return field.unpack_from(self._map, offset)[0]
+
+    def _put(self, offset, value, field=_U64):
+        field.pack_into(self._map, offset, value)
+
+    @staticmethod
+    def _offset(position):
+        return _HEADER_SIZE + position * _RECORD.size
+
+    def _record(self, position):
+        offset = self._offset(position)
+        if offset + _RECORD.size > len(self._map):
+            self._remap()
+        return _RECORD.unpack_from(self._map, offset)
+
+    def _records(self):
+        end = self._offset(self._get(_COUNT))
+        if end > len(self._map):
+            self._remap()
+        return list(_RECORD.iter_unpack(self._map[_HEADER_SIZE:end]))
+
+    def _bytes(self, offset, length):
+        heap = self._heap
+        if offset + length > len(heap):
+            self._remap()
+            heap = self._heap
+        return heap[offset:offset + length]
+
+    def _name(self, record):
+        return self._bytes(record[4], record[5]).decode('utf-8')
+
+    def _item(self, record):
+        data = json.loads(self._bytes(record[6], record[7]))
+        return mmshop.Item.from_dict(data, record[3])
+
+    def _position(self, item_id):
+        j = self._bisect(_BY_ID, (item_id, item_id))
+        if j < self._get_index(_INDEXED):
+            position = self._entry(_BY_ID, j)
+            if self._record(position)[0] == item_id:
+                return position
+        return None
+
+    # -------------------------------------------------------------------------
+    # indexes
+    # -------------------------------------------------------------------------
+    def _get_index(self, offset, field=_U64):
+        return field.unpack_from(self._index, offset)[0]
+
+    def _put_index(self, offset, value, field=_U64):
+        field.pack_into(self._index, offset, value)
+
+    def _entry_offset(self, index, j):
+        capacity = self._get_index(_CAPACITY)
+        return _INDEX_HEADER_SIZE + (index * capacity + j) * _POSITION.size
+
+    def _entry(self, index, j):
+        offset = self._entry_offset(index, j)
+        if offset + _POSITION.size > len(self._index):
+            self._remap()
+        return _POSITION.unpack_from(self._index, offset)[0]
+
+    def _entries(self, index, start, stop):
+        '''
+        Get the record positions of a range of an index
+        :param index: The index
+        :param start: The first entry
+        :param stop: The entry after the last one
+        :return: tuple of the record positions
+        '''
+        if stop <= start:
+            return ()
+        offset = self._entry_offset(index, start)
+        if offset + (stop - start) * _POSITION.size > len(self._index):
+            self._remap()
+        return struct.unpack_from('<%dI' % (stop - start), self._index, offset)  # @IgnorePep8
+
+    def _key(self, index, record):
+        return (self._name(record) if index == _BY_NAME else record[index],
+                record[0])
+
+    def _price_at(self, j):
+        return self._record(self._entry(_BY_PRICE, j))[1]
+
+    def _bisect(self, index, key, right=False, count=None):
+        '''
+        Find the entry of the key in an index
+        :param index: The index
+        :param key: The key (value, ID)
+        :param right: Find the entry after the equal keys
+        :param count: The count of entries (default: the indexed records)
+        :return: the entry, see ´bisect.bisect_left´
+        '''
+        low = 0
+        high = self._get_index(_INDEXED) if count is None else count
+        while low < high:
+            mid = (low + high) // 2
+            value = self._key(index, self._record(self._entry(index, mid)))
+            if value < key or right and value == key:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def _range(self, index, low, high):
+        '''
+        Find the entries of the values in an index
+        :param index: The index
+        :param low: The minimal value (´None´: unbounded)
+        :param high: The maximal value (´None´: unbounded)
+        :return: tuple of the first entry and the entry after the last one
+        '''
+        start = 0 if low is None else self._bisect(index, (low, -_INF))
+        if high is None:
+            stop = self._get_index(_INDEXED)
+        else:
+            stop = self._bisect(index, (high, _INF))
+        return start, max(start, stop)
+
+    def _insert_index(self, index, position, count):
+        # > called by writers publishing, the index holds ´count´ entries
+        j = self._bisect(index, self._key(index, self._record(position)),
+                         count=count)
+        offset = self._entry_offset(index, j)
+        self._index.move(offset + _POSITION.size, offset,
+                         (count - j) * _POSITION.size)
+        _POSITION.pack_into(self._index, offset, position)
+
+    def _remove_index(self, index, position, count):
+        # > called by writers publishing, the index holds ´count´ entries
+        j = self._bisect(index, self._key(index, self._record(position)),
+                         count=count)
+        offset = self._entry_offset(index, j)
+        self._index.move(offset, offset + _POSITION.size,
+                         (count - j - 1) * _POSITION.size)
+
+    def _add_total(self, value):
+        # > Neumaier summation, see ´mmshop.ItemStats´
+        total = self._get_index(_TOTAL, _F64)
+        res = total + value
+        if abs(total) >= abs(value):
+            compensation = (total - res) + value
+        else:
+            compensation = (value - res) + total
+        self._put_index(_TOTAL, res, _F64)
+        self._put_index(_COMPENSATION, self._get_index(_COMPENSATION, _F64) + compensation, _F64)  # @IgnorePep8
+
+    def _grow_index(self, count):
+        '''
+        Extend the index file to hold at least ´count´ entries per index,
+        called by writers publishing. The entries move to the new offsets.
+        :param count: The count of entries
+        '''
+        capacity = self._get_index(_CAPACITY)
+        if count <= capacity:
+            return
+        indexed = self._get_index(_INDEXED)
+        entries = [self._index[self._entry_offset(k, 0):self._entry_offset(k, indexed)]  # @IgnorePep8
+                   for k in _BY_SORT.values()]
+        capacity = max(count, 2 * capacity)
+        os.ftruncate(self._index_fd, _INDEX_HEADER_SIZE +
+                     len(entries) * capacity * _POSITION.size)
+        self._remap()
+        self._put_index(_CAPACITY, capacity)
+        for k, data in zip(_BY_SORT.values(), entries):
+            offset = self._entry_offset(k, 0)
+            self._index[offset:offset + len(data)] = data
+
+    def _build_index(self):
+        '''
+        Sort the records into the indexes, called by writers publishing
+        '''
+        records = self._records()
+        count = len(records)
+        self._grow_index(count)
+        for k in _BY_SORT.values():
+            keys = [self._key(k, r) for r in records]
+            order = sorted(range(count), key=keys.__getitem__)
+            offset = self._entry_offset(k, 0)
+            self._index[offset:offset + count * _POSITION.size] = struct.pack('<%dI' % count, *order)  # @IgnorePep8
+        self._put_index(_TOTAL, math.fsum(r[1] for r in records), _F64)
+        self._put_index(_COMPENSATION, 0.0, _F64)
+        self._put_index(_INDEXED, count)
+
+    def _extend_index(self, count):
+        '''
+        Add the records from ´count´ on to the indexes, called by writers
+        publishing
+        :param count: The count of the indexed records
+        '''
+        added = self._get(_COUNT) - count
+        if added > SHM_INDEX_REBUILD_RATIO * (count + added):
+            self._build_index()
+            return
+        self._grow_index(count + added)
+        for position in range(count, count + added):
+            for k in _BY_SORT.values():
+                self._insert_index(k, position, position)
+            self._add_total(self._record(position)[1])
+        self._put_index(_INDEXED, count + added)
+
+    def _read_changes(self, seq):
+        def read():
+            last = self._get(_CHANGES)
+            first = max(last - self._ring_size, 0) + 1
+            changes = []
+            if seq is not None and first - 1 <= seq < last:
+                for n in range(seq + 1, last + 1):
+                    n, op, version, offset, length = _CHANGE.unpack_from(
+                        self._ring, self._slot(n))
+                    data = json.loads(self._bytes(offset, length))
+                    changes.append(mmshop.Change(
+                        n, _CHANGE_OPS[op], mmshop.Item.from_dict(data, version)))  # @IgnorePep8
+            return first, last, changes
+        return self._read(read)
+
+    def _slot(self, seq):
+        return (seq - 1) % self._ring_size * _CHANGE.size
+
+    def _log(self, op, records):
+        '''
+        Append the changes of the records to the ring, called by writers
+        publishing the records
+        :param op: The operation ´create´ or ´update´
+        :param records: The packed records
+        '''
+        seq = self._get(_CHANGES)
+        for record in records:
+            record = _RECORD.unpack(record)
+            seq += 1
+            _CHANGE.pack_into(self._ring, self._slot(seq), seq,
+                              _CHANGE_OPS.index(op), record[3], record[6],
+                              record[7])
+        self._put(_CHANGES, seq)
+
+    def _remap(self):
+        # > the files were extended by a writer, the old mappings are
+        #   released when the readers are done with them
+        with self._map_lock:
+            if os.fstat(self._fd).st_size > len(self._map):
+                self._map = mmap.mmap(self._fd, 0)
+            if os.fstat(self._heap_fd).st_size > len(self._heap):
+                self._heap = mmap.mmap(self._heap_fd, 0)
+            if os.fstat(self._index_fd).st_size > len(self._index):
+                self._index = mmap.mmap(self._index_fd, 0)
+
+    def _read(self, read):
+        '''
+        Read consistently with the seqlock, under the writer lock if the
+        writes do not let the read through
+        :param read: The function reading the records
+        :return: The result of the function
+        '''
+        for _ in range(SHM_READ_RETRIES):
+            seq = self._get(_SEQ)
+            if seq & 1:
+                continue
+            try:
+                res = read()
+            except Exception:
+                # > a torn record may point anywhere
+                if self._get(_SEQ) == seq:
+                    raise
+                continue
+            if self._get(_SEQ) == seq:
+                return res
+        with self._writing():
+            return read()
+
+    @contextlib.contextmanager
+    def _writing(self):
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+    @contextlib.contextmanager
+    def _publishing(self):
+        # > called by writers holding the lock
+        seq = self._get(_SEQ)
+        self._put(_SEQ, seq + 1)
+        try:
+            yield
+        finally:
+            self._put(_VERSION, self._get(_VERSION) + 1)
+            self._put(_SEQ, seq + 2)
+
+    def _grow(self, fd, size):
+        # > called by writers holding the lock
+        length = os.fstat(fd).st_size
+        if size > length:
+            os.ftruncate(fd, max(size, 2 * length))
+            self._remap()
+
+    def _append_heap(self, items, name=None):
+        '''
+        Append the names and JSON items to the heap, called by writers
+        holding the lock. The heap is not visible before the records are
+        published.
+        :param items: The items
+        :param name: The heap offset and length of the unchanged name of
+            a single item, the name is not appended again
+        :return: list of the packed records
+        '''
+        used = self._get(_HEAP_USED)
+        chunks, records = [], []
+        for item in items:
+            item.version = item.version or 1
+            data = json.dumps(item.to_dict()).encode('utf-8')
+            if name is None:
+                chunk = (item.name or '').encode('utf-8')
+                name_offset, name_length = used, len(chunk)
+                chunks.append(chunk)
+                used += len(chunk)
+            else:
+                name_offset, name_length = name
+            records.append(_RECORD.pack(
+                item.id, item.price, item.expire_key, item.version,
+                name_offset, name_length, used, len(data)))
+            chunks.append(data)
+            used += len(data)
+        chunk = b''.join(chunks)
+        start = used - len(chunk)
+        self._grow(self._heap_fd, used)
+        self._heap[start:used] = chunk
+        self._put(_HEAP_USED, used)
+        return records
+
+    def _compact(self):
+        '''
+        Rewrite the heap with the names and JSON items of the records and
+        of the kept changes only, called by writers publishing. The live
+        size is counted when the heap grew by its size at the last check
+        (´SHM_HEAP_COMPACT_MIN´ at least), the heap is rewritten if less
+        than half of it is live.
+        '''
+        used = self._get(_HEAP_USED)
+        checked = self._get(_HEAP_CHECKED)
+        if used - checked <= max(checked, SHM_HEAP_COMPACT_MIN):
+            return
+        records = self._records()
+        last = self._get(_CHANGES)
+        seqs = range(max(last - self._ring_size, 0) + 1, last + 1)
+        changes = [_CHANGE.unpack_from(self._ring, self._slot(n))
+                   for n in seqs]
+        # > (offset, length) of the live chunks, a chunk may be shared by
+        #   a record and a change
+        chunks = set()
+        for r in records:
+            chunks.update(((r[4], r[5]), (r[6], r[7])))
+        chunks.update((c[3], c[4]) for c in changes)
+        if 2 * sum(length for _, length in chunks) > used:
+            self._put(_HEAP_CHECKED, used)
+            return
+        moved, data, size = {}, [], 0
+        for offset, length in sorted(chunks):
+            moved[offset, length] = size
+            data.append(self._bytes(offset, length))
+            size += length
+        self._heap[:size] = b''.join(data)
+        self._map[_HEADER_SIZE:self._offset(len(records))] = b''.join(
+            _RECORD.pack(*(r[:4] + (moved[r[4:6]], r[5],
+                                    moved[r[6:8]], r[7])))
+            for r in records)
+        for n, c in zip(seqs, changes):
+            _CHANGE.pack_into(self._ring, self._slot(n), *(c[:3] + (moved[c[3:5]], c[4])))  # @IgnorePep8
+        self._put(_HEAP_USED, size)
+        self._put(_HEAP_CHECKED, size)
+
+    def _add_many(self, items):
+        # > called by writers holding the lock
+        errors = []
+        batch = {}
+        for item in mmshop.coerce_items(items, self._get(_NEXT_ID, _I64)):
+            if isinstance(item, ValueError):
+                errors.append(item)
+                continue
+            if item.id in batch or self._position(item.id) is not None:
+                errors.append(mmshop.ItemExistsError(item.id))
+                continue
+            batch[item.id] = item
+            errors.append(None)
+        if batch:
+            self._insert(list(batch.values()))
+        return errors
+
+    def _insert(self, items):
+        '''
+        Append the records of new items, called by writers holding the lock
+        :param items: The items with IDs
+        '''
+        count = self._get(_COUNT)
+        records = self._append_heap(items)
+        self._grow(self._fd, self._offset(count + len(records)))
+        with self._publishing():
+            self._map[self._offset(count):self._offset(count + len(records))] = b''.join(records)  # @IgnorePep8
+            self._put(_COUNT, count + len(records))
+            self._log('create', records)
+            self._extend_index(count)
+            next_id = max(item.id for item in items) + 1
+            if next_id > self._get(_NEXT_ID, _I64):
+                self._put(_NEXT_ID, next_id, _I64)
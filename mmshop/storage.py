@@ -0,0 +1,852 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# mmshop.storage
+'''
+:author:  madkote
+:contact: madkote(at)bluewin.ch
+
+Storage
+-------
+The module provides persistent item stores and the store factory
+'''
+
+import cherrypy
+import contextlib
+import json
+import logging
+import math
+import os
+import queue
+import re
+import sqlite3
+import threading
+
+import mmshop
+
+VERSION = (0, 6, 0)
+
+__all__ = ['SHARED_STORES', 'SQLiteItemStore', 'WALItemStore', 'open_store']
+__author__ = 'madkote <madkote(at)bluewin.ch>'
+__version__ = '.'.join(str(x) for x in VERSION)
+
+WAL_SNAPSHOT = 'snapshot-%08d.ndjson'
+WAL_LOG = 'wal-%08d.ndjson'
+WAL_SNAPSHOT_EVERY = 100000
+
+# > kinds of stores which can be shared by several processes
+SHARED_STORES = ('sqlite', 'shm')
+
+SQLITE_POOL_SIZE = 10
+SQLITE_CACHED_STATEMENTS = 64
+
+_RE_WAL_FILE = re.compile(r'^(snapshot|wal)-(\d{8})\.ndjson$')
+
+
+# =============================================================================
+# FACTORY
+# =============================================================================
+def open_store(spec=None, items=None):
+    '''
+    Open the item store given by the specification:
+    * ´memory´ (default) - in-memory store
+    * ´wal:<directory>´  - in-memory store persisted with write-ahead log
+    * ´sqlite:<file>´    - SQLite database, the connection pool is sized
+                           to the server thread pool
+    * ´shm:<file>´       - memory mapped files shared by processes, e.g.
+                           ´shm:/dev/shm/mmshop´
+    :param spec: The store specification
+    :param items: initial items, persistent stores are initialized with
+        the items only if they are empty
+    :return: The item store
+    :raise ValueError: if the specification is not valid
+    '''
+    kind, _, path = (spec or 'memory').partition(':')
+    if kind == 'memory':
+        return mmshop.ItemStore(items)
+    elif kind == 'wal' and path:
+        return WALItemStore(path, items)
+    elif kind == 'sqlite' and path:
+        # > a connection for every server thread, the adaptive pool grows
+        #   up to ´server.thread_pool_max´
+        return SQLiteItemStore(path, items,
+                               pool_size=max(cherrypy.server.thread_pool,
+                                             cherrypy.server.thread_pool_max or 0))  # @IgnorePep8
+    elif kind == 'shm' and path:
+        return mmshop.SharedItemStore(path, items)
+    raise ValueError('Item store not valid: %s' % spec)
+
+
+# =============================================================================
+# WRITE-AHEAD LOG
+# =============================================================================
+class WALItemStore(mmshop.ItemStore):
+    '''
+    In-memory item store persisted with an append-only write-ahead log.
+
+    Every write is checked, then appended to the log before it is
+    applied, so the log holds only writes which apply. The log is
+    synced to the disk by a background thread: all writes which arrive
+    while a sync is running are committed together by the next sync
+    (group commit), and a writer returns only when its write is durable.
+
+    Every ´snapshot_every´ writes the log is rotated and a compact
+    snapshot of all items is written in background, then the older log
+    and snapshot files are removed. Recovery loads the latest snapshot,
+    replays the logs written after it and builds the store at once. Items
+    which the store can not hold are skipped with an error message.
+
+    Files in the store directory are numbered by generation: snapshot
+    ´N´ holds the items at the end of the log ´N - 1´.
+    '''
+    def __init__(self, path, items=None, sync=True,
+                 snapshot_every=WAL_SNAPSHOT_EVERY):
+        '''
+        :param path: The store directory
+        :param items: initial items, used only if the store is empty
+        :param sync: Flag to wait until the write is synced to the disk
+        :param snapshot_every: Count of writes between snapshots
+        '''
+        super(WALItemStore, self).__init__()
+        self.path = path
+        self.sync = sync
+        self.snapshot_every = snapshot_every
+        os.makedirs(path, exist_ok=True)
+        self._generation = self._recover()
+        self._io = threading.Condition(threading.Lock())
+        self._log = open(self._file(WAL_LOG, self._generation), 'ab')
+        self._log_records = 0
+        self._written = 0
+        self._synced = 0
+        self._closed = False
+        self._local = threading.local()
+        self._snapshotter = None
+        self._flusher = threading.Thread(target=self._flush_loop,
+                                         name='mmshop-wal-flusher')
+        self._flusher.daemon = True
+        self._flusher.start()
+        if items and not len(self):
+            for item in items:
+                self.add(item)
+
+    def add(self, item):
+        item = super(WALItemStore, self).add(item)
+        self._wait_synced()
+        return item
+
+    def add_many(self, items):
+        errors = super(WALItemStore, self).add_many(items)
+        if None in errors:
+            self._wait_synced()
+        return errors
+
+    def update(self, item_id, data, version=None):
+        item = super(WALItemStore, self).update(item_id, data, version)
+        self._wait_synced()
+        return item
+
+    def close(self):
+        '''
+        Sync the log and stop the background threads
+        '''
+        with self._io:
+            if self._closed:
+                return
+            self._closed = True
+            self._io.notify_all()
+        self._flusher.join()
+        if self._snapshotter is not None:
+            self._snapshotter.join()
+        with self._io:
+            self._log.flush()
+            os.fsync(self._log.fileno())
+            self._log.close()
+
+    def _file(self, name, generation):
+        return os.path.join(self.path, name % generation)
+
+    # =========================================================================
+    # WRITE
+    # =========================================================================
+    def _before_write(self):
+        # > rotate between the operations only: the snapshot is taken from
+        #   the index, which holds all writes of the old log then
+        if self._log_records >= self.snapshot_every:
+            self._rotate()
+
+    def _journal(self, op, item):
+        line = json.dumps({'op': op, 'item': item.to_dict(),
+                           'version': item.version}) + '\n'
+        with self._io:
+            if self._closed:
+                raise IOError('Item store is closed')
+            self._log.write(line.encode('utf-8'))
+            self._written += 1
+            self._local.seq = self._written
+            self._io.notify_all()
+        self._log_records += 1
+
+    def _wait_synced(self):
+        if not self.sync:
+            return
+        seq = self._local.seq
+        with self._io:
+            while self._synced < seq and not self._closed:
+                self._io.wait()
+
+    def _flush_loop(self):
+        while True:
+            with self._io:
+                while self._synced >= self._written and not self._closed:
+                    self._io.wait()
+                if self._closed:
+                    return
+                self._log.flush()
+                fd = os.dup(self._log.fileno())
+                seq = self._written
+            # > writes arriving while syncing are committed with next sync
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            with self._io:
+                self._synced = max(self._synced, seq)
+                self._io.notify_all()
+
+    # =========================================================================
+    # SNAPSHOT
+    # =========================================================================
+    def _rotate(self):
+        # > called by writers holding the lock, all logged writes are applied
+        if self._snapshotter is not None and self._snapshotter.is_alive():
+            return
+        items = list(self._index.values())
+        generation = self._generation + 1
+        with self._io:
+            self._log.flush()
+            os.fsync(self._log.fileno())
+            self._log.close()
+            self._log = open(self._file(WAL_LOG, generation), 'ab')
+            self._synced = self._written
+            self._io.notify_all()
+        self._generation = generation
+        self._log_records = 0
+        self._snapshotter = threading.Thread(target=self._write_snapshot,
+                                             args=(generation, items),
+                                             name='mmshop-wal-snapshot')
+        self._snapshotter.start()
+
+    def _write_snapshot(self, generation, items):
+        filename = self._file(WAL_SNAPSHOT, generation)
+        try:
+            with open(filename + '.tmp', 'wb') as f:
+                for item in items:
+                    line = json.dumps({'item': item.to_dict(),
+                                       'version': item.version}) + '\n'
+                    f.write(line.encode('utf-8'))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(filename + '.tmp', filename)
+        except Exception as e:
+            logging.error('Can not write snapshot %s: %s' % (filename, e))
+            return
+        for name, n in self._files():
+            if n < generation:
+                os.remove(os.path.join(self.path, name))
+
+    # =========================================================================
+    # RECOVERY
+    # =========================================================================
+    def _files(self):
+        res = []
+        for name in os.listdir(self.path):
+            match = _RE_WAL_FILE.match(name)
+            if match:
+                res.append((name, int(match.group(2))))
+        return res
+
+    def _recover(self):
+        '''
+        Load the latest snapshot and replay the logs written after it
+        :return: The current generation
+        '''
+        files = self._files()
+        snapshots = [n for name, n in files if name.startswith('snapshot')]
+        logs = sorted(n for name, n in files if name.startswith('wal'))
+        base = max(snapshots) if snapshots else 0
+        items = {}
+        if snapshots:
+            with open(self._file(WAL_SNAPSHOT, base), 'rb') as f:
+                for line in f:
+                    record = json.loads(line.decode('utf-8'))
+                    if 'item' not in record:
+                        # > snapshot of items without versions
+                        record = {'item': record}
+                    items[record['item']['id']] = record
+        for n in logs:
+            if n >= base:
+                self._replay(self._file(WAL_LOG, n), items)
+        loaded = []
+        for record in items.values():
+            try:
+                item = mmshop.Item.from_dict(record['item'],
+                                             record.get('version', 0))
+                mmshop.check_item_id(item.id)
+                if not math.isfinite(item.price):
+                    raise ValueError('price %r is not finite' % item.price)
+            except (TypeError, ValueError) as e:
+                # > records the store can not hold (written by older
+                #   versions) are skipped, the store still opens
+                logging.error('Skipping item %r in %s: %s' %
+                              (record['item'], self.path, e))
+                continue
+            loaded.append(item)
+        self._load(loaded)
+        return max(logs + [base])
+
+    def _replay(self, filename, items):
+        offset = 0
+        with open(filename, 'rb') as f:
+            for line in f:
+                try:
+                    record = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    break
+                if not line.endswith(b'\n'):
+                    break
+                items[record['item']['id']] = record
+                offset += len(line)
+        if offset < os.path.getsize(filename):
+            # > incomplete last record of an interrupted write
+            logging.warning('Truncating log %s at %s' % (filename, offset))
+            with open(filename, 'r+b') as f:
+                f.truncate(offset)
+
+
+# =============================================================================
+# SQLITE
+# =============================================================================
+_SQL_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS items (
+    id INTEGER PRIMARY KEY,
+    price REAL NOT NULL,
+    expire_key INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    version INTEGER NOT NULL DEFAULT 1
+);
+CREATE INDEX IF NOT EXISTS items_expire ON items (expire_key, id);
+CREATE INDEX IF NOT EXISTS items_price ON items (price);
+CREATE INDEX IF NOT EXISTS items_name
+    ON items (json_extract(data, '$.name'), id);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value NUMERIC NOT NULL
+);
+INSERT OR IGNORE INTO meta VALUES ('version', 0);
+INSERT OR IGNORE INTO meta VALUES ('next_id', 0);
+INSERT OR IGNORE INTO meta VALUES ('count', 0);
+INSERT OR IGNORE INTO meta VALUES ('total', 0.0);
+INSERT OR IGNORE INTO meta VALUES ('compensation', 0.0);
+CREATE TABLE IF NOT EXISTS changes (
+    seq INTEGER PRIMARY KEY,
+    op TEXT NOT NULL,
+    data TEXT NOT NULL,
+    version INTEGER NOT NULL
+);
+CREATE TRIGGER IF NOT EXISTS items_insert AFTER INSERT ON items BEGIN
+    UPDATE meta SET value = value + 1 WHERE key IN ('version', 'count');
+    %(add_new)s
+    UPDATE meta SET value = MAX(value, NEW.id + 1) WHERE key = 'next_id';
+    INSERT INTO changes (op, data, version)
+        VALUES ('create', NEW.data, NEW.version);
+END;
+CREATE TRIGGER IF NOT EXISTS items_update AFTER UPDATE ON items BEGIN
+    UPDATE meta SET value = value + 1 WHERE key = 'version';
+    %(remove_old)s
+    %(add_new)s
+    INSERT INTO changes (op, data, version)
+        VALUES ('update', NEW.data, NEW.version);
+END;
+'''
+# > the total value uses compensated (Neumaier) summation like
+#   ´mmshop.ItemStats´: the compensation is updated from the total before
+#   the total itself
+_SQL_SUM = '''UPDATE meta SET value = value + (
+        SELECT CASE WHEN ABS(t.value) >= ABS(%(price)s)
+            THEN (t.value - (t.value + %(price)s)) + %(price)s
+            ELSE (%(price)s - (t.value + %(price)s)) + t.value END
+        FROM meta AS t WHERE t.key = 'total') WHERE key = 'compensation';
+    UPDATE meta SET value = value + %(price)s WHERE key = 'total';'''
+_SQL_SCHEMA = _SQL_SCHEMA % {
+    'add_new': _SQL_SUM % {'price': 'NEW.price'},
+    'remove_old': _SQL_SUM % {'price': '(-OLD.price)'}}
+# > databases created before the compensated total or the change log
+_SQL_OLD_TRIGGERS = """SELECT name FROM sqlite_master WHERE type = 'trigger'
+    AND name IN ('items_insert', 'items_update')
+    AND (sql NOT LIKE '%compensation%' OR sql NOT LIKE '%INTO changes%')"""
+_SQL_PRICES = 'SELECT price FROM items'
+_SQL_SET_TOTAL = '''UPDATE meta SET value = CASE key
+    WHEN 'total' THEN ? ELSE 0.0 END WHERE key IN ('total', 'compensation')'''
+# > databases created before the item versions
+_SQL_COLUMNS = 'PRAGMA table_info(items)'
+_SQL_ADD_VERSION = '''ALTER TABLE items
+    ADD COLUMN version INTEGER NOT NULL DEFAULT 1'''
+# > the sequence numbers of the changes (rowids) are never reused, the
+#   last change is never removed
+_SQL_CHANGES_RANGE = 'SELECT MIN(seq), MAX(seq) FROM changes'
+_SQL_CHANGES = 'SELECT seq, op, data, version FROM changes WHERE seq > ? ORDER BY seq'  # @IgnorePep8
+_SQL_CHANGES_TRIM = '''DELETE FROM changes
+    WHERE seq <= (SELECT MAX(seq) FROM changes) - ?'''
+_SQL_META = 'SELECT value FROM meta WHERE key = ?'
+_SQL_NEXT_ID = "UPDATE meta SET value = value + ? WHERE key = 'next_id'"
+_SQL_COUNT = "SELECT value FROM meta WHERE key = 'count'"
+_SQL_CONTAINS = 'SELECT 1 FROM items WHERE id = ?'
+_SQL_GET = 'SELECT data, version FROM items WHERE id = ?'
+_SQL_PAGE = '''SELECT id, data, version FROM items WHERE id > ?
+    ORDER BY id LIMIT ?'''
+_SQL_INSERT = '''INSERT INTO items (id, price, expire_key, data, version)
+    VALUES (?, ?, ?, ?, ?)'''
+_SQL_UPDATE = '''UPDATE items SET price = ?, expire_key = ?, data = ?,
+    version = ? WHERE id = ?'''
+_SQL_PRICE_MIN = 'SELECT MIN(price) FROM items'
+_SQL_PRICE_MAX = 'SELECT MAX(price) FROM items'
+# > the price index is walked up to the offset, from the nearer end
+_SQL_PRICE_AT = 'SELECT price FROM items ORDER BY price LIMIT 2 OFFSET ?'
+_SQL_PRICE_AT_DESC = '''SELECT price FROM items ORDER BY price DESC
+    LIMIT 2 OFFSET ?'''
+_SQL_EXPIRED_COUNT = 'SELECT COUNT(*) FROM items WHERE expire_key <= ?'
+_SQL_EXPIRED = '''SELECT data, version FROM items WHERE expire_key <= ?
+    ORDER BY expire_key, id'''
+_SQL_VALID = '''SELECT data, version FROM items WHERE expire_key > ?
+    ORDER BY expire_key, id'''
+_SQL_NEXT_EXPIRE = 'SELECT MIN(expire_key) FROM items WHERE expire_key > ?'
+_SQL_NAME = "json_extract(data, '$.name')"
+_SQL_SORT_COLUMNS = {'id': 'id', 'name': _SQL_NAME, 'price': 'price',
+                     'expire': 'expire_key'}
+
+
+def _sql_query(sort, order, name, cursor):
+    column = _SQL_SORT_COLUMNS[sort]
+    where = ['price BETWEEN ? AND ?', 'expire_key BETWEEN ? AND ?']
+    if name:
+        where.append('%s BETWEEN ? AND ?' % _SQL_NAME)
+    if cursor:
+        op = '<' if order == 'desc' else '>'
+        if sort == 'id':
+            where.append('id %s ?' % op)
+        else:
+            where.append('(%s, id) %s (SELECT %s, id FROM items WHERE id = ?)'
+                         % (column, op, column))
+    return 'SELECT id, data, version FROM items WHERE %s ORDER BY %s %s, id %s LIMIT ?' % (  # @IgnorePep8
+        ' AND '.join(where), column, order, order)
+
+
+# > constant texts for every query shape, so the statements are cached
+_SQL_QUERY = dict(((sort, order, name, cursor),
+                   _sql_query(sort, order, name, cursor))
+                  for sort in mmshop.QUERY_SORT_KEYS
+                  for order in ('asc', 'desc')
+                  for name in (False, True)
+                  for cursor in (False, True))
+
+
+class SQLiteItemStore(object):
+    '''
+    Item store in a SQLite database with the interface of
+    ´mmshop.ItemStore´, for catalogs larger than the memory.
+
+    The database runs in WAL journal mode, so readers do not block the
+    writer. Connections are taken from a pool, every connection keeps
+    its prepared statements, and the lookups by ID, price and expiry go
+    through indexes. Count, total value (compensated like
+    ´mmshop.ItemStats´) and store version are maintained by triggers.
+    Items are stored as JSON documents next to the indexed columns.
+
+    The price percentiles of ´stats´ walk the price index from its nearer
+    end up to the rank, so they cost up to n / 2 index entries (the
+    median). They are computed once per store version and kept by the
+    process until the next write.
+
+    The triggers record the changes in the table ´changes´ too, so the
+    change log ´changes´ (´mmshop.SharedChangeLog´) follows the writes of
+    all processes using the database.
+    '''
+    def __init__(self, path, items=None, pool_size=SQLITE_POOL_SIZE,
+                 changes_size=None):
+        '''
+        :param path: The database file
+        :param items: initial items, used only if the store is empty
+        :param pool_size: The count of connections
+        :param changes_size: The count of kept changes
+            (default: ´API_CHANGES_SIZE´)
+        '''
+        self.path = path
+        self.changes = mmshop.SharedChangeLog(self._read_changes, changes_size)
+        # > store version and price percentiles at the version
+        self._percentiles = (None, None)
+        self._pool = queue.LifoQueue()
+        for _ in range(max(1, pool_size)):
+            self._pool.put(None)
+        with self._connection() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            old = [row[0] for row in conn.execute(_SQL_OLD_TRIGGERS)]
+            for name in old:
+                conn.execute('DROP TRIGGER %s' % name)
+            conn.executescript(_SQL_SCHEMA)
+            columns = [row[1] for row in conn.execute(_SQL_COLUMNS)]
+            if 'version' not in columns:
+                conn.execute(_SQL_ADD_VERSION)
+            if old:
+                total = math.fsum(row[0] for row in conn.execute(_SQL_PRICES))
+                conn.execute(_SQL_SET_TOTAL, (total,))
+        if items and not len(self):
+            for item in items:
+                self.add(item)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30,
+                               isolation_level=None,
+                               check_same_thread=False,
+                               cached_statements=SQLITE_CACHED_STATEMENTS)
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    @contextlib.contextmanager
+    def _connection(self):
+        # > connections are opened lazily, at most pool size at once
+        conn = self._pool.get()
+        try:
+            if conn is None:
+                conn = self._connect()
+            yield conn
+        finally:
+            self._pool.put(conn)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        with self._connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            else:
+                conn.execute('COMMIT')
+
+    def _meta(self, conn, key):
+        return conn.execute(_SQL_META, (key,)).fetchone()[0]
+
+    def _read_changes(self, seq):
+        # > range and changes from the same snapshot
+        with self._connection() as conn:
+            conn.execute('BEGIN')
+            try:
+                first, last = conn.execute(_SQL_CHANGES_RANGE).fetchone()
+                rows = []
+                if seq is not None and first is not None and first - 1 <= seq:  # @IgnorePep8
+                    rows = conn.execute(_SQL_CHANGES, (seq,)).fetchall()
+            finally:
+                conn.execute('COMMIT')
+        last = last or 0
+        return (last + 1 if first is None else first), last, [
+            mmshop.Change(s, op, mmshop.Item.from_dict(json.loads(data), version))  # @IgnorePep8
+            for s, op, data, version in rows]
+
+    def _trim_changes(self, conn):
+        conn.execute(_SQL_CHANGES_TRIM, (self.changes.size,))
+
+    def __len__(self):
+        with self._connection() as conn:
+            return conn.execute(_SQL_COUNT).fetchone()[0]
+
+    def __contains__(self, item_id):
+        with self._connection() as conn:
+            return conn.execute(_SQL_CONTAINS, (item_id,)).fetchone() is not None  # @IgnorePep8
+
+    def close(self):
+        '''
+        Close the connections
+        '''
+        while True:
+            try:
+                conn = self._pool.get_nowait()
+            except queue.Empty:
+                break
+            if conn is not None:
+                conn.close()
+
+    @property
+    def version(self):
+        '''
+        The store version, incremented on every write
+        '''
+        with self._connection() as conn:
+            return self._meta(conn, 'version')
+
+    def next_id(self):
+        '''
+        Allocate the next free item ID
+        :return: the item ID
+        '''
+        return self.next_ids(1)
+
+    def next_ids(self, count):
+        '''
+        Allocate a block of free item IDs
+        :param count: The count of IDs
+        :return: the first item ID of the block
+        '''
+        with self._transaction() as conn:
+            conn.execute(_SQL_NEXT_ID, (count,))
+            return self._meta(conn, 'next_id') - count
+
+    def get(self, item_id):
+        '''
+        Get item by ID
+        :param item_id: The item ID
+        :return: The item
+        :raise ItemNotFoundError: if there is no item with the given ID
+        '''
+        with self._connection() as conn:
+            row = conn.execute(_SQL_GET, (item_id,)).fetchone()
+        if row is None:
+            raise mmshop.ItemNotFoundError(item_id)
+        return mmshop.Item.from_dict(json.loads(row[0]), row[1])
+
+    def items(self):
+        '''
+        Get all items
+        :return: tuple of items ordered by ID
+        '''
+        return self.page()[0]
+
+    def page(self, after=None, limit=None):
+        '''
+        Get a page of items ordered by ID
+        :param after: The cursor - only items with greater ID are returned
+        :param limit: The maximal count of items (default: all)
+        :return: tuple of the items and the cursor for the next page,
+            the cursor is ´None´ if there are no more items
+        '''
+        after = -1 if after is None else after
+        # > one more row tells if there is a next page
+        size = -1 if limit is None else limit + 1
+        with self._connection() as conn:
+            rows = conn.execute(_SQL_PAGE, (after, size)).fetchall()
+        next_after = None
+        if limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            next_after = rows[-1][0]
+        return tuple(mmshop.Item.from_dict(json.loads(data), version)
+                     for _, data, version in rows), next_after
+
+    def add(self, item):
+        '''
+        Add new item. If the item has no ID, the next free ID is assigned.
+        :param item: The item (record or dictionary)
+        :return: The stored item
+        :raise ItemExistsError: if an item with same ID exists already
+        :raise ValueError: if the item expiry or ID is not valid
+        '''
+        item = mmshop.Item.coerce(item)
+        with self._transaction() as conn:
+            if item.id is None:
+                item.id = self._meta(conn, 'next_id')
+            mmshop.check_item_id(item.id)
+            try:
+                self._insert(conn, item)
+            except sqlite3.IntegrityError:
+                raise mmshop.ItemExistsError(item.id)
+            self._trim_changes(conn)
+        self.changes.notify()
+        return item
+
+    def add_many(self, items):
+        '''
+        Add new items at once in a single transaction, see
+        ´mmshop.ItemStore.add_many´
+        :param items: The items (records or dictionaries)
+        :return: list of errors for the items
+        '''
+        errors = []
+        with self._transaction() as conn:
+            items = mmshop.coerce_items(items, self._meta(conn, 'next_id'))
+            for item in items:
+                if isinstance(item, ValueError):
+                    errors.append(item)
+                    continue
+                try:
+                    self._insert(conn, item)
+                except sqlite3.IntegrityError:
+                    errors.append(mmshop.ItemExistsError(item.id))
+                else:
+                    errors.append(None)
+            self._trim_changes(conn)
+        self.changes.notify()
+        return errors
+
+    def _insert(self, conn, item):
+        item.version = item.version or 1
+        conn.execute(_SQL_INSERT, (item.id, item.price, item.expire_key,
+                                   json.dumps(item.to_dict()), item.version))
+
+    def update(self, item_id, data, version=None):
+        '''
+        Update the item by ID, see ´mmshop.ItemStore.update´
+        :param item_id: The item ID
+        :param data: The fields to be updated
+        :param version: The expected item version (default: any)
+        :return: The updated item
+        :raise ItemNotFoundError: if there is no item with the given ID
+        :raise ItemVersionError: if the item version is not the expected one
+        :raise ValueError: if the item expiry is not valid
+        '''
+        with self._transaction() as conn:
+            row = conn.execute(_SQL_GET, (item_id,)).fetchone()
+            if row is None:
+                raise mmshop.ItemNotFoundError(item_id)
+            if version is not None and row[1] != version:
+                raise mmshop.ItemVersionError(item_id, row[1])
+            item = mmshop.Item.from_dict(json.loads(row[0]), row[1])
+            item = item.replace(**data)
+            conn.execute(_SQL_UPDATE, (item.price, item.expire_key,
+                                       json.dumps(item.to_dict()),
+                                       item.version, item_id))
+            self._trim_changes(conn)
+        self.changes.notify()
+        return item
+
+    def stats(self, now=None):
+        '''
+        Get the aggregates of the items
+        :param now: The time to count the expired items (default: now)
+        :return: The aggregates, see ´mmshop.ItemStore.stats´
+        '''
+        with self._connection() as conn:
+            # > all aggregates from the same snapshot
+            conn.execute('BEGIN')
+            try:
+                count = self._meta(conn, 'count')
+                value = (float(self._meta(conn, 'total')) +
+                         float(self._meta(conn, 'compensation'))) if count else 0.0  # @IgnorePep8
+                price_min = conn.execute(_SQL_PRICE_MIN).fetchone()[0]
+                price_max = conn.execute(_SQL_PRICE_MAX).fetchone()[0]
+                expired = conn.execute(_SQL_EXPIRED_COUNT,
+                                       (mmshop.expire_key(now),)).fetchone()[0]  # @IgnorePep8
+                version = self._meta(conn, 'version')
+                cached, percentiles = self._percentiles
+                if cached != version:
+                    percentiles = dict(
+                        ('items_price_p%s' % q, self._percentile(conn, count, q))  # @IgnorePep8
+                        for q in mmshop.PRICE_PERCENTILES)
+                    self._percentiles = (version, percentiles)
+            finally:
+                conn.execute('COMMIT')
+        res = {'items_count': count,
+               'items_value': value,
+               'items_price_min': price_min,
+               'items_price_max': price_max,
+               'items_price_mean': value / count if count else None,
+               'items_expired': expired}
+        res.update(percentiles)
+        return res
+
+    def _percentile(self, conn, count, q):
+        # > the price index gives the values at the rank
+        if not count:
+            return None
+        index, fraction = mmshop.percentile_rank(count, q)
+        if 2 * index < count:
+            prices = [price for price, in
+                      conn.execute(_SQL_PRICE_AT, (index,)).fetchall()]
+        else:
+            offset = count - 2 - index
+            prices = [price for price, in conn.execute(
+                _SQL_PRICE_AT_DESC, (max(offset, 0),)).fetchall()]
+            prices = prices[::-1] if offset >= 0 else prices[:1]
+        res = prices[0]
+        if fraction:
+            res += (prices[1] - res) * fraction
+        return res
+
+    def expired(self, now=None, flag=True):
+        '''
+        Get expired items
+        :param now: The time (default: now)
+        :param flag: Get the expired (default) or not expired items
+        :return: list of items ordered by expiry
+        '''
+        sql = _SQL_EXPIRED if flag else _SQL_VALID
+        with self._connection() as conn:
+            rows = conn.execute(sql, (mmshop.expire_key(now),)).fetchall()
+        return [mmshop.Item.from_dict(json.loads(data), version)
+                for data, version in rows]
+
+    def select(self, price_min=None, price_max=None, expired=None,
+               after=None, limit=None, now=None):
+        '''
+        Get a page of the items in the price range ordered by ID, see
+        ´mmshop.ItemStore.select´
+        :return: tuple of the items and the cursor for the next page
+        '''
+        return self.query(price_min=price_min, price_max=price_max,
+                          expired=expired, after=after, limit=limit, now=now)
+
+    def query(self, name=None, name_prefix=None, price_min=None,
+              price_max=None, expire_min=None, expire_max=None, expired=None,
+              sort='id', order='asc', after=None, limit=None, now=None):
+        '''
+        Query the items with the indexes of the database, see
+        ´mmshop.ItemStore.query´
+        :return: tuple of the items and the cursor for the next page
+        :raise ValueError: if the sort key or order is not valid
+        :raise ItemNotFoundError: if there is no item with the cursor ID
+        '''
+        if sort not in mmshop.QUERY_SORT_KEYS:
+            raise ValueError('sort key %r not in %r' %
+                             (sort, mmshop.QUERY_SORT_KEYS))
+        if order not in ('asc', 'desc'):
+            raise ValueError('sort order %r not in asc, desc' % order)
+        inf = float('inf')
+        expire_min = -1 if expire_min is None else expire_min
+        expire_max = inf if expire_max is None else expire_max
+        if expired is not None:
+            key = mmshop.expire_key(now)
+            if expired:
+                expire_max = min(expire_max, key)
+            else:
+                expire_min = max(expire_min, key + 1)
+        args = [-inf if price_min is None else price_min,
+                inf if price_max is None else price_max,
+                expire_min, expire_max]
+        if name is not None:
+            args.extend((name, name))
+        elif name_prefix is not None:
+            args.extend((name_prefix, name_prefix + mmshop.NAME_PREFIX_END))
+        if after is not None:
+            args.append(after)
+        # > one more row tells if there is a next page
+        args.append(-1 if limit is None else limit + 1)
+        by_name = name is not None or name_prefix is not None
+        sql = _SQL_QUERY[sort, order, by_name, after is not None]
+        with self._connection() as conn:
+            if after is not None and sort != 'id' and \
+                    conn.execute(_SQL_CONTAINS, (after,)).fetchone() is None:
+                raise mmshop.ItemNotFoundError(after)
+            rows = conn.execute(sql, args).fetchall()
+        next_after = None
+        if limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            next_after = rows[-1][0]
+        return tuple(mmshop.Item.from_dict(json.loads(data), version)
+                     for _, data, version in rows), next_after
+
+    def next_expire(self, now=None):
+        '''
+        Get the expiry key of the item to expire next
+        :param now: The time (default: now)
+        :return: The expiry key or ´None´ if no item is going to expire
+        '''
+        with self._connection() as conn:
+            return conn.execute(_SQL_NEXT_EXPIRE,
+                                (mmshop.expire_key(now),)).fetchone()[0]
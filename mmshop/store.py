@@ -0,0 +1,1061 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# mmshop.store
+'''
+:author:  madkote
+:contact: madkote(at)bluewin.ch
+
+Item store
+----------
+The module provides the item repository used by the API
+'''
+
+import array
+import bisect
+import datetime
+import functools
+import itertools
+import operator
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import mmshop
+
+VERSION = (0, 12, 0)
+
+__all__ = ['EXPIRE_FORMAT', 'ITEM_ID_MAX', 'ITEM_ID_MIN', 'NAME_PREFIX_END',
+           'PRICE_PERCENTILES',
+           'QUERY_SCAN_RATIO', 'QUERY_SORT_KEYS', 'ExpiryIndex',
+           'ItemColumns', 'ItemStats', 'ItemStore', 'ItemExistsError',
+           'ItemNotFoundError', 'ItemVersionError', 'ReadWriteLock',
+           'SortedIndex', 'check_item_id', 'coerce_items', 'expire_key',
+           'parse_expire', 'percentile_rank']
+__author__ = 'madkote <madkote(at)bluewin.ch>'
+__version__ = '.'.join(str(x) for x in VERSION)
+
+EXPIRE_FORMAT = '%Y%m%d%H%M'
+PRICE_PERCENTILES = (50, 90, 99)
+QUERY_SORT_KEYS = ('id', 'name', 'price', 'expire')
+# > a query scans the columns instead of the index if the index range
+#   is larger than 1/QUERY_SCAN_RATIO of the items
+QUERY_SCAN_RATIO = 8
+# > upper bound of the names with a prefix
+NAME_PREFIX_END = '\U0010ffff'
+# > item IDs are signed 64-bit integers in the columns and the stores
+ITEM_ID_MIN = -2 ** 63
+ITEM_ID_MAX = 2 ** 63 - 1
+
+
+# =============================================================================
+# UTILITIES
+# =============================================================================
+def expire_key(now=None):
+    '''
+    Get the expiry key of the time. The key is the number ´YYYYMMDDhhmm´,
+    so keys are ordered like the times.
+    :param now: The time (default: now)
+    :return: The key comparable with the items expiry keys
+    '''
+    if now is None:
+        now = datetime.datetime.now()
+    return (now.year * 100000000 + now.month * 1000000 + now.day * 10000 +
+            now.hour * 100 + now.minute)
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_expire(value):
+    '''
+    Parse and validate the item expiry in ´EXPIRE_FORMAT´. Expiry times
+    repeat a lot across a catalog, the results are cached.
+    :param value: The expiry
+    :return: The expiry key, see ´expire_key´
+    :raise ValueError: if the expiry is not valid
+    '''
+    if len(value) != 12 or not value.isdigit():
+        raise ValueError('expiry %r does not match %r' %
+                         (value, EXPIRE_FORMAT))
+    datetime.datetime(int(value[0:4]), int(value[4:6]), int(value[6:8]),
+                      int(value[8:10]), int(value[10:12]))
+    return int(value)
+
+
+def percentile_rank(count, q):
+    '''
+    Get the position of the percentile in sorted values. The percentile
+    is interpolated linearly between the value at the index and the next
+    value (same as the NumPy default).
+    :param count: The count of values
+    :param q: The percentile 0..100
+    :return: tuple of the index and the fraction of the next value
+    '''
+    position = (count - 1) * q / 100.0
+    index = int(position)
+    return index, position - index
+
+
+def _name_key(item):
+    return item.name or ''
+
+
+_SORT_KEYS = {'id': operator.attrgetter('id'),
+              'name': _name_key,
+              'price': operator.attrgetter('price'),
+              'expire': operator.attrgetter('expire_key')}
+
+
+# =============================================================================
+# ERRORS
+# =============================================================================
+class ItemNotFoundError(KeyError):
+    '''
+    there is no item with the given ID
+    '''
+
+
+class ItemExistsError(KeyError):
+    '''
+    an item with the given ID exists already
+    '''
+
+
+class ItemVersionError(Exception):
+    '''
+    the item version is not the expected one - the item was updated
+    in the meantime
+    '''
+
+
+# =============================================================================
+# LOCKING
+# =============================================================================
+class ReadWriteLock(object):
+    '''
+    Reader/writer lock: many readers or one writer at a time.
+    Waiting writers take precedence over new readers, so a steady stream
+    of reads can not starve the writers.
+    '''
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+
+    def acquire_read(self):
+        with self._cond:
+            while self._writer or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+
+    def release_read(self):
+        with self._cond:
+            self._readers -= 1
+            if not self._readers:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writer = True
+
+    def release_write(self):
+        with self._cond:
+            self._writer = False
+            self._cond.notify_all()
+
+    def reading(self):
+        '''
+        :return: context manager holding the lock for reading
+        '''
+        return _LockContext(self.acquire_read, self.release_read)
+
+    def writing(self):
+        '''
+        :return: context manager holding the lock for writing
+        '''
+        return _LockContext(self.acquire_write, self.release_write)
+
+
+class _LockContext(object):
+    def __init__(self, acquire, release):
+        self._acquire = acquire
+        self._release = release
+
+    def __enter__(self):
+        self._acquire()
+        return self
+
+    def __exit__(self, *args):
+        self._release()
+
+
+# =============================================================================
+# AGGREGATES
+# =============================================================================
+class ItemStats(object):
+    '''
+    Running aggregates over the stored items.
+
+    The aggregates are updated on every write, so reading them does not
+    depend on the number of items. The total value uses compensated
+    (Neumaier) summation, so it does not drift with adding and removing
+    prices. Prices are kept sorted, the minimum and maximum price are
+    read from the ends.
+
+    Not thread-safe by itself - the owning store serializes the writers.
+    '''
+    def __init__(self):
+        self._count = 0
+        self._total = 0.0
+        self._compensation = 0.0
+        self._prices = []
+
+    def _sum(self, value):
+        total = self._total + value
+        if abs(self._total) >= abs(value):
+            self._compensation += (self._total - total) + value
+        else:
+            self._compensation += (value - total) + self._total
+        self._total = total
+
+    def load(self, items):
+        '''
+        Replace the aggregates by the aggregates over the items
+        :param items: The items
+        '''
+        self.__init__()
+        for item in items:
+            self._count += 1
+            self._sum(item.price)
+        self._prices = sorted(item.price for item in items)
+
+    def add(self, item):
+        '''
+        Account a new item
+        :param item: The item
+        '''
+        self._count += 1
+        self._sum(item.price)
+        bisect.insort(self._prices, item.price)
+
+    def add_many(self, items):
+        '''
+        Account new items at once
+        :param items: The items
+        '''
+        prices = []
+        for item in items:
+            self._count += 1
+            self._sum(item.price)
+            prices.append(item.price)
+        # > merging sorted runs is linear
+        self._prices.extend(sorted(prices))
+        self._prices.sort()
+
+    def remove(self, item):
+        '''
+        Remove an item from the aggregates
+        :param item: The item
+        '''
+        self._count -= 1
+        self._sum(-item.price)
+        del self._prices[bisect.bisect_left(self._prices, item.price)]
+        if not self._count:
+            self._total = self._compensation = 0.0
+
+    def to_dict(self):
+        '''
+        :return: The aggregates
+        '''
+        if self._count:
+            price_min = self._prices[0]
+            price_max = self._prices[-1]
+            value = self._total + self._compensation
+            price_mean = value / self._count
+        else:
+            price_min = price_max = price_mean = None
+            value = 0.0
+        res = {'items_count': self._count,
+               'items_value': value,
+               'items_price_min': price_min,
+               'items_price_max': price_max,
+               'items_price_mean': price_mean}
+        for q in PRICE_PERCENTILES:
+            res['items_price_p%s' % q] = self.percentile(q)
+        return res
+
+    def percentile(self, q):
+        '''
+        Get the price percentile, the prices are sorted already
+        :param q: The percentile 0..100
+        :return: The price or ´None´ if there are no items
+        '''
+        if not self._count:
+            return None
+        index, fraction = percentile_rank(self._count, q)
+        res = self._prices[index]
+        if fraction:
+            res += (self._prices[index + 1] - res) * fraction
+        return res
+
+
+class SortedIndex(object):
+    '''
+    Secondary index: sorted ´(key, item ID)´ pairs.
+
+    The items with keys in a range are found with bisection, so a range
+    query costs O(log n) plus the count of the items in the range, and
+    the items are read in the key order.
+
+    Not thread-safe by itself - the owning store serializes the writers.
+    '''
+    def __init__(self, key):
+        '''
+        :param key: The function getting the key of an item
+        '''
+        self.key = key
+        self._keys = []
+
+    def __len__(self):
+        return len(self._keys)
+
+    def load(self, items):
+        '''
+        Replace the index by the index of the items
+        :param items: The items
+        '''
+        key = self.key
+        self._keys = sorted((key(item), item.id) for item in items)
+
+    def add(self, item):
+        '''
+        Index a new item
+        :param item: The item
+        '''
+        bisect.insort(self._keys, (self.key(item), item.id))
+
+    def add_many(self, items):
+        '''
+        Index new items at once
+        :param items: The items
+        '''
+        key = self.key
+        self._keys.extend(sorted((key(item), item.id) for item in items))
+        self._keys.sort()
+
+    def remove(self, item):
+        '''
+        Remove an item from the index
+        :param item: The item
+        '''
+        key = (self.key(item), item.id)
+        del self._keys[bisect.bisect_left(self._keys, key)]
+
+    def update(self, old, item):
+        '''
+        Re-index an updated item
+        :param old: The old item
+        :param item: The new item
+        '''
+        if self.key(old) != self.key(item):
+            self.remove(old)
+            self.add(item)
+
+    def between(self, low=None, high=None):
+        '''
+        Get the positions of the keys in the range
+        :param low: The minimal key (inclusive, default: unbounded)
+        :param high: The maximal key (inclusive, default: unbounded)
+        :return: tuple of the start and stop position
+        '''
+        start = 0 if low is None else bisect.bisect_left(self._keys, (low,))
+        if high is None:
+            stop = len(self._keys)
+        else:
+            stop = bisect.bisect_right(self._keys, (high, float('inf')))
+        return start, max(start, stop)
+
+    def position(self, key, item_id):
+        '''
+        Get the position of the item in the index
+        :param key: The key of the item
+        :param item_id: The item ID
+        :return: The position of the item or of the next key
+        '''
+        return bisect.bisect_left(self._keys, (key, item_id))
+
+    def ids(self, start=0, stop=None, reverse=False):
+        '''
+        Iterate the item IDs in the key order
+        :param start: The start position
+        :param stop: The stop position (default: end)
+        :param reverse: Iterate backwards from the stop position
+        :return: generator of item IDs
+        '''
+        keys = self._keys
+        stop = len(keys) if stop is None else stop
+        if reverse:
+            return (keys[i][1] for i in range(stop - 1, start - 1, -1))
+        return (keys[i][1] for i in range(start, stop))
+
+
+class ExpiryIndex(SortedIndex):
+    '''
+    Items ordered by expiry.
+
+    The index keeps sorted ´(expiry key, item ID)´ pairs, the expired items
+    are the head of the list up to the current time and are found with
+    bisection.
+
+    Not thread-safe by itself - the owning store serializes the writers.
+    '''
+    def __init__(self):
+        super(ExpiryIndex, self).__init__(operator.attrgetter('expire_key'))
+
+    def _split(self, now):
+        # > position of the first item not expired at the time
+        return bisect.bisect_right(self._keys, (expire_key(now), float('inf')))
+
+    def count(self, now=None):
+        '''
+        Count of expired items
+        :param now: The time (default: now)
+        :return: The count of items
+        '''
+        return self._split(now)
+
+    def expired(self, now=None):
+        '''
+        IDs of expired items
+        :param now: The time (default: now)
+        :return: list of item IDs ordered by expiry
+        '''
+        return [i for _, i in self._keys[:self._split(now)]]
+
+    def valid(self, now=None):
+        '''
+        IDs of items not expired
+        :param now: The time (default: now)
+        :return: list of item IDs ordered by expiry
+        '''
+        return [i for _, i in self._keys[self._split(now):]]
+
+    def next_expire(self, now=None):
+        '''
+        Get the expiry key of the item to expire next
+        :param now: The time (default: now)
+        :return: The expiry key or ´None´ if no item is going to expire
+        '''
+        i = self._split(now)
+        return self._keys[i][0] if i < len(self._keys) else None
+
+
+class ItemColumns(object):
+    '''
+    Item prices and expiry keys in contiguous columns parallel to the
+    sorted item IDs.
+
+    Range filters run as vectorized operations over the columns with
+    NumPy if it is installed (the columns are shared without a copy),
+    otherwise as a single pass over the columns without touching the items.
+
+    Not thread-safe by itself - the owning store serializes the writers.
+    '''
+    def __init__(self):
+        self._ids = array.array('q')
+        self._prices = array.array('d')
+        self._expires = array.array('q')
+
+    def __len__(self):
+        return len(self._ids)
+
+    def load(self, items):
+        '''
+        Replace the columns by the columns of the items
+        :param items: The items ordered by ID
+        '''
+        self._ids = array.array('q', [item.id for item in items])
+        self._prices = array.array('d', [item.price for item in items])
+        self._expires = array.array('q', [item.expire_key for item in items])
+
+    def add(self, item):
+        '''
+        Add a new item
+        :param item: The item
+        '''
+        i = bisect.bisect_left(self._ids, item.id)
+        if i == len(self._ids):
+            self._ids.append(item.id)
+            self._prices.append(item.price)
+            self._expires.append(item.expire_key)
+        else:
+            self._ids.insert(i, item.id)
+            self._prices.insert(i, item.price)
+            self._expires.insert(i, item.expire_key)
+
+    def add_many(self, items):
+        '''
+        Add new items at once
+        :param items: The items
+        '''
+        for item in sorted(items, key=operator.attrgetter('id')):
+            self.add(item)
+
+    def update(self, item):
+        '''
+        Update the columns of a stored item
+        :param item: The new item
+        '''
+        i = bisect.bisect_left(self._ids, item.id)
+        self._prices[i] = item.price
+        self._expires[i] = item.expire_key
+
+    def select(self, price_min=None, price_max=None, expire_min=None,
+               expire_max=None, after=None, limit=None):
+        '''
+        Select the items in the ranges, the bounds are inclusive and
+        ´None´ is unbounded
+        :param price_min: The minimal price
+        :param price_max: The maximal price
+        :param expire_min: The minimal expiry key
+        :param expire_max: The maximal expiry key
+        :param after: The cursor - only items with greater ID are selected
+        :param limit: The maximal count of items (default: all)
+        :return: tuple of the list of item IDs ordered by ID and the cursor
+            for the next page, the cursor is ´None´ if there are no more items
+        '''
+        start = 0 if after is None else bisect.bisect_right(self._ids, after)
+        # > one more item tells if there is a next page
+        size = None if limit is None else limit + 1
+        if numpy is not None:
+            ids = self._select_numpy(start, size, price_min, price_max,
+                                     expire_min, expire_max)
+        else:
+            ids = self._select_python(start, size, price_min, price_max,
+                                      expire_min, expire_max)
+        next_after = None
+        if limit is not None and len(ids) > limit:
+            ids = ids[:limit]
+            next_after = ids[-1]
+        return ids, next_after
+
+    def _select_numpy(self, start, size, price_min, price_max, expire_min,
+                      expire_max):
+        # > views of the columns, released before the writers resize them
+        mask = True
+        prices = numpy.frombuffer(self._prices, numpy.float64)[start:]
+        if price_min is not None:
+            mask = mask & (prices >= price_min)
+        if price_max is not None:
+            mask = mask & (prices <= price_max)
+        expires = numpy.frombuffer(self._expires, numpy.int64)[start:]
+        if expire_min is not None:
+            mask = mask & (expires >= expire_min)
+        if expire_max is not None:
+            mask = mask & (expires <= expire_max)
+        ids = numpy.frombuffer(self._ids, numpy.int64)[start:]
+        if mask is not True:
+            ids = ids[mask]
+        return ids[:size].tolist()
+
+    def _select_python(self, start, size, price_min, price_max, expire_min,
+                       expire_max):
+        inf = float('inf')
+        price_min = -inf if price_min is None else price_min
+        price_max = inf if price_max is None else price_max
+        expire_min = -inf if expire_min is None else expire_min
+        expire_max = inf if expire_max is None else expire_max
+        columns = zip(itertools.islice(self._ids, start, None),
+                      itertools.islice(self._prices, start, None),
+                      itertools.islice(self._expires, start, None))
+        ids = (i for i, price, expire in columns
+               if price_min <= price <= price_max and
+               expire_min <= expire <= expire_max)
+        return list(itertools.islice(ids, size))
+
+
+# =============================================================================
+# STORE
+# =============================================================================
+def check_item_id(item_id):
+    '''
+    Check the item ID is in the range of the stores, see ´ITEM_ID_MAX´
+    :param item_id: The item ID
+    :return: The item ID
+    :raise ValueError: if the ID is out of range
+    '''
+    if not ITEM_ID_MIN <= item_id <= ITEM_ID_MAX:
+        raise ValueError('item ID %s out of range %s..%s' %
+                         (item_id, ITEM_ID_MIN, ITEM_ID_MAX))
+    return item_id
+
+
+def coerce_items(items, next_id):
+    '''
+    Coerce the items of a batch and assign the missing IDs. The missing
+    IDs follow the IDs of the batch, so they do not collide with them.
+    :param items: The items (records or dictionaries)
+    :param next_id: The next free ID of the store
+    :return: list of the items or of ´ValueError´ for the invalid items
+        (expiry or ID out of range)
+    '''
+    res = []
+    for item in items:
+        try:
+            item = mmshop.Item.coerce(item)
+            if item.id is not None:
+                check_item_id(item.id)
+                next_id = max(next_id, item.id + 1)
+            res.append(item)
+        except ValueError as e:
+            res.append(e)
+    for n, item in enumerate(res):
+        if not isinstance(item, ValueError) and item.id is None:
+            try:
+                item.id = check_item_id(next_id)
+            except ValueError as e:
+                res[n] = e
+            next_id += 1
+    return res
+
+
+class ItemStore(object):
+    '''
+    Thread-safe in-memory item repository with an ID index.
+
+    Items are kept in a dictionary keyed by the item ID, so lookup, insert
+    and update do not depend on the number of items. New IDs are taken from
+    a monotonic allocator instead of scanning for the highest ID.
+
+    Stored items are never modified in place: an update publishes a new
+    item record (copy-on-write). Single item reads therefore need no
+    lock, writers are serialized by a reader/writer lock, and the list of
+    all items is an immutable snapshot which is shared by all readers
+    until the next write.
+
+    Items are listed in ID order, which makes the ID a stable cursor
+    for pagination. Secondary indexes by name, price and expiry are
+    maintained on every write and serve the queries, see ´query´.
+
+    Every write is recorded in the change log ´changes´ for the clients
+    following the changes, see ´mmshop.ChangeLog´.
+    '''
+    def __init__(self, items=None):
+        '''
+        :param items: initial items (copied into the store)
+        '''
+        self._lock = ReadWriteLock()
+        self._index = {}
+        self._ids = []
+        self._next_id = 0
+        self._version = 0
+        self._snapshot = ((), ())
+        self._stats = ItemStats()
+        self._expiry = ExpiryIndex()
+        self._names = SortedIndex(_name_key)
+        self._prices = SortedIndex(_SORT_KEYS['price'])
+        self._columns = ItemColumns()
+        self.changes = mmshop.ChangeLog()
+        for item in (items or []):
+            self.add(item)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, item_id):
+        return item_id in self._index
+
+    def close(self):
+        '''
+        Release the store resources
+        '''
+
+    @property
+    def version(self):
+        '''
+        The store version, incremented on every write
+        '''
+        return self._version
+
+    def next_id(self):
+        '''
+        Allocate the next free item ID
+        :return: the item ID
+        '''
+        return self.next_ids(1)
+
+    def next_ids(self, count):
+        '''
+        Allocate a block of free item IDs
+        :param count: The count of IDs
+        :return: the first item ID of the block
+        '''
+        with self._lock.writing():
+            item_id = self._next_id
+            self._next_id += count
+        return item_id
+
+    def get(self, item_id):
+        '''
+        Get item by ID
+        :param item_id: The item ID
+        :return: The item
+        :raise ItemNotFoundError: if there is no item with the given ID
+        '''
+        item = self._index.get(item_id)
+        if item is None:
+            raise ItemNotFoundError(item_id)
+        return item
+
+    def items(self):
+        '''
+        Get all items
+        :return: immutable snapshot (tuple) of items ordered by ID
+        '''
+        return self._get_snapshot()[1]
+
+    def page(self, after=None, limit=None):
+        '''
+        Get a page of items ordered by ID
+        :param after: The cursor - only items with greater ID are returned
+        :param limit: The maximal count of items (default: all)
+        :return: tuple of the items and the cursor for the next page,
+            the cursor is ´None´ if there are no more items
+        '''
+        ids, items = self._get_snapshot()
+        start = 0 if after is None else bisect.bisect_right(ids, after)
+        stop = len(ids) if limit is None else min(start + limit, len(ids))
+        next_after = ids[stop - 1] if start < stop < len(ids) else None
+        return items[start:stop], next_after
+
+    def add(self, item):
+        '''
+        Add new item. If the item has no ID, the next free ID is assigned.
+        :param item: The item (record or dictionary)
+        :return: The stored item
+        :raise ItemExistsError: if an item with same ID exists already
+        :raise ValueError: if the item expiry or ID is not valid
+        '''
+        item = mmshop.Item.coerce(item)
+        with self._lock.writing():
+            self._before_write()
+            # > everything which may fail is checked before the journal
+            #   and the indexes are written
+            if item.id is None:
+                item.id = self._next_id
+            check_item_id(item.id)
+            if item.id in self._index:
+                raise ItemExistsError(item.id)
+            item.version = item.version or 1
+            self._journal('add', item)
+            if item.id >= self._next_id:
+                self._next_id = item.id + 1
+            self._index[item.id] = item
+            if not self._ids or item.id > self._ids[-1]:
+                self._ids.append(item.id)
+            else:
+                bisect.insort(self._ids, item.id)
+            self._stats.add(item)
+            self._expiry.add(item)
+            self._names.add(item)
+            self._prices.add(item)
+            self._columns.add(item)
+            self._publish()
+            self.changes.append('create', item)
+        return item
+
+    def add_many(self, items):
+        '''
+        Add new items at once with a single write. Items without ID get
+        the next free IDs after the IDs of the other items. Items which can
+        not be added are skipped.
+        :param items: The items (records or dictionaries)
+        :return: list of errors for the items: ´None´ if the item was added,
+            ´ItemExistsError´ or ´ValueError´ if the expiry or ID is not
+            valid
+        '''
+        errors = []
+        batch = {}
+        with self._lock.writing():
+            self._before_write()
+            items = coerce_items(items, self._next_id)
+            for item in items:
+                if isinstance(item, ValueError):
+                    errors.append(item)
+                    continue
+                if item.id in self._index or item.id in batch:
+                    errors.append(ItemExistsError(item.id))
+                    continue
+                item.version = item.version or 1
+                batch[item.id] = item
+                errors.append(None)
+            if batch:
+                for item in batch.values():
+                    self._journal('add', item)
+                self._index.update(batch)
+                self._ids.extend(sorted(batch))
+                self._ids.sort()
+                self._next_id = max(self._next_id, self._ids[-1] + 1)
+                self._stats.add_many(batch.values())
+                self._expiry.add_many(batch.values())
+                self._names.add_many(batch.values())
+                self._prices.add_many(batch.values())
+                self._columns.add_many(batch.values())
+                self._publish()
+                self.changes.extend('create', batch.values())
+        return errors
+
+    def update(self, item_id, data, version=None):
+        '''
+        Update the item by ID. Only the given fields are replaced and the
+        item version is incremented. With the expected version the update
+        is a compare-and-swap: it is applied only if the item was not
+        updated in the meantime.
+        :param item_id: The item ID
+        :param data: The fields to be updated
+        :param version: The expected item version (default: any)
+        :return: The updated item
+        :raise ItemNotFoundError: if there is no item with the given ID
+        :raise ItemVersionError: if the item version is not the expected one
+        :raise ValueError: if the item expiry is not valid
+        '''
+        with self._lock.writing():
+            self._before_write()
+            old = self.get(item_id)
+            if version is not None and old.version != version:
+                raise ItemVersionError(item_id, old.version)
+            item = old.replace(**data)
+            self._journal('update', item)
+            self._index[item_id] = item
+            self._stats.remove(old)
+            self._stats.add(item)
+            self._expiry.update(old, item)
+            self._names.update(old, item)
+            self._prices.update(old, item)
+            self._columns.update(item)
+            self._publish()
+            self.changes.append('update', item)
+        return item
+
+    def stats(self, now=None):
+        '''
+        Get the running aggregates of the items
+        :param now: The time to count the expired items (default: now)
+        :return: The aggregates, see ´ItemStats.to_dict´, and the count
+            of expired items
+        '''
+        with self._lock.reading():
+            res = self._stats.to_dict()
+            res['items_expired'] = self._expiry.count(now)
+        return res
+
+    def expired(self, now=None, flag=True):
+        '''
+        Get expired items
+        :param now: The time (default: now)
+        :param flag: Get the expired (default) or not expired items
+        :return: list of items ordered by expiry
+        '''
+        with self._lock.reading():
+            if flag:
+                ids = self._expiry.expired(now)
+            else:
+                ids = self._expiry.valid(now)
+            return [self._index[i] for i in ids]
+
+    def next_expire(self, now=None):
+        '''
+        Get the expiry key of the item to expire next
+        :param now: The time (default: now)
+        :return: The expiry key or ´None´ if no item is going to expire
+        '''
+        with self._lock.reading():
+            return self._expiry.next_expire(now)
+
+    def select(self, price_min=None, price_max=None, expired=None,
+               after=None, limit=None, now=None):
+        '''
+        Get a page of the items in the price range ordered by ID, see
+        ´query´
+        :return: tuple of the items and the cursor for the next page
+        '''
+        return self.query(price_min=price_min, price_max=price_max,
+                          expired=expired, after=after, limit=limit, now=now)
+
+    def query(self, name=None, name_prefix=None, price_min=None,
+              price_max=None, expire_min=None, expire_max=None, expired=None,
+              sort='id', order='asc', after=None, limit=None, now=None):
+        '''
+        Query the items. The ranges are inclusive and ´None´ is unbounded.
+
+        The query is served by the index with the smallest range, the other
+        conditions are checked on the items in the range only. If the
+        result is sorted by the key of that index it is read in order up
+        to the limit, otherwise the items in the range are sorted. Large
+        ranges ordered by ID are scanned in the columns instead.
+        :param name: The exact name
+        :param name_prefix: The name prefix
+        :param price_min: The minimal price
+        :param price_max: The maximal price
+        :param expire_min: The minimal expiry key, see ´expire_key´
+        :param expire_max: The maximal expiry key
+        :param expired: Only expired (´True´) or not expired (´False´)
+            items (default: all)
+        :param sort: The sort key, one of ´QUERY_SORT_KEYS´
+        :param order: The sort order ´asc´ or ´desc´
+        :param after: The cursor - ID of the last item of the previous page
+        :param limit: The maximal count of items (default: all)
+        :param now: The time to check the expiry (default: now)
+        :return: tuple of the items and the cursor for the next page,
+            the cursor is ´None´ if there are no more items
+        :raise ValueError: if the sort key or order is not valid
+        :raise ItemNotFoundError: if there is no item with the cursor ID
+        '''
+        if sort not in QUERY_SORT_KEYS:
+            raise ValueError('sort key %r not in %r' % (sort, QUERY_SORT_KEYS))
+        if order not in ('asc', 'desc'):
+            raise ValueError('sort order %r not in asc, desc' % order)
+        if expired is not None:
+            key = expire_key(now)
+            if expired:
+                expire_max = key if expire_max is None else min(expire_max, key)  # @IgnorePep8
+            else:
+                expire_min = key + 1 if expire_min is None else max(expire_min, key + 1)  # @IgnorePep8
+        if name is not None:
+            name_low = name_high = name
+        elif name_prefix is not None:
+            name_low, name_high = name_prefix, name_prefix + NAME_PREFIX_END
+        else:
+            name_low = name_high = None
+
+        def match(item):
+            return ((name_low is None or
+                     name_low <= _name_key(item) <= name_high) and
+                    (price_min is None or item.price >= price_min) and
+                    (price_max is None or item.price <= price_max) and
+                    (expire_min is None or item.expire_key >= expire_min) and
+                    (expire_max is None or item.expire_key <= expire_max))
+
+        desc = order == 'desc'
+        size = None if limit is None else limit + 1
+        with self._lock.reading():
+            # > index with the smallest range
+            ranges = []
+            if name_low is not None:
+                ranges.append(('name',) + self._names.between(name_low, name_high))  # @IgnorePep8
+            if price_min is not None or price_max is not None:
+                ranges.append(('price',) + self._prices.between(price_min, price_max))  # @IgnorePep8
+            if expire_min is not None or expire_max is not None:
+                ranges.append(('expire',) + self._expiry.between(expire_min, expire_max))  # @IgnorePep8
+            ranges.sort(key=lambda r: r[2] - r[1])
+            if sort == 'id' and not desc and name_low is None and ranges and \
+                    (ranges[0][2] - ranges[0][1]) * QUERY_SCAN_RATIO > len(self._ids):  # @IgnorePep8
+                ids, next_after = self._columns.select(
+                    price_min, price_max, expire_min, expire_max, after, limit)
+                return tuple(self._index[i] for i in ids), next_after
+            if ranges:
+                field, start, stop = ranges[0]
+            else:
+                field, start, stop = sort, 0, len(self._ids)
+            index = {'id': None, 'name': self._names, 'price': self._prices,
+                     'expire': self._expiry}[field]
+            key = _SORT_KEYS[sort]
+            cursor = None
+            if after is not None:
+                cursor = (after, after) if sort == 'id' else \
+                    (key(self.get(after)), after)
+            if field == sort:
+                # > read in order from the cursor
+                if index is None:
+                    keys = self._ids
+                    if cursor is not None and desc:
+                        stop = min(stop, bisect.bisect_left(keys, after))
+                    elif cursor is not None:
+                        start = max(start, bisect.bisect_right(keys, after))
+                    ids = (keys[i] for i in (range(stop - 1, start - 1, -1)
+                                             if desc else range(start, stop)))
+                else:
+                    if cursor is not None and desc:
+                        stop = min(stop, index.position(*cursor))
+                    elif cursor is not None:
+                        start = max(start, index.position(*cursor) + 1)
+                    ids = index.ids(start, max(start, stop), desc)
+                items = (self._index[i] for i in ids)
+                res = list(itertools.islice(filter(match, items), size))
+            else:
+                # > sort the items in the range
+                res = [item for item in
+                       (self._index[i] for i in index.ids(start, stop))
+                       if match(item)]
+                res.sort(key=lambda item: (key(item), item.id), reverse=desc)
+                if cursor is not None:
+                    res = [item for item in res
+                           if ((key(item), item.id) < cursor if desc else
+                               (key(item), item.id) > cursor)]
+                res = res[:size]
+        next_after = None
+        if limit is not None and len(res) > limit:
+            res = res[:limit]
+            next_after = res[-1].id
+        return tuple(res), next_after
+
+    def _get_snapshot(self):
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._lock.reading():
+                snapshot = self._snapshot
+                if snapshot is None:
+                    ids = tuple(self._ids)
+                    snapshot = (ids, tuple(self._index[i] for i in ids))
+                    self._snapshot = snapshot
+        return snapshot
+
+    def _load(self, items):
+        '''
+        Replace the store content by the items at once, much faster
+        than adding the items one by one
+        :param items: The items (records or dictionaries)
+        :raise ValueError: if an item expiry is not valid
+        '''
+        with self._lock.writing():
+            items = [mmshop.Item.coerce(item) for item in items]
+            for item in items:
+                item.version = item.version or 1
+            self._index = dict((item.id, item) for item in items)
+            self._ids = sorted(self._index)
+            self._next_id = self._ids[-1] + 1 if self._ids else 0
+            items = list(self._index.values())
+            self._stats.load(items)
+            self._expiry.load(items)
+            self._names.load(items)
+            self._prices.load(items)
+            self._columns.load([self._index[i] for i in self._ids])
+            self._publish()
+
+    def _before_write(self):
+        '''
+        Prepare the write operation, called once per operation by writers
+        holding the lock before anything is recorded or applied, so the
+        operation is not split by e.g. a log rotation. The in-memory store
+        does not need anything.
+        '''
+
+    def _journal(self, op, item):
+        '''
+        Record the write before it is applied, called by writers holding
+        the lock. Persistent stores override it, the in-memory store
+        does not record anything.
+        :param op: The operation ´add´ or ´update´
+        :param item: The new item
+        '''
+
+    def _publish(self):
+        # > called by writers holding the lock
+        self._version += 1
+        self._snapshot = None
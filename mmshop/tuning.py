@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# mmshop.tuning
+'''
+:author:  madkote
+:contact: madkote(at)bluewin.ch
+
+Server tuning
+-------------
+The module provides the performance profile of the HTTP server: the
+options of the command line and the configuration file, the adaptive
+thread pool and the statistics of the thread pool
+'''
+
+import cherrypy
+import cherrypy.lib.reprconf
+import cherrypy.process.plugins
+
+VERSION = (0, 1, 0)
+
+__all__ = ['PERFORMANCE_OPTIONS', 'THREAD_POOL_FREQUENCY',
+           'THREAD_POOL_GROWTH', 'ThreadPoolMonitor', 'load_config',
+           'pool_stats', 'tune_server']
+__author__ = 'madkote <madkote(at)bluewin.ch>'
+__version__ = '.'.join(str(x) for x in VERSION)
+
+# > command line options of the performance profile:
+#   (option, configuration key, type or value of a flag, help)
+PERFORMANCE_OPTIONS = (
+    ('--threads', 'server.thread_pool', int,
+     'Count of server threads (minimum of the adaptive pool)'),
+    ('--threads-max', 'server.thread_pool_max', int,
+     'Maximal count of server threads of the adaptive pool'),
+    ('--adaptive-threads', 'mmshop.adaptive_threads', True,
+     'Grow and shrink the thread pool with the queued connections'),
+    ('--socket-queue', 'server.socket_queue_size', int,
+     'Listen backlog of the server socket'),
+    ('--socket-timeout', 'server.socket_timeout', float,
+     'Timeout (seconds) of the client connections'),
+    ('--max-body', 'server.max_request_body_size', int,
+     'Maximal request body size (bytes), 0 for no limit'),
+    ('--keep-alive', 'mmshop.keep_alive', int,
+     'Maximal count of idle keep-alive connections, 0 disables keep-alive'),
+    ('--no-nodelay', 'server.nodelay', False,
+     'Do not disable the Nagle algorithm on the client connections'),
+)
+# > period (seconds) of the thread pool adaption
+THREAD_POOL_FREQUENCY = 1
+# > maximal threads of the adaptive pool per minimal threads if
+#   ´server.thread_pool_max´ is not set
+THREAD_POOL_GROWTH = 4
+
+
+# =============================================================================
+# CONFIGURATION
+# =============================================================================
+def load_config(filename):
+    '''
+    Load the configuration file. The file has the format of the CherryPy
+    configuration files, the entries of the ´[global]´ section are used:
+        [global]
+        server.thread_pool = 30
+        mmshop.store = 'sqlite:/var/lib/mmshop/mmshop.db'
+    :param filename: The configuration file
+    :return: The configuration entries
+    :raise ValueError: if the file can not be parsed
+    :raise OSError: if the file can not be read
+    '''
+    return dict(cherrypy.lib.reprconf.Parser().dict_from_file(filename).get('global', {}))  # @IgnorePep8
+
+
+def tune_server(config, bus=None, server=None):
+    '''
+    Apply the performance settings which CherryPy does not pass to the
+    HTTP server: the keep-alive limit (´mmshop.keep_alive´) and the
+    adaptive thread pool (´mmshop.adaptive_threads´). Call before the
+    server starts.
+    :param config: The configuration
+    :param bus: The engine (default: ´cherrypy.engine´)
+    :param server: The server (default: ´cherrypy.server´)
+    '''
+    bus = bus or cherrypy.engine
+    server = server or cherrypy.server
+    keep_alive = config.get('mmshop.keep_alive')
+    if keep_alive is not None:
+        def apply_keep_alive():
+            server.httpserver.keep_alive_conn_limit = keep_alive
+        # > after the server is created, see ´cherrypy.server.start´
+        bus.subscribe('start', apply_keep_alive, priority=80)
+    if config.get('mmshop.adaptive_threads'):
+        if server.thread_pool_max is None or server.thread_pool_max <= 0:
+            server.thread_pool_max = THREAD_POOL_GROWTH * server.thread_pool
+        ThreadPoolMonitor(bus, server).subscribe()
+
+
+# =============================================================================
+# THREAD POOL
+# =============================================================================
+def _pool(server):
+    httpserver = server.httpserver
+    return getattr(httpserver, 'requests', None) if httpserver else None
+
+
+def _queued(pool):
+    # > the queue holds the shutdown requests of the shrinking pool too
+    return max(pool.qsize - len(pool._pending_shutdowns), 0)
+
+
+def pool_stats(server=None):
+    '''
+    Get the statistics of the server thread pool
+    :param server: The server (default: ´cherrypy.server´)
+    :return: The count of threads, of idle threads, the bounds of the
+        pool and the count of queued connections, empty if the server
+        is not running
+    '''
+    pool = _pool(server or cherrypy.server)
+    if pool is None:
+        return {}
+    # > the shut down threads are removed from the pool on the next shrink
+    return {'threads': sum(1 for t in pool._threads if t.is_alive()),
+            'threads_idle': pool.idle,
+            'threads_min': pool.min,
+            'threads_max': pool.max,
+            'queue': _queued(pool)}
+
+
+class ThreadPoolMonitor(cherrypy.process.plugins.Monitor):
+    '''
+    Adaptive thread pool of the HTTP server.
+
+    Periodically the pool grows by the count of the connections waiting
+    for a thread (up to ´server.thread_pool_max´) or, if none is waiting,
+    it shrinks by half of the idle threads (down to ´server.thread_pool´).
+    The pool follows the load without keeping the threads for the peak
+    load all the time.
+    '''
+    def __init__(self, bus, server=None, frequency=THREAD_POOL_FREQUENCY):
+        '''
+        :param bus: The engine
+        :param server: The server (default: ´cherrypy.server´)
+        :param frequency: The period (seconds) of the adaption
+        '''
+        super(ThreadPoolMonitor, self).__init__(bus, self.adapt, frequency,
+                                                name='ThreadPoolMonitor')
+        self.server = server or cherrypy.server
+
+    def adapt(self):
+        '''
+        Grow or shrink the thread pool
+        '''
+        pool = _pool(self.server)
+        if pool is None:
+            return
+        queued = _queued(pool)
+        if queued:
+            pool.grow(queued)
+        else:
+            idle = pool.idle
+            if idle > 1:
+                pool.shrink(idle // 2)
@@ -11,8 +11,21 @@ Test module for the Mickey Mouse shop
 '''
 
 import cherrypy
+import datetime
+import gzip
 import json
+import math
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import urllib.error
 import urllib.request
 
 import mmshop
@@ -35,7 +48,9 @@ class _TestWebApp(unittest.TestCase):
         config = dict(mmshop.API_CONFIG)
         cherrypy.config.update(config)
         cherrypy.engine.autoreload.unsubscribe()
-        cherrypy.tree.mount(app(), script_name)
+        root = app(flag_static=True)
+        cherrypy.engine.subscribe('stop', root.store.changes.wakeup)
+        cherrypy.tree.mount(root, script_name)
         cherrypy.server.unsubscribe()
         cherrypy.engine.start()
         cherrypy.server.start()
@@ -71,7 +86,7 @@ class _TestWebApp(unittest.TestCase):
         req = urllib.request.Request(self.url + path)
         req_data = None
         if data is not None:
-            if isinstance(data, dict):
+            if isinstance(data, (dict, list)):
                 req.add_header('Content-Type',
                                'application/json; charset=utf-8')
                 req_data = json.dumps(data)
@@ -129,6 +144,14 @@ class TestWebMickeyMouseShop(_TestWebApp):
                         'item data wrong: %s :: %s' % (got, exp))
 
     def test_003_item_new(self):
+        # > IDs out of the 64-bit range are rejected before the store
+        try:
+            self.webapp_request('/item', method='POST',
+                                data={'id': 10 ** 20, 'name': 'big'})
+            got = 201
+        except urllib.error.HTTPError as e:
+            got = e.code
+        self.assertTrue(got == 404, 'bad status: %s' % got)
         item_new = {'name': 'banana', 'price': 0.29}
         response = self.webapp_request('/item', method='POST', data=item_new)
         # status
@@ -168,10 +191,489 @@ class TestWebMickeyMouseShop(_TestWebApp):
         data = json.loads(response.read().decode())
         got = data
         exp = {'items_count': 4,
-               'items_value': 18.28}
+               'items_value': 18.28,
+               'items_price_min': 1.25,
+               'items_price_max': 10.99,
+               'items_expired': 4}
+        got = dict((k, got.get(k)) for k in exp)
         self.assertTrue(got == exp,
                         'stats wrong: got[%s] :: exp[%s]' % (got, exp))
 
+    def test_007_item_page(self):
+        response = self.webapp_request('/item?limit=2&after=0')
+        # data
+        data = json.loads(response.read().decode())
+        got = [i['id'] for i in data]
+        exp = [1, 2]
+        self.assertTrue(got == exp,
+                        'items page wrong: %s :: %s' % (got, exp))
+        got = response.headers.get('X-Next-After')
+        exp = '2'
+        self.assertTrue(got == exp,
+                        'next cursor wrong: %s :: %s' % (got, exp))
+
+    def test_008_item_stream(self):
+        response = self.webapp_request('/item')
+        exp = json.loads(response.read().decode())
+        response = self.webapp_request('/item?stream=json')
+        got = json.loads(response.read().decode())
+        self.assertTrue(got == exp,
+                        'streamed items wrong: %s :: %s' % (got, exp))
+        response = self.webapp_request('/item?stream=ndjson')
+        got = [json.loads(line) for line in
+               response.read().decode().splitlines()]
+        self.assertTrue(got == exp,
+                        'streamed items wrong: %s :: %s' % (got, exp))
+
+    def test_009_monitor_cached(self):
+        response = self.webapp_request('/monitor')
+        # status
+        got = response.status
+        exp = 200
+        self.assertTrue(got == exp, 'bad status: %s' % response.status)
+        etag = response.headers.get('ETag')
+        self.assertTrue(etag, 'ETag expected')
+        # not modified
+        try:
+            response = self.webapp_request('/monitor',
+                                           header=[('If-None-Match', etag)])
+        except urllib.error.HTTPError as e:
+            got = e.code
+        else:
+            got = response.status
+        exp = 304
+        self.assertTrue(got == exp, 'bad status: %s' % got)
+
+    def test_010_image_cached(self):
+        response = self.webapp_request('/image/0')
+        got = (response.status, len(response.read()) > 0)
+        exp = (200, True)
+        self.assertTrue(got == exp, 'bad response: %s' % (got,))
+        etag = response.headers.get('ETag')
+        modified = response.headers.get('Last-Modified')
+        for header in [('If-None-Match', etag),
+                       ('If-Modified-Since', modified)]:
+            try:
+                response = self.webapp_request('/image/0', header=[header])
+            except urllib.error.HTTPError as e:
+                got = e.code
+            else:
+                got = response.status
+            exp = 304
+            self.assertTrue(got == exp, 'bad status: %s' % got)
+
+    def test_011_image_range(self):
+        response = self.webapp_request('/image/0')
+        data = response.read()
+        response = self.webapp_request('/image/0',
+                                       header=[('Range', 'bytes=10-19')])
+        got = (response.status, response.read())
+        exp = (206, data[10:20])
+        self.assertTrue(got == exp, 'bad response: %s' % (got,))
+
+    def test_012_item_concurrent(self):
+        # hammer the service from many threads
+        threads_count = 8
+        requests_count = 10
+        errors = []
+        # > other tests add items too, count the new ones only
+        response = self.webapp_request('/item')
+        count = len(json.loads(response.read().decode()))
+
+        def worker(n):
+            try:
+                for i in range(requests_count):
+                    self.webapp_request('/item', method='POST',
+                                        data={'name': 'item-%s-%s' % (n, i),
+                                              'price': 1.0})
+                    self.webapp_request('/item').read()
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=worker, args=(n,))
+                   for n in range(threads_count)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertFalse(errors, 'requests failed: %s' % errors)
+        # data
+        response = self.webapp_request('/item')
+        data = json.loads(response.read().decode())
+        ids = [i['id'] for i in data]
+        got = len(set(ids))
+        exp = count + threads_count * requests_count
+        self.assertTrue(got == exp and len(ids) == exp,
+                        'items count wrong: %s :: %s' % (got, exp))
+
+    def test_013_item_expired(self):
+        response = self.webapp_request('/item?expired=false')
+        data = json.loads(response.read().decode())
+        got = len(data)
+        exp = 0
+        self.assertTrue(got == exp,
+                        'items count wrong: %s :: %s' % (got, exp))
+
+    def test_014_item_bulk(self):
+        items = [{'name': 'apple', 'price': 0.5},
+                 {'name': 'pear', 'price': '0.7'},
+                 {'id': 0, 'name': 'cheese', 'price': 1.0},
+                 {'name': 'plum'}]
+        response = self.webapp_request('/item/_bulk', method='POST',
+                                       data=items)
+        # data
+        data = json.loads(response.read().decode())
+        got = (data['created'], data['failed'],
+               [i['status'] for i in data['results']])
+        exp = (2, 2, [201, 201, 409, 404])
+        self.assertTrue(got == exp,
+                        'bulk result wrong: %s :: %s' % (got, exp))
+        got = data['results'][3]['error']
+        exp = 'Price field in the entity must be defined'
+        self.assertTrue(got == exp, 'bulk error wrong: %s :: %s' % (got, exp))
+        # > ´Allow´ of the bulk path lists the methods routed for it
+        try:
+            self.webapp_request('/item/_bulk')
+        except urllib.error.HTTPError as e:
+            got = (e.code, e.headers.get('Allow'))
+        exp = (405, 'POST')
+        self.assertTrue(got == exp, 'bad status: %s :: %s' % (got, exp))
+        response = self.webapp_request('/item/0', method='HEAD')
+        got = (response.status, response.read())
+        exp = (200, b'')
+        self.assertTrue(got == exp, 'bad status: %s :: %s' % (got, exp))
+        item_id = data['results'][1]['id']
+        response = self.webapp_request('/item/%s' % item_id)
+        got = json.loads(response.read().decode())['price']
+        exp = 0.7
+        self.assertTrue(got == exp, 'item wrong: %s :: %s' % (got, exp))
+        # > the missing IDs do not collide with the given IDs
+        response = self.webapp_request('/item')
+        item_id = max(i['id'] for i in json.loads(response.read().decode()))
+        items = [{'name': 'fig', 'price': 0.3},
+                 {'id': item_id + 1, 'name': 'kiwi', 'price': 0.4}]
+        response = self.webapp_request('/item/_bulk', method='POST',
+                                       data=items)
+        data = json.loads(response.read().decode())
+        got = [i['status'] for i in data['results']]
+        exp = [201, 201]
+        self.assertTrue(got == exp and data['results'][0]['id'] > item_id + 1,
+                        'bulk result wrong: %s' % data)
+
+    def test_015_item_price_range(self):
+        response = self.webapp_request('/item')
+        items = json.loads(response.read().decode())
+        exp = [i['id'] for i in items if 1.0 <= i['price'] <= 5.0][:3]
+        response = self.webapp_request('/item?price_min=1&price_max=5&limit=3')
+        got = [i['id'] for i in json.loads(response.read().decode())]
+        self.assertTrue(got == exp,
+                        'items in range wrong: %s :: %s' % (got, exp))
+        got = response.headers.get('X-Next-After')
+        exp = str(exp[-1])
+        self.assertTrue(got == exp,
+                        'next cursor wrong: %s :: %s' % (got, exp))
+
+    def test_016_item_query(self):
+        response = self.webapp_request('/item')
+        items = json.loads(response.read().decode())
+        exp = sorted((i for i in items if i['name'].startswith('c')),
+                     key=lambda i: (-i['price'], -i['id']))
+        exp = [i['id'] for i in exp]
+        got = []
+        path = '/item?name_prefix=c&sort=price&order=desc&limit=1'
+        while True:
+            response = self.webapp_request(path)
+            got.extend(i['id'] for i in json.loads(response.read().decode()))
+            after = response.headers.get('X-Next-After')
+            if after is None:
+                break
+            path = '/item?name_prefix=c&sort=price&order=desc&limit=1' \
+                '&after=%s' % after
+        self.assertTrue(got == exp,
+                        'items query wrong: %s :: %s' % (got, exp))
+        try:
+            self.webapp_request('/item?sort=weight')
+        except urllib.error.HTTPError as e:
+            got = e.code
+        exp = 404
+        self.assertTrue(got == exp, 'bad status: %s' % got)
+
+    def test_017_item_field(self):
+        response = self.webapp_request('/item', method='POST',
+                                       data={'name': 'kiwi', 'price': 0.4})
+        item_id = json.loads(response.read().decode())['id']
+        path = '/item/%s/price' % item_id
+        response = self.webapp_request(path, method='PUT', data='0.45')
+        got = json.loads(response.read().decode())
+        exp = 0.45
+        self.assertTrue(got == exp, 'field wrong: %s :: %s' % (got, exp))
+        response = self.webapp_request('/item/%s/name' % item_id)
+        got = json.loads(response.read().decode())
+        exp = 'kiwi'
+        self.assertTrue(got == exp, 'field wrong: %s :: %s' % (got, exp))
+        for path, method, data, exp in (
+                ('/item/%s/expire' % item_id, 'GET', '1.0', 404),
+                ('/item/%s/price' % item_id, 'POST', '1.0', 405),
+                ('/item/%s/price' % item_id, 'PUT', '"nan"', 404),
+                ('/item/%s/price' % item_id, 'PUT', 'NaN', 404),
+                ('/item/%s/price' % item_id, 'PUT', '"-inf"', 404),
+                ('/item/%s/price' % item_id, 'PUT', 'abc', 400)):
+            try:
+                response = self.webapp_request(path, method=method, data=data)
+            except urllib.error.HTTPError as e:
+                got = e.code
+            else:
+                got = response.status
+            self.assertTrue(got == exp, 'bad status: %s' % got)
+
+    def test_018_item_patch(self):
+        response = self.webapp_request('/item', method='POST',
+                                       data={'name': 'lime', 'price': 0.3})
+        item_id = json.loads(response.read().decode())['id']
+        path = '/item/%s' % item_id
+        response = self.webapp_request(path, method='PATCH',
+                                       data={'price': '0.35'})
+        etag = response.headers.get('ETag')
+        got = (json.loads(response.read().decode()), etag)
+        exp = ({'id': item_id, 'name': 'lime', 'price': 0.35}, '"2"')
+        self.assertTrue(got == exp, 'item wrong: %s :: %s' % (got, exp))
+        response = self.webapp_request(path, method='PATCH',
+                                       data={'price': 0.4},
+                                       header=[('If-Match', etag)])
+        got = response.headers.get('ETag')
+        exp = '"3"'
+        self.assertTrue(got == exp, 'ETag wrong: %s :: %s' % (got, exp))
+        for data, exp in (({'price': 0.5}, 412), ({'price': 'cheap'}, 404),
+                          ({'price': float('nan')}, 404), ({}, 400),
+                          ('abc', 400)):
+            try:
+                response = self.webapp_request(path, method='PATCH',
+                                               data=data,
+                                               header=[('If-Match', etag)])
+            except urllib.error.HTTPError as e:
+                got = e.code
+            else:
+                got = response.status
+            self.assertTrue(got == exp, 'bad status: %s' % got)
+
+    def test_019_item_etag(self):
+        response = self.webapp_request('/item', method='POST',
+                                       data={'name': 'plum', 'price': 0.6})
+        item_id = json.loads(response.read().decode())['id']
+        path = '/item/%s' % item_id
+        etag = self.webapp_request(path).headers.get('ETag')
+        self.assertTrue(etag == '"1"', 'bad ETag: %s' % etag)
+        try:
+            response = self.webapp_request(path,
+                                           header=[('If-None-Match', etag)])
+        except urllib.error.HTTPError as e:
+            got = e.code
+        else:
+            got = response.status
+        exp = 304
+        self.assertTrue(got == exp, 'bad status: %s' % got)
+        # concurrent updates with the same version
+        got = []
+        for price in (0.7, 0.8):
+            try:
+                response = self.webapp_request(
+                    path, method='PUT', data={'price': price},
+                    header=[('If-Match', etag)])
+            except urllib.error.HTTPError as e:
+                got.append(e.code)
+            else:
+                got.append((response.status, response.headers.get('ETag')))
+        exp = [(200, '"2"'), 412]
+        self.assertTrue(got == exp, 'bad status: %s :: %s' % (got, exp))
+
+    def test_020_changes(self):
+        # > short heartbeat ends the stream soon after the client is gone
+        heartbeat = mmshop.api.CHANGES_HEARTBEAT
+        mmshop.api.CHANGES_HEARTBEAT = 0.1
+        try:
+            response = self.webapp_request('/changes')
+        finally:
+            mmshop.api.CHANGES_HEARTBEAT = heartbeat
+        got = response.headers.get('Content-Type')
+        self.assertTrue(got.startswith('text/event-stream'),
+                        'bad content type: %s' % got)
+        self.assertTrue(response.readline() == b'retry: 3000\n')
+        self.webapp_request('/item', method='POST',
+                            data={'name': 'fig', 'price': 1.1})
+        event = {}
+        while 'data' not in event:
+            line = response.readline().decode().rstrip('\n')
+            if line and not line.startswith(':'):
+                k, v = line.split(': ', 1)
+                event[k] = v
+        response.close()
+        got = (event['event'], json.loads(event['data'])['item']['name'])
+        exp = ('create', 'fig')
+        self.assertTrue(got == exp, 'bad event: %s :: %s' % (got, exp))
+
+    def test_021_item_since(self):
+        seq = int(self.webapp_request('/item').headers.get('X-Changes-Seq'))
+        timer = threading.Timer(0.1, self.webapp_request, ('/item',),
+                                {'method': 'POST',
+                                 'data': {'name': 'kiwi', 'price': 0.4}})
+        timer.start()
+        response = self.webapp_request('/item?since=%s&wait=10' % seq)
+        timer.join()
+        data = json.loads(response.read().decode())
+        got = [(c['seq'], c['op'], c['item']['name'])
+               for c in data['changes']] + [data['seq']]
+        exp = [(seq + 1, 'create', 'kiwi'), seq + 1]
+        self.assertTrue(got == exp, 'bad changes: %s :: %s' % (got, exp))
+        try:
+            response = self.webapp_request('/item?since=%s' % (seq + 1000))
+        except urllib.error.HTTPError as e:
+            got = e.code
+        else:
+            got = response.status
+        exp = 410
+        self.assertTrue(got == exp, 'bad status: %s' % got)
+
+    def test_022_changes_busy(self):
+        root = cherrypy.tree.apps[mmshop.API_URL].root
+
+        def wait_released():
+            # > closed streams give their threads back
+            for _ in range(50):
+                if not root._waiting:
+                    return
+                time.sleep(0.1)
+            self.fail('change feed threads not released')
+        wait_released()
+        # > short heartbeat ends the streams soon after the client is gone
+        heartbeat = mmshop.api.CHANGES_HEARTBEAT
+        mmshop.api.CHANGES_HEARTBEAT = 0.1
+        streams = []
+        try:
+            limit = int(cherrypy.server.thread_pool *
+                        mmshop.api.CHANGES_WAITING_SHARE)
+            for _ in range(limit):
+                streams.append(self.webapp_request('/changes'))
+            try:
+                streams.append(self.webapp_request('/changes'))
+            except urllib.error.HTTPError as e:
+                got = (e.code, e.headers.get('Retry-After'))
+            else:
+                got = (streams[-1].status, None)
+            exp = (503, '3')
+            self.assertTrue(got == exp, 'bad status: %s' % (got,))
+            # > the API is served while the streams are open
+            start = time.time()
+            response = self.webapp_request('/item?since=0&wait=10')
+            got = (response.status, response.headers.get('Retry-After'))
+            exp = (200, '3')
+            self.assertTrue(got == exp and time.time() - start < 1,
+                            'bad response: %s' % (got,))
+            for _ in range(limit):
+                self.webapp_request('/item').read()
+        finally:
+            mmshop.api.CHANGES_HEARTBEAT = heartbeat
+            for response in streams:
+                response.close()
+        wait_released()
+
+    def test_023_compress(self):
+        plain = self.webapp_request('/monitor').read()
+        got = []
+        for _ in range(2):
+            response = self.webapp_request(
+                '/monitor', header=[('Accept-Encoding', 'gzip')])
+            got.append((response.headers.get('Content-Encoding'),
+                        response.headers.get('Vary'),
+                        gzip.decompress(response.read()) == plain))
+        exp = [('gzip', 'Accept-Encoding', True)] * 2
+        self.assertTrue(got == exp, 'bad response: %s :: %s' % (got, exp))
+        # > the compressed body has its own ETag, both are validated
+        etag = self.webapp_request('/monitor').headers.get('ETag')
+        etag_gzip = response.headers.get('ETag')
+        got = []
+        for tag, encoding in ((etag, 'identity'), (etag_gzip, 'gzip'),
+                              (etag_gzip, 'identity')):
+            try:
+                self.webapp_request('/monitor',
+                                    header=[('Accept-Encoding', encoding),
+                                            ('If-None-Match', tag)])
+            except urllib.error.HTTPError as e:
+                got.append((e.code, e.headers.get('ETag')))
+        exp = [(304, etag), (304, etag_gzip), (304, etag)]
+        self.assertTrue(etag_gzip == etag[:-1] + '-gzip"' and got == exp,
+                        'bad validation: %s :: %s' % (got, exp))
+        # > small responses are not compressed
+        response = self.webapp_request('/stats',
+                                       header=[('Accept-Encoding', 'gzip')])
+        got = response.headers.get('Content-Encoding')
+        self.assertTrue(got is None, 'bad encoding: %s' % got)
+
+    def test_024_cache_policy(self):
+        got = []
+        for path, method, data in (('/item', 'GET', None),
+                                   ('/item', 'POST', {'name': 'pear',
+                                                      'price': 0.9}),
+                                   ('/img/check.svg', 'GET', None),
+                                   ('/item?since=0', 'GET', None)):
+            response = self.webapp_request(path, method=method, data=data)
+            got.append(response.headers.get('Cache-Control'))
+        exp = ['no-cache', 'no-store', mmshop.API_STATIC_CACHE_CONTROL,
+               'no-store']
+        self.assertTrue(got == exp, 'bad policy: %s :: %s' % (got, exp))
+        # > shared static assets do not set the session cookie, errors are
+        #   not stored
+        got = []
+        for path in ('/mmshop.html', '/img/check.svg', '/nonexistent.png',
+                     '/item/999999'):
+            try:
+                response = self.webapp_request(path)
+            except urllib.error.HTTPError as e:
+                response = e
+            got.append((response.status, response.headers.get('Cache-Control'),
+                        response.headers.get('Set-Cookie')))
+        exp = [(200, mmshop.API_STATIC_CACHE_CONTROL, None)] * 2 + \
+            [(404, 'no-store', None)] * 2
+        self.assertTrue(got == exp, 'bad policy: %s :: %s' % (got, exp))
+        # > nor do the shared API responses
+        got = [self.webapp_request(path).headers.get('Set-Cookie')
+               for path in ('/', '/monitor', '/item', '/item/0', '/stats')]
+        exp = [None] * 5
+        self.assertTrue(got == exp, 'cookies set: %s' % got)
+        # > item lists are validated with ETag
+        etag = self.webapp_request('/item').headers.get('ETag')
+        try:
+            response = self.webapp_request('/item',
+                                           header=[('If-None-Match', etag)])
+        except urllib.error.HTTPError as e:
+            got = e.code
+        else:
+            got = response.status
+        exp = 304
+        self.assertTrue(got == exp, 'bad status: %s' % got)
+
+    def test_025_server_pool(self):
+        response = self.webapp_request('/server')
+        res = json.loads(response.read().decode('utf-8'))
+        got = (sorted(res), res['threads_min'],
+               response.headers.get('Cache-Control'))
+        exp = (['queue', 'threads', 'threads_idle', 'threads_max',
+                'threads_min'], cherrypy.server.thread_pool, 'no-cache')
+        self.assertTrue(got == exp, 'bad pool: %s :: %s' % (got, exp))
+        # > the idle pool shrinks down to the minimum
+        pool = cherrypy.server.httpserver.requests
+        size = len(pool._threads)
+        pool.min = 2
+        try:
+            mmshop.ThreadPoolMonitor(cherrypy.engine).adapt()
+            for _ in range(50):
+                if mmshop.pool_stats()['threads'] < size:
+                    break
+                time.sleep(0.1)
+            got = mmshop.pool_stats()['threads']
+            self.assertTrue(got < size, 'pool not shrunk: %s' % got)
+        finally:
+            pool.min = size
+            pool.grow(size)
+
 
 class TestMickeyMouseShop(unittest.TestCase):
     # run tests on the service as object
@@ -213,6 +715,679 @@ class TestMickeyMouseShop(unittest.TestCase):
     def test_200_stats(self):
         pass
 
+    def test_210_load_config(self):
+        filename = os.path.join(tempfile.mkdtemp(), 'mmshop.conf')
+        try:
+            with open(filename, 'w') as f:
+                f.write('[global]\n'
+                        'server.thread_pool = 30\n'
+                        'server.socket_timeout = 2.5\n'
+                        'mmshop.adaptive_threads = True\n')
+            res = mmshop.load_config(filename)
+        finally:
+            shutil.rmtree(os.path.dirname(filename))
+        exp = {'server.thread_pool': 30, 'server.socket_timeout': 2.5,
+               'mmshop.adaptive_threads': True}
+        self.assertTrue(res == exp, '%s expected, but %s got' % (exp, res))
+
+
+class TestItemStore(unittest.TestCase):
+    # run tests on the item store
+    def test_300_store_get(self):
+        store = mmshop.ItemStore([{'id': 5, 'name': 'tea', 'price': 1.0}])
+        res = store.get(5)['name']
+        exp = 'tea'
+        self.assertTrue(res == exp, '%s expected, but %s got' % (exp, res))
+        self.assertRaises(mmshop.ItemNotFoundError, store.get, 6)
+
+    def test_301_store_add(self):
+        store = mmshop.ItemStore([{'id': 5, 'name': 'tea', 'price': 1.0}])
+        res = store.add({'name': 'coffee', 'price': 2.0})['id']
+        exp = 6
+        self.assertTrue(res == exp, '%s expected, but %s got' % (exp, res))
+        self.assertRaises(mmshop.ItemExistsError, store.add,
+                          {'id': 5, 'name': 'water', 'price': 0.5})
+
+    def test_302_store_snapshot(self):
+        store = mmshop.ItemStore([{'id': 5, 'name': 'tea', 'price': 1.0}])
+        snapshot = store.items()
+        store.update(5, {'price': 2.0})
+        res = (snapshot[0]['price'], store.get(5)['price'])
+        exp = (1.0, 2.0)
+        self.assertTrue(res == exp, '%s expected, but %s got' % (exp, res))
+
+    def test_303_store_stats(self):
+        store = mmshop.ItemStore([
+            {'id': 0, 'name': 'tea', 'price': 0.1, 'expire': '201701010000'},
+            {'id': 1, 'name': 'coffee', 'price': 0.2,
+             'expire': '201901010000'}])
+        store.add({'name': 'water', 'price': 0.7})
+        store.update(1, {'price': 0.3})
+        now = datetime.datetime(2018, 1, 1)
+        res = store.stats(now)
+        exp = {'items_count': 3,
+               'items_value': math.fsum([0.1, 0.3, 0.7]),
+               'items_price_min': 0.1,
+               'items_price_max': 0.7,
+               'items_expired': 2}
+        res = dict((k, res[k]) for k in exp)
+        self.assertTrue(res == exp, '%s expected, but %s got' % (exp, res))
+
+    def test_304_store_concurrent(self):
+        store = mmshop.ItemStore()
+
+        def worker():
+            for i in range(200):
+                store.add({'name': 'x', 'price': 1.0})
+                store.items()
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        res = sorted(i['id'] for i in store.items())
+        exp = list(range(8 * 200))
+        self.assertTrue(res == exp, 'duplicate or missing IDs')
+
+    def test_305_store_expired(self):
+        store = mmshop.ItemStore([
+            {'id': 0, 'name': 'tea', 'price': 0.1, 'expire': '201901010000'},
+            {'id': 1, 'name': 'coffee', 'price': 0.2,
+             'expire': '201701010000'},
+            {'id': 2, 'name': 'water', 'price': 0.7}])
+        now = datetime.datetime(2018, 1, 1)
+        res = [i['id'] for i in store.expired(now)]
+        exp = [2, 1]
+        self.assertTrue(res == exp, '%s expected, but %s got' % (exp, res))
+        res = [i['id'] for i in store.expired(now, flag=False)]
+        exp = [0]
+        self.assertTrue(res == exp, '%s expected, but %s got' % (exp, res))
+        res = store.next_expire(now)
+        exp = 201901010000
+        self.assertTrue(res == exp, '%s expected, but %s got' % (exp, res))
+        self.assertRaises(ValueError, mmshop.parse_expire, '201913010000')
+
+    def test_306_store_wal(self):
+        path = tempfile.mkdtemp()
+        try:
+            store = mmshop.open_store('wal:%s' % path,
+                                      [{'id': 0, 'name': 'tea', 'price': 1.0}])
+            store.snapshot_every = 2
+            for i in range(5):
+                store.add({'name': 'coffee', 'price': 2.0})
+            store.update(0, {'price': 1.5})
+            store.close()
+            # recover
+            store = mmshop.open_store('wal:%s' % path)
+            res = (len(store), store.get(0)['price'], store.next_id())
+            exp = (6, 1.5, 6)
+            store.close()
+            self.assertTrue(res == exp,
+                            '%s expected, but %s got' % (exp, res))
+        finally:
+            shutil.rmtree(path)
+
+    def test_307_store_sqlite(self):
+        path = tempfile.mkdtemp()
+        try:
+            spec = 'sqlite:%s' % os.path.join(path, 'mmshop.db')
+            store = mmshop.open_store(spec,
+                                      [{'id': 0, 'name': 'tea', 'price': 1.0}])
+            for i in range(5):
+                store.add({'name': 'coffee', 'price': 2.0})
+            store.update(0, {'price': 1.5})
+            self.assertRaises(mmshop.ItemExistsError, store.add,
+                              {'id': 1, 'name': 'water', 'price': 0.5})
+            store.close()
+            # reopen
+            store = mmshop.open_store(spec)
+            items, next_after = store.page(after=1, limit=2)
+            res = (len(store), store.get(0)['price'], store.next_id(),
+                   [i['id'] for i in items], next_after,
+                   store.stats()['items_value'])
+            exp = (6, 1.5, 6, [2, 3], 3, 11.5)
+            store.close()
+            self.assertTrue(res == exp,
+                            '%s expected, but %s got' % (exp, res))
+        finally:
+            shutil.rmtree(path)
+
+    def test_308_select(self):
+        items = [{'id': i, 'name': 'item', 'price': float(i),
+                  'expire': '2019010%s0000' % (1 + i % 2)} for i in range(10)]
+        path = tempfile.mkdtemp()
+        try:
+            spec = 'sqlite:%s' % os.path.join(path, 'mmshop.db')
+            shm = 'shm:%s' % os.path.join(path, 'mmshop.shm')
+            for store in (mmshop.ItemStore(items),
+                          mmshop.open_store(spec, items),
+                          mmshop.open_store(shm, items)):
+                now = datetime.datetime(2019, 1, 1, 12, 0)
+                store.update(4, {'price': 9.5})
+                page, next_after = store.select(2.0, 8.0, limit=3)
+                expired, _ = store.select(price_min=5.0, expired=True,
+                                          now=now)
+                stats = store.stats()
+                res = ([i['id'] for i in page], next_after,
+                       [i['id'] for i in expired], stats['items_price_p50'],
+                       stats['items_price_p90'])
+                exp = ([2, 3, 5], 5, [4, 6, 8], 5.5, 9.05)
+                store.close()
+                self.assertTrue(res == exp,
+                                '%s expected, but %s got' % (exp, res))
+        finally:
+            shutil.rmtree(path)
+
+    def test_309_query(self):
+        names = ['apple', 'apricot', 'banana', 'cheese', 'cherry']
+        items = [{'id': i, 'name': names[i % 5], 'price': float(i % 7),
+                  'expire': '20190%s010000' % (1 + i % 9)} for i in range(50)]
+        path = tempfile.mkdtemp()
+        try:
+            spec = 'sqlite:%s' % os.path.join(path, 'mmshop.db')
+            shm = 'shm:%s' % os.path.join(path, 'mmshop.shm')
+            for store in (mmshop.ItemStore(items),
+                          mmshop.open_store(spec, items),
+                          mmshop.open_store(shm, items)):
+                by_name, _ = store.query(name='cherry', sort='price',
+                                         order='desc', limit=3)
+                by_prefix, next_after = store.query(
+                    name_prefix='ap', price_max=2.0, sort='expire', limit=2)
+                page, _ = store.query(name_prefix='ap', price_max=2.0,
+                                      sort='expire', after=next_after)
+                res = ([i['id'] for i in by_name],
+                       [i['id'] for i in by_prefix + page])
+                exp = ([34, 19, 39], [0, 36, 1, 21, 30, 15, 16, 35])
+                store.close()
+                self.assertTrue(res == exp,
+                                '%s expected, but %s got' % (exp, res))
+        finally:
+            shutil.rmtree(path)
+
+    def test_310_serializer(self):
+        store = mmshop.ItemStore([{'id': 5, 'name': 'tea', 'price': 1.0}])
+        serializer = mmshop.ItemSerializer()
+        data = serializer.encode_items(store.items())
+        self.assertTrue(serializer.encode_item(store.get(5)) is
+                        serializer.encode_item(store.get(5)),
+                        'encoded item is not cached')
+        store.update(5, {'price': 2.0})
+        res = (json.loads(data.decode())[0]['price'],
+               json.loads(serializer.encode_item(store.get(5)))['price'])
+        exp = (1.0, 2.0)
+        self.assertTrue(res == exp, '%s expected, but %s got' % (exp, res))
+        # > the cache is bounded, or disabled
+        store = mmshop.ItemStore([{'name': 'tea', 'price': 1.0}] * 100)
+        for cache_size, cached in ((256, range(1, 10)), (0, [0])):
+            serializer = mmshop.ItemSerializer(cache_size=cache_size)
+            data = serializer.encode_items(store.items())
+            res = (len(serializer) in cached, len(json.loads(data.decode())))
+            exp = (True, 100)
+            self.assertTrue(res == exp, '%s: %s expected, but %s got' %
+                            (cache_size, exp, res))
+
+    def test_311_item_record(self):
+        item = mmshop.Item.from_dict({'id': 1, 'name': 'tea', 'price': 1.0,
+                                      'expire': '203001010000', 'tag': 'x'})
+        self.assertFalse(hasattr(item, '__dict__'), 'item has a dictionary')
+        new = item.replace(price=2.0)
+        res = (item['price'], new['price'], new.expire_key, new['tag'],
+               'expire' in mmshop.Item(1, 'tea', 1.0), new.to_dict())
+        exp = (1.0, 2.0, 203001010000, 'x', False,
+               {'id': 1, 'name': 'tea', 'price': 2.0,
+                'expire': '203001010000', 'tag': 'x'})
+        self.assertTrue(res == exp, '%s expected, but %s got' % (exp, res))
+        with self.assertRaises(ValueError):
+            item.replace(expire='2030')
+
+    def test_312_item_version(self):
+        path = tempfile.mkdtemp()
+        try:
+            for spec in (None, 'wal:%s' % os.path.join(path, 'wal'),
+                         'sqlite:%s' % os.path.join(path, 'mmshop.db'),
+                         'shm:%s' % os.path.join(path, 'mmshop.shm')):
+                store = mmshop.open_store(spec)
+                store.add({'id': 0, 'name': 'tea', 'price': 1.0})
+                store.update(0, {'price': 1.5}, version=1)
+                self.assertRaises(mmshop.ItemVersionError, store.update,
+                                  0, {'price': 2.0}, version=1)
+                if spec is not None:
+                    store.close()
+                    store = mmshop.open_store(spec)
+                res = (store.get(0).version, store.get(0)['price'])
+                exp = (2, 1.5)
+                store.close()
+                self.assertTrue(res == exp,
+                                '%s expected, but %s got' % (exp, res))
+        finally:
+            shutil.rmtree(path)
+
+    def test_313_update_cas(self):
+        store = mmshop.ItemStore([{'id': 0, 'name': 'tea', 'price': 0.0}])
+
+        def worker():
+            for _ in range(50):
+                while True:
+                    item = store.get(0)
+                    try:
+                        store.update(0, {'price': item.price + 1.0},
+                                     version=item.version)
+                    except mmshop.ItemVersionError:
+                        continue
+                    break
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        res = (store.get(0)['price'], store.get(0).version)
+        exp = (400.0, 401)
+        self.assertTrue(res == exp, '%s expected, but %s got' % (exp, res))
+
+    def test_314_changes(self):
+        store = mmshop.ItemStore([{'name': 'tea', 'price': 1.0}])
+        store.changes = mmshop.ChangeLog(3)
+        seq = store.changes.seq
+        store.add({'name': 'milk', 'price': 2.0})
+        store.update(0, {'price': 1.5})
+        res = [(c.seq, c.op, c.item['price'])
+               for c in store.changes.since(seq)]
+        exp = [(1, 'create', 2.0), (2, 'update', 1.5)]
+        self.assertTrue(res == exp, '%s expected, but %s got' % (exp, res))
+        res = store.changes.wait(2, 0.01)
+        self.assertTrue(res == [], 'no changes expected, but %s got' % res)
+        store.add_many([{'name': 'egg', 'price': 0.2},
+                        {'name': 'jam', 'price': 3.0}])
+        self.assertRaises(mmshop.ChangesExpiredError,
+                          store.changes.since, seq)
+        self.assertRaises(mmshop.ChangesExpiredError,
+                          store.changes.since, 5)
+        res = [c.item['name'] for c in store.changes.wait(2)]
+        exp = ['egg', 'jam']
+        self.assertTrue(res == exp, '%s expected, but %s got' % (exp, res))
+
+    def test_315_negotiate_encoding(self):
+        encodings = ('br', 'gzip')
+        for header, exp in ((None, None),
+                            ('gzip, deflate', 'gzip'),
+                            ('gzip, br', 'br'),
+                            ('br;q=0.5, gzip', 'gzip'),
+                            ('gzip;q=0, deflate', None),
+                            ('*', 'br'),
+                            ('identity', None)):
+            res = mmshop.negotiate_encoding(header, encodings)
+            self.assertTrue(res == exp, '%s: %s expected, but %s got' % (header, exp, res))  # @IgnorePep8
+        data = b'mickey mouse ' * 100
+        res = gzip.decompress(mmshop.compress(data, 'gzip'))
+        self.assertTrue(res == data, 'bad compression')
+
+    def test_316_workers_store(self):
+        # > workers need a store shared by processes
+        for spec in ('memory', 'wal:/tmp/mmshop'):
+            self.assertRaises(ValueError, mmshop.serve_workers, 2,
+                              {'mmshop.store': spec})
+
+    def test_317_store_shm(self):
+        path = os.path.join(tempfile.mkdtemp(), 'mmshop.shm')
+        try:
+            store = mmshop.SharedItemStore(
+                path, [{'id': 0, 'name': 'tea', 'price': 1.0}], capacity=2)
+            # > other process writes to the store, the files grow
+            pid = os.fork()
+            if not pid:
+                other = mmshop.SharedItemStore(path)
+                other.add_many([{'name': 'coffee', 'price': 2.0}] * 5)
+                other.update(0, {'price': 1.5})
+                os._exit(0)
+            os.waitpid(pid, 0)
+            self.assertRaises(mmshop.ItemExistsError, store.add,
+                              {'id': 1, 'name': 'water', 'price': 0.5})
+            items, next_after = store.page(after=1, limit=2)
+            res = (len(store), store.get(0)['price'], store.get(0).version,
+                   store.next_id(), [i['id'] for i in items], next_after,
+                   store.stats()['items_value'], store.version)
+            exp = (6, 1.5, 2, 6, [2, 3], 3, 11.5, 3)
+            store.close()
+            self.assertTrue(res == exp, '%s expected, but %s got' % (exp, res))
+        finally:
+            shutil.rmtree(os.path.dirname(path))
+
+    def test_318_store_wal_bulk(self):
+        path = tempfile.mkdtemp()
+        try:
+            store = mmshop.WALItemStore(path, snapshot_every=5)
+            store.add({'name': 'tea', 'price': 1.0})
+            # > the log is rotated within the bulk import
+            store.add_many([{'name': 'coffee', 'price': 2.0}] * 10)
+            store.add_many([{'name': 'water', 'price': 0.5}] * 3)
+            store.close()
+            # recover
+            store = mmshop.WALItemStore(path)
+            res = ([i['id'] for i in store.items()], store.next_id())
+            exp = (list(range(14)), 14)
+            store.close()
+            self.assertTrue(res == exp, '%s expected, but %s got' % (exp, res))
+        finally:
+            shutil.rmtree(path)
+
+    def test_319_store_bulk_ids(self):
+        path = tempfile.mkdtemp()
+        try:
+            for spec in ('memory', 'sqlite:%s' % os.path.join(path, 'db'),
+                         'shm:%s' % os.path.join(path, 'shm')):
+                store = mmshop.open_store(spec, [{'name': 'tea',
+                                                  'price': 1.0}])
+                errors = store.add_many([{'name': 'coffee', 'price': 2.0},
+                                         {'id': 1, 'name': 'water',
+                                          'price': 0.5}])
+                res = (errors, [(i['id'], i['name']) for i in store.items()])
+                exp = ([None, None],
+                       [(0, 'tea'), (1, 'water'), (2, 'coffee')])
+                store.close()
+                self.assertTrue(res == exp, '%s: %s expected, but %s got' %
+                                (spec, exp, res))
+        finally:
+            shutil.rmtree(path)
+
+    def test_320_store_total(self):
+        path = tempfile.mkdtemp()
+        try:
+            for spec in ('memory', 'sqlite:%s' % os.path.join(path, 'db'),
+                         'shm:%s' % os.path.join(path, 'shm')):
+                store = mmshop.open_store(spec, [{'name': 'gold',
+                                                  'price': 1e16}])
+                # > the small prices are lost by a plain sum
+                store.add_many([{'name': 'tea', 'price': 1.0}] * 10)
+                store.update(0, {'price': 0.0})
+                res = store.stats()['items_value']
+                exp = 10.0
+                store.close()
+                self.assertTrue(res == exp, '%s: %s expected, but %s got' %
+                                (spec, exp, res))
+        finally:
+            shutil.rmtree(path)
+
+    def test_321_store_shared_changes(self):
+        path = tempfile.mkdtemp()
+        try:
+            for cls in (mmshop.SQLiteItemStore, mmshop.SharedItemStore):
+                filename = os.path.join(path, cls.__name__)
+                store = cls(filename, [{'name': 'tea', 'price': 1.0}],
+                            changes_size=3)
+                seq = store.changes.seq
+                # > other process writes to the store, later the waiting
+                #   reader is woken by its writes too
+                pid = os.fork()
+                if not pid:
+                    other = cls(filename)
+                    other.add({'name': 'milk', 'price': 2.0})
+                    other.update(0, {'price': 1.5})
+                    time.sleep(0.2)
+                    other.add({'name': 'egg', 'price': 0.2})
+                    os._exit(0)
+                res = []
+                last = seq
+                start = time.time()
+                while last < 4 and time.time() - start < 5:
+                    changes = store.changes.wait(last, 5)
+                    res.extend((c.seq, c.op, c.item['price'])
+                               for c in changes)
+                    last = changes[-1].seq if changes else last
+                elapsed = time.time() - start
+                os.waitpid(pid, 0)
+                exp = [(2, 'create', 2.0), (3, 'update', 1.5),
+                       (4, 'create', 0.2)]
+                self.assertTrue(res == exp, '%s: %s expected, but %s got' %
+                                (cls.__name__, exp, res))
+                self.assertTrue(elapsed < 2, '%s: waited %.1fs' %
+                                (cls.__name__, elapsed))
+                store.add_many([{'name': 'jam', 'price': 3.0}] * 2)
+                self.assertRaises(mmshop.ChangesExpiredError,
+                                  store.changes.since, seq)
+                self.assertRaises(mmshop.ChangesExpiredError,
+                                  store.changes.since, 7)
+                res = [(c.seq, c.item['name'])
+                       for c in store.changes.since(4)]
+                exp = [(5, 'jam'), (6, 'jam')]
+                store.close()
+                self.assertTrue(res == exp, '%s: %s expected, but %s got' %
+                                (cls.__name__, exp, res))
+        finally:
+            shutil.rmtree(path)
+
+    def test_322_store_id_range(self):
+        path = tempfile.mkdtemp()
+        try:
+            for spec in ('memory', 'wal:%s' % os.path.join(path, 'wal'),
+                         'sqlite:%s' % os.path.join(path, 'db'),
+                         'shm:%s' % os.path.join(path, 'shm')):
+                store = mmshop.open_store(spec, [{'name': 'tea',
+                                                  'price': 1.0}])
+                self.assertRaises(ValueError, store.add,
+                                  {'id': 2 ** 63, 'name': 'big',
+                                   'price': 1.0})
+                errors = store.add_many([{'id': -2 ** 63 - 1, 'name': 'big',
+                                          'price': 1.0},
+                                         {'name': 'milk', 'price': 2.0}])
+                store.add({'name': 'egg', 'price': 0.2})
+                if spec != 'memory':
+                    # > nothing of the rejected items is persisted
+                    store.close()
+                    store = mmshop.open_store(spec)
+                res = ([type(e).__name__ for e in errors],
+                       [(i['id'], i['name']) for i in store.items()],
+                       store.stats()['items_count'])
+                exp = (['ValueError', 'NoneType'],
+                       [(0, 'tea'), (1, 'milk'), (2, 'egg')], 3)
+                store.close()
+                self.assertTrue(res == exp, '%s: %s expected, but %s got' %
+                                (spec, exp, res))
+        finally:
+            shutil.rmtree(path)
+
+    def test_323_store_wal_recover(self):
+        path = tempfile.mkdtemp()
+        try:
+            # > log with a record of an item the store can not hold
+            records = [{'op': 'add', 'version': 1,
+                        'item': {'id': 0, 'name': 'tea', 'price': 1.0}},
+                       {'op': 'add', 'version': 1,
+                        'item': {'id': 10 ** 20, 'name': 'big',
+                                 'price': 1.0}}]
+            with open(os.path.join(path, 'wal-00000000.ndjson'), 'w') as f:
+                f.writelines(json.dumps(r) + '\n' for r in records)
+            store = mmshop.WALItemStore(path)
+            store.add({'name': 'milk', 'price': 2.0})
+            res = [(i['id'], i['name']) for i in store.items()]
+            exp = [(0, 'tea'), (1, 'milk')]
+            store.close()
+            self.assertTrue(res == exp, '%s expected, but %s got' % (exp, res))  # @IgnorePep8
+        finally:
+            shutil.rmtree(path)
+
+    def test_324_store_shm_indexes(self):
+        names = ['apple', 'apricot', None, 'cheese', 'cherry', 'tea']
+
+        def items(first, count):
+            return [{'id': i, 'name': names[i % 6], 'price': float(i % 7),
+                     'expire': '20190%s010000' % (1 + i % 9)}
+                    for i in range(first, first + count)]
+
+        def writes(store):
+            # > single adds and updates move the index entries, the bulk
+            #   add rebuilds the indexes and grows the index file
+            for item in items(100, 3):
+                store.add(item)
+            store.update(5, {'price': 9.0})
+            store.update(7, {'name': 'banana'})
+            store.update(11, {'expire': '201812010000'})
+            store.update(13, {'name': None, 'price': 0.5})
+            store.add_many(items(200, 300))
+
+        def results(store):
+            now = datetime.datetime(2019, 5, 1)
+            first, next_after = store.query(sort='name', order='desc',
+                                            limit=7)
+            page, _ = store.query(sort='name', order='desc',
+                                  after=next_after, limit=7)
+            return ([i['id'] for i in store.items()],
+                    [i['id'] for i in first + page],
+                    [i['id'] for i in store.query(name_prefix='ap',
+                                                  price_max=2.0,
+                                                  sort='expire')[0]],
+                    [i['id'] for i in store.query(price_min=9.0,
+                                                  sort='price',
+                                                  order='desc')[0]],
+                    [i['id'] for i in store.query(expired=False,
+                                                  sort='id', limit=5,
+                                                  after=300, now=now)[0]],
+                    [i['id'] for i in store.expired(now)],
+                    store.next_expire(now), store.stats(now))
+        path = os.path.join(tempfile.mkdtemp(), 'mmshop.shm')
+        try:
+            memory = mmshop.ItemStore(items(0, 100))
+            writes(memory)
+            store = mmshop.SharedItemStore(path, items(0, 100), capacity=8)
+            # > the indexes written by other process
+            pid = os.fork()
+            if not pid:
+                writes(mmshop.SharedItemStore(path))
+                os._exit(0)
+            os.waitpid(pid, 0)
+            exp = results(memory)
+            res = results(store)
+            store.close()
+            self.assertTrue(res == exp, '%s expected, but %s got' % (exp, res))  # @IgnorePep8
+            # > the indexes are rebuilt if the index file is missing
+            os.remove(path + '.index')
+            store = mmshop.SharedItemStore(path)
+            res = results(store)
+            store.close()
+            self.assertTrue(res == exp, '%s expected, but %s got' % (exp, res))  # @IgnorePep8
+        finally:
+            shutil.rmtree(os.path.dirname(path))
+
+    def test_325_store_sqlite_percentiles(self):
+        path = tempfile.mkdtemp()
+        try:
+            # > the ranks near the top are read from the end of the index
+            for count in (1, 2, 3, 10, 101, 250):
+                items = [{'id': i, 'name': 'tea', 'price': float(i * 37 % 101)}  # @IgnorePep8
+                         for i in range(count)]
+                memory = mmshop.ItemStore(items)
+                store = mmshop.SQLiteItemStore(
+                    os.path.join(path, 'db%s' % count), items)
+                res, exp = store.stats(), memory.stats()
+                self.assertTrue(res == exp, '%s expected, but %s got' % (exp, res))  # @IgnorePep8
+                # > the percentiles kept until the next write
+                store.update(0, {'price': 1000.0})
+                memory.update(0, {'price': 1000.0})
+                res, exp = store.stats(), memory.stats()
+                store.close()
+                self.assertTrue(res == exp, '%s expected, but %s got' % (exp, res))  # @IgnorePep8
+        finally:
+            shutil.rmtree(path)
+
+    def test_326_workers(self):
+        # > smoke test of the worker processes with the shared store
+        path = tempfile.mkdtemp()
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        url = 'http://127.0.0.1:%s%s/item' % (port, mmshop.API_URL)
+        proc = subprocess.Popen(
+            [sys.executable, '-m', 'mmshop', '--workers', '2', '--no-auth',
+             '--port', str(port), '--store', 'shm:%s' % os.path.join(path, 'shm')],  # @IgnorePep8
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        def workers():
+            res = []
+            for pid in os.listdir('/proc'):
+                try:
+                    with open('/proc/%s/stat' % pid) as f:
+                        stat = f.read()
+                except (OSError, ValueError):
+                    continue
+                # > the state follows the command in parentheses
+                if stat.rpartition(')')[2].split()[1] == str(proc.pid):
+                    res.append(int(pid))
+            return res
+
+        def wait_for(check, timeout=20):
+            deadline = time.time() + timeout
+            while time.time() < deadline:
+                try:
+                    res = check()
+                    if res:
+                        return res
+                except OSError:
+                    pass
+                time.sleep(0.1)
+            return None
+
+        def get():
+            with urllib.request.urlopen(url, timeout=5) as response:
+                return (response.status,
+                        response.headers['X-Changes-Seq'])
+        try:
+            res = wait_for(get)
+            self.assertTrue(res and res[0] == 200, 'no response: %s' % (res,))
+            pids = wait_for(lambda: len(workers()) == 2 and workers())
+            self.assertTrue(pids, 'two workers expected: %s' % workers())
+            os.kill(pids[0], signal.SIGKILL)
+            # > the other worker serves, the supervisor restarts the killed
+            res = [get() for _ in range(5)]
+            exp = [(200, res[0][1])] * 5
+            self.assertTrue(res == exp, '%s expected, but %s got' % (exp, res))  # @IgnorePep8
+            res = wait_for(lambda: pids[0] not in workers() and
+                           len(workers()) == 2)
+            self.assertTrue(res, 'worker not restarted: %s' % workers())
+            self.assertTrue(wait_for(get)[0] == 200, 'no response')
+            proc.send_signal(signal.SIGTERM)
+            res = proc.wait(20)
+            self.assertTrue(res == 0, 'exit code 0 expected, but %s got' % res)  # @IgnorePep8
+            self.assertTrue(workers() == [], 'workers left: %s' % workers())
+        finally:
+            if proc.poll() is None:
+                for pid in workers():
+                    os.kill(pid, signal.SIGKILL)
+                proc.kill()
+                proc.wait()
+            shutil.rmtree(path)
+
+    def test_327_store_shm_compact(self):
+        path = os.path.join(tempfile.mkdtemp(), 'mmshop.shm')
+        compact_min = mmshop.shared.SHM_HEAP_COMPACT_MIN
+        mmshop.shared.SHM_HEAP_COMPACT_MIN = 4096
+        try:
+            store = mmshop.SharedItemStore(
+                path, [{'name': 'tea %s' % i, 'price': 1.0}
+                       for i in range(10)], capacity=2, changes_size=5)
+            # > reader with own mappings like another process
+            reader = mmshop.SharedItemStore(path)
+            reader.get(9)
+            for n in range(2000):
+                store.update(n % 10, {'price': float(n)})
+            store.update(3, {'name': 'coffee'})
+            seq = store.changes.seq
+            res = (os.path.getsize(path + '.heap') < 32 * 1024,
+                   [(i['name'], i['price'], i.version)
+                    for i in reader.items()][2:5],
+                   [(c.item['id'], c.item['price'])
+                    for c in reader.changes.since(seq - 4)])
+            exp = (True,
+                   [('tea 2', 1992.0, 201), ('coffee', 1993.0, 202),
+                    ('tea 4', 1994.0, 201)],
+                   [(7, 1997.0), (8, 1998.0), (9, 1999.0), (3, 1993.0)])
+            reader.close()
+            store.close()
+            self.assertTrue(res == exp, '%s expected, but %s got' % (exp, res))
+        finally:
+            mmshop.shared.SHM_HEAP_COMPACT_MIN = compact_min
+            shutil.rmtree(os.path.dirname(path))
+
 if __name__ == "__main__":
     # :note: ignore warnings from cheroot
     # :todo: there are some errors by shutting down the server and engine